@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""
+File: fat32.py
+
+Builds a complete FAT32 filesystem from a directory tree straight into a file or block device, without
+mkdosfs, mount or rsync. Every directory and file gets a contiguous run of clusters (directories first,
+then the file data in tree order), so the whole filesystem is written front to back in one sequential
+stream: reserved sectors, both FATs, the directories and then the file data. Long file names are
+stored as VFAT long name entries next to a generated 8.3 short name.
+
+Usage:
+	image = fatImage(sectors, 'TOOLS', hiddenSectors=start)
+	image.addTree('/local_tools/')
+	image.write(fd, offset)
+"""
+
+import os
+import array
+import struct
+from time import localtime, time
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+ROOT_CLUSTER = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+MEDIA_DESCRIPTOR = 0xf8
+MIN_CLUSTERS = 65525 # fewer clusters than this and it is FAT16 by definition
+MAX_CLUSTERS = 0x0ffffff5
+END_OF_CHAIN = 0x0fffffff
+DIR_ENTRY_SIZE = 32
+LFN_CHARS = 13
+WRITE_CHUNK = 4 * 1024 * 1024
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+# Flags (in the reserved byte of a short entry) for an 8.3 name that is all lowercase, as Linux and Windows write them
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXT = 0x10
+
+# Characters allowed in a short (8.3) name besides A-Z and 0-9
+SHORT_NAME_CHARS = "!#$%&'()-@^_`{}~"
+# Characters never allowed in a long name
+INVALID_LONG_CHARS = '"*/:<>?\\|'
+
+def sectorsPerCluster(sectors):
+	"""The cluster size mkdosfs would pick for a FAT32 filesystem of this many sectors"""
+	size = sectors * SECTOR_SIZE
+	if size <= 260 * 1024 * 1024:
+		return 1
+	if size <= 8 * 1024 * 1024 * 1024:
+		return 8
+	if size <= 16 * 1024 * 1024 * 1024:
+		return 16
+	if size <= 32 * 1024 * 1024 * 1024:
+		return 32
+	return 64
+
+def fatDateTime(timestamp):
+	"""Converts a unix timestamp into (date, time) in FAT's 2 second resolution local time"""
+	t = localtime(timestamp)
+	if t.tm_year < 1980:
+		return ((1 << 5) | 1, 0)
+	if t.tm_year > 2107:
+		return ((127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29)
+	return (((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+			(t.tm_hour << 11) | (t.tm_min << 5) | (min(t.tm_sec, 59) / 2))
+
+def shortNameChecksum(shortName):
+	"""The checksum of an 11 byte short name that ties its long name entries to it"""
+	checksum = 0
+	for c in shortName:
+		checksum = (((checksum & 1) << 7) + (checksum >> 1) + ord(c)) & 0xff
+	return checksum
+
+def shortNamePart(text):
+	"""Uppercases 'text' and replaces anything not allowed in a short name (returns the part and whether it was lossy)"""
+	result = ''
+	lossy = False
+	for c in text.upper():
+		if c.isalnum() and ord(c) < 128 or c in SHORT_NAME_CHARS:
+			result += c
+		elif c in ' .':
+			lossy = True
+		else:
+			result += '_'
+			lossy = True
+	return (result, lossy)
+
+def makeShortName(name, taken):
+	"""Generates the 11 byte short name for 'name', unique among 'taken' (a set of short names already
+	in the directory). Returns (shortName, needsLongName, caseFlags)."""
+	parts = name.split('.')
+	if len(name) <= 12 and len(parts) <= 2 and 0 < len(parts[0]) <= 8 and (len(parts) == 1 or 0 < len(parts[1]) <= 3):
+		# already a valid 8.3 name, e.g. "SYSLINUX.CFG" or "syslinux.cfg" (boot loaders may only read these)
+		parts.append('')
+		(base, lossy) = shortNamePart(parts[0])
+		(ext, extLossy) = shortNamePart(parts[1])
+		caseFlags = 0
+		for (part, flag) in [ (parts[0], CASE_LOWER_BASE), (parts[1], CASE_LOWER_EXT) ]:
+			if part.lower() == part and part.upper() != part:
+				caseFlags |= flag
+			elif part.upper() != part:
+				lossy = True	# mixed case needs a long name
+		shortName = base.ljust(8) + ext.ljust(3)
+		if not (lossy or extLossy) and shortName not in taken:
+			return (shortName.encode('ascii'), False, caseFlags)
+
+	stripped = name.lstrip('.')
+	if '.' in stripped:
+		(base, ext) = stripped.rsplit('.', 1)
+	else:
+		(base, ext) = (stripped, '')
+	base = shortNamePart(base)[0] or '_'
+	ext = shortNamePart(ext)[0][:3]
+	for n in xrange(1, 1000000):
+		tail = '~' + str(n)
+		shortName = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+		if shortName not in taken:
+			return (shortName.encode('ascii'), True, 0)
+	raise ValueError("too many similar names in one directory: " + name)
+
+def longNameEntries(name, shortName):
+	"""Builds the VFAT long name entries (in on-disk order) that precede a short name entry"""
+	chars = name.encode('utf-16-le')
+	chars = [ chars[i:i + 2] for i in range(0, len(chars), 2) ]
+	if len(chars) % LFN_CHARS:
+		chars.append('\0\0')
+	while len(chars) % LFN_CHARS:
+		chars.append('\xff\xff')
+	checksum = shortNameChecksum(shortName)
+	count = len(chars) / LFN_CHARS
+	entries = []
+	for i in range(count):
+		part = chars[i * LFN_CHARS:(i + 1) * LFN_CHARS]
+		order = i + 1
+		if order == count:
+			order |= 0x40
+		entries.append(struct.pack('<B10sBBB12sH4s', order, ''.join(part[0:5]), ATTR_LONG_NAME, 0, checksum,
+								   ''.join(part[5:11]), 0, ''.join(part[11:13])))
+	entries.reverse()
+	return entries
+
+def dirEntry(shortName, attr, cluster, size, mtime, caseFlags=0):
+	"""Builds a 32 byte short directory entry"""
+	(date, tm) = fatDateTime(mtime)
+	return struct.pack('<11sBBBHHHHHHHI', shortName, attr, caseFlags, 0, tm, date, date, cluster >> 16, tm, date,
+					   cluster & 0xffff, size)
+
+class fatNode:
+	"""A file or directory that will be stored in the filesystem"""
+	def __init__(self, name, source, isDir, size, mtime):
+		self.name = name
+		self.source = source
+		self.isDir = isDir
+		self.size = size
+		self.mtime = mtime
+		self.children = []
+		self.cluster = 0
+		self.clusters = 0
+		self.entries = 0
+
+class fatImage:
+	"""A FAT32 filesystem being put together in memory (only the metadata; file data is streamed
+	from the source files when it's written)"""
+	def __init__(self, sectors, label, hiddenSectors=0, volumeId=None):
+		"""
+		@param sectors - size of the filesystem in 512 byte sectors
+		@param label - volume label (up to 11 characters, e.g. 'TOOLS')
+		@param hiddenSectors - (optional) sectors before the filesystem on the drive (its partition's start)
+		@param volumeId - (optional) 32 bit volume serial number (default: from the current time)
+		"""
+		self.sectors = sectors
+		self.label = label.upper()[:11]
+		self.hiddenSectors = hiddenSectors
+		if volumeId is None:
+			volumeId = int(time() * 1000) & 0xffffffff
+		self.volumeId = volumeId
+		self.sectorsPerCluster = sectorsPerCluster(sectors)
+		self.clusterSize = self.sectorsPerCluster * SECTOR_SIZE
+		self.computeGeometry()
+		self.root = fatNode('', None, True, 0, time())
+
+	def computeGeometry(self):
+		"""Works out how many clusters there are and how many sectors each FAT needs to map them"""
+		self.fatSectors = 1
+		while True:
+			dataSectors = self.sectors - RESERVED_SECTORS - NUM_FATS * self.fatSectors
+			self.numClusters = dataSectors / self.sectorsPerCluster
+			needed = ((self.numClusters + 2) * 4 + SECTOR_SIZE - 1) / SECTOR_SIZE
+			if needed <= self.fatSectors:
+				break
+			self.fatSectors = needed
+		if self.numClusters < MIN_CLUSTERS or self.numClusters > MAX_CLUSTERS:
+			raise ValueError("%d sectors gives %d clusters, which is not a valid FAT32 size" % (self.sectors, self.numClusters))
+		self.dataStart = (RESERVED_SECTORS + NUM_FATS * self.fatSectors) * SECTOR_SIZE
+
+	def addTree(self, source, dest=None):
+		"""Adds the contents of the directory 'source' (regular files and directories, like rsync -r)
+		@param source - directory to copy from
+		@param dest - (optional) node to add them to (default: the root directory)
+		"""
+		if dest is None:
+			dest = self.root
+		for name in sorted(os.listdir(source)):
+			path = os.path.join(source, name)
+			if os.path.islink(path):
+				continue
+			st = os.stat(path)
+			if os.path.isdir(path):
+				node = self.addNode(dest, name, None, True, 0, st.st_mtime)
+				self.addTree(path, node)
+			elif os.path.isfile(path):
+				self.addNode(dest, name, path, False, st.st_size, st.st_mtime)
+
+	def addFile(self, source, name=None):
+		"""Adds a single file to the root directory
+		@param source - the file to copy
+		@param name - (optional) its name on the filesystem (default: the same)
+		"""
+		if name is None:
+			name = os.path.basename(source)
+		st = os.stat(source)
+		self.addNode(self.root, name, source, False, st.st_size, st.st_mtime)
+
+	def addNode(self, parent, name, source, isDir, size, mtime):
+		if not isinstance(name, unicode):
+			name = name.decode('utf-8', 'replace')
+		for c in INVALID_LONG_CHARS:
+			name = name.replace(c, '_')
+		if len(name) > 255:
+			raise ValueError("file name too long for FAT: " + name.encode('utf-8'))
+		if size > 0xffffffff:
+			raise ValueError("file too big for FAT32: " + source)
+		node = fatNode(name, source, isDir, size, mtime)
+		parent.children.append(node)
+		return node
+
+	def walk(self, node=None):
+		"""Yields every node, breadth first (the order the directories are allocated in)"""
+		if node is None:
+			node = self.root
+		queue = [ node ]
+		while queue:
+			node = queue.pop(0)
+			yield node
+			queue.extend([ child for child in node.children if child.isDir ])
+			for child in node.children:
+				if not child.isDir:
+					yield child
+
+	def allocate(self):
+		"""Gives every directory (first) and every non-empty file (after them) a contiguous run of clusters
+		@returns the number of clusters used
+		"""
+		nodes = list(self.walk())
+		dirs = [ node for node in nodes if node.isDir ]
+		files = [ node for node in nodes if not node.isDir ]
+		self.shortNames = {}
+		for node in dirs:
+			entries = 0
+			if node is self.root:
+				entries += 1	# the volume label
+			else:
+				entries += 2	# '.' and '..'
+			taken = set()
+			for child in node.children:
+				(shortName, needsLongName, caseFlags) = makeShortName(child.name, taken)
+				taken.add(shortName)
+				self.shortNames[id(child)] = (shortName, needsLongName, caseFlags)
+				entries += 1
+				if needsLongName:
+					entries += (len(child.name.encode('utf-16-le')) / 2 + LFN_CHARS - 1) / LFN_CHARS
+			if entries > 65536:
+				raise ValueError("too many entries for one FAT directory: " + node.name.encode('utf-8'))
+			node.entries = entries
+			node.size = entries * DIR_ENTRY_SIZE
+		cluster = ROOT_CLUSTER
+		for node in dirs + files:
+			node.clusters = (node.size + self.clusterSize - 1) / self.clusterSize
+			if node.isDir:
+				node.clusters = max(node.clusters, 1)
+			if node.clusters:
+				node.cluster = cluster
+				cluster += node.clusters
+		used = cluster - ROOT_CLUSTER
+		if used > self.numClusters:
+			raise ValueError("%d MB of clusters needed, but the filesystem only has %d MB" %
+							 (used * self.clusterSize / 1000000, self.numClusters * self.clusterSize / 1000000))
+		self.dirs = dirs
+		self.files = files
+		return used
+
+	def bootSector(self, used):
+		"""Builds the boot sector, the FS information sector and the rest of the reserved area"""
+		bpb = struct.pack('<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s',
+						  '\xeb\x58\x90', 'MSWIN4.1', SECTOR_SIZE, self.sectorsPerCluster, RESERVED_SECTORS,
+						  NUM_FATS, 0, 0, MEDIA_DESCRIPTOR, 0, 32, 64, self.hiddenSectors, self.sectors,
+						  self.fatSectors, 0, 0, ROOT_CLUSTER, FSINFO_SECTOR, BACKUP_BOOT_SECTOR, '\0' * 12,
+						  0x80, 0, 0x29, self.volumeId, self.label.encode('ascii', 'replace').ljust(11), 'FAT32   ')
+		boot = bpb.ljust(SECTOR_SIZE - 2, '\0') + '\x55\xaa'
+		nextFree = ROOT_CLUSTER + used
+		if nextFree >= self.numClusters + 2:
+			nextFree = 0xffffffff
+		fsInfo = struct.pack('<I480sI', 0x41615252, '\0' * 480, 0x61417272)
+		fsInfo += struct.pack('<II12sI', self.numClusters - used, nextFree, '\0' * 12, 0xaa550000)
+		blank = '\0' * SECTOR_SIZE
+		sectors = [ boot, fsInfo ] + [ blank ] * (BACKUP_BOOT_SECTOR - 2) + [ boot, fsInfo ]
+		sectors += [ blank ] * (RESERVED_SECTORS - len(sectors))
+		return ''.join(sectors)
+
+	def fatTable(self):
+		"""Builds one copy of the FAT: every allocated run is a simple chain ending in end-of-chain"""
+		fat = array.array('I')
+		if fat.itemsize != 4:
+			fat = array.array('L')
+		fat.append(0x0fffff00 | MEDIA_DESCRIPTOR)
+		fat.append(END_OF_CHAIN)
+		for node in self.dirs + self.files:
+			if node.clusters:
+				fat.extend(xrange(node.cluster + 1, node.cluster + node.clusters))
+				fat.append(END_OF_CHAIN)
+		data = fat.tostring()
+		return data + '\0' * (self.fatSectors * SECTOR_SIZE - len(data))
+
+	def directory(self, node, parent):
+		"""Builds the clusters of a directory"""
+		entries = []
+		if node is self.root:
+			entries.append(dirEntry(self.label.encode('ascii', 'replace').ljust(11), ATTR_VOLUME_ID, 0, 0, node.mtime))
+		else:
+			parentCluster = parent.cluster
+			if parent is self.root:
+				parentCluster = 0
+			entries.append(dirEntry('.'.ljust(11), ATTR_DIRECTORY, node.cluster, 0, node.mtime))
+			entries.append(dirEntry('..'.ljust(11), ATTR_DIRECTORY, parentCluster, 0, node.mtime))
+		for child in node.children:
+			(shortName, needsLongName, caseFlags) = self.shortNames[id(child)]
+			if needsLongName:
+				entries.extend(longNameEntries(child.name, shortName))
+			if child.isDir:
+				entries.append(dirEntry(shortName, ATTR_DIRECTORY, child.cluster, 0, child.mtime, caseFlags))
+			else:
+				entries.append(dirEntry(shortName, ATTR_ARCHIVE, child.cluster, child.size, child.mtime, caseFlags))
+		data = ''.join(entries)
+		return data + '\0' * (node.clusters * self.clusterSize - len(data))
+
+	def write(self, fd, offset=0, progress=None):
+		"""Writes the whole filesystem, front to back
+		@param fd - file descriptor of the file or block device
+		@param offset - (optional) byte offset of the filesystem in it (e.g. 0 for a partition node)
+		@param progress - (optional) function called with the number of bytes of each write
+		@returns the number of bytes written
+		"""
+		used = self.allocate()
+		out = streamWriter(fd, offset, progress)
+		out.write(self.bootSector(used))
+		fat = self.fatTable()
+		for i in range(NUM_FATS):
+			out.write(fat)
+		del fat
+
+		parents = { id(self.root) : self.root }
+		for node in self.dirs:
+			for child in node.children:
+				parents[id(child)] = node
+		for node in self.dirs:
+			out.write(self.directory(node, parents[id(node)]))
+		for node in self.files:
+			if not node.clusters:
+				continue
+			f = open(node.source, 'rb')
+			try:
+				remaining = node.size
+				while remaining:
+					chunk = f.read(min(remaining, WRITE_CHUNK))
+					if not chunk:
+						raise IOError("%s shrank while it was being copied" % node.source)
+					out.write(chunk)
+					remaining -= len(chunk)
+			finally:
+				f.close()
+			out.write('\0' * (node.clusters * self.clusterSize - node.size))
+		out.flush()
+		return out.written
+
+def allocatedExtents(path, offset=0):
+	"""Returns the byte ranges of an existing FAT32 filesystem that hold anything: the reserved sectors
+	and the FATs, and every run of clusters the FAT marks as used (free clusters are left out)
+	@param path - the image file or device holding the filesystem
+	@param offset - (optional) byte offset of the filesystem in it
+	@returns a sorted list of (offset, length)
+	"""
+	f = open(path, 'rb')
+	try:
+		f.seek(offset)
+		boot = f.read(SECTOR_SIZE)
+		if len(boot) < SECTOR_SIZE or boot[82:90] != 'FAT32   ' or boot[510:512] != '\x55\xaa':
+			raise ValueError("no FAT32 filesystem at offset %d of %s" % (offset, path))
+		(bytesPerSector, perCluster, reserved, numFats) = struct.unpack('<HBHB', boot[11:17])
+		(totalSectors, fatSectors) = struct.unpack('<II', boot[32:40])
+		dataStart = (reserved + numFats * fatSectors) * bytesPerSector
+		clusterSize = perCluster * bytesPerSector
+		numClusters = (totalSectors * bytesPerSector - dataStart) / clusterSize
+
+		fat = array.array('I')
+		if fat.itemsize != 4:
+			fat = array.array('L')
+		f.seek(offset + reserved * bytesPerSector)
+		fat.fromstring(f.read((numClusters + 2) * 4))
+	finally:
+		f.close()
+
+	extents = [ (offset, dataStart) ]
+	runStart = None
+	for cluster in xrange(2, min(len(fat), numClusters + 2)):
+		if fat[cluster] & 0x0fffffff:
+			if runStart is None:
+				runStart = cluster
+		elif runStart is not None:
+			extents.append((offset + dataStart + (runStart - 2) * clusterSize, (cluster - runStart) * clusterSize))
+			runStart = None
+	if runStart is not None:
+		extents.append((offset + dataStart + (runStart - 2) * clusterSize, (cluster + 1 - runStart) * clusterSize))
+	return extents
+
+class streamWriter:
+	"""Collects small writes into large sequential ones"""
+	def __init__(self, fd, offset, progress=None):
+		self.fd = fd
+		self.progress = progress
+		self.buffer = []
+		self.buffered = 0
+		self.written = 0
+		os.lseek(fd, offset, os.SEEK_SET)
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= WRITE_CHUNK:
+			self.flush()
+
+	def flush(self):
+		if not self.buffered:
+			return
+		data = ''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		done = 0
+		while done < len(data):
+			done += os.write(self.fd, buffer(data, done))
+		self.written += len(data)
+		if self.progress is not None:
+			self.progress(len(data))
+
+def buildFilesystem(target, sectors, label, source=None, extraFiles=None, offset=0, hiddenSectors=0, progress=None):
+	"""Builds a FAT32 filesystem holding the tree 'source' into a file or block device
+	@param target - path of the file or device node
+	@param sectors - size of the filesystem in 512 byte sectors
+	@param label - volume label
+	@param source - (optional) directory whose contents go in the root directory
+	@param extraFiles - (optional) list of (path, name) of more files to put in the root directory
+	@param offset - (optional) byte offset of the filesystem in 'target'
+	@param hiddenSectors - (optional) the partition's start sector on the drive
+	@param progress - (optional) function called with the number of bytes of each write
+	@returns the number of bytes written
+	"""
+	image = fatImage(sectors, label, hiddenSectors)
+	if source:
+		image.addTree(source)
+	for (path, name) in extraFiles or []:
+		image.addFile(path, name)
+	fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0644)
+	try:
+		written = image.write(fd, offset, progress)
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+	return written
@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+"""
+File: usb_benchmark.py
+
+A reproducible benchmark for usb_updater.py. Creates N fake drives backed by sparse files (attached as
+loop devices when running as root, or used as plain files otherwise), points a fake MEDIA_DEV_ROOT at
+them and runs processDrive() on every drive at once in each requested mode, with a worker process per
+drive or (--engine threads) a thread per drive. Results (wall time, per-phase time, number of external
+commands, bytes written) are written as JSON so runs can be compared.
+
+--compare-engines runs each mode under both engines with a recordingRunner in place of the real
+commands and checks that every drive asked for the same commands in the same order.
+
+--check-devices checks usb_updater's device model (blockDevice) against a fake sysfs tree (fakeSysfs),
+including a drive being replaced by another one under the same kernel name.
+
+--check-fat builds FAT32 filesystems of a few sizes from the generated trees with the fat32 module and
+has fsck.vfat check them (when it is installed).
+
+--check-hotplug runs usb_updater's hotplug daemon against a scratch device directory and a stub pipeline
+(stubPipeline), plugging and unplugging drives by creating and removing their usbXpartY links.
+
+--crash-test kills each drive's worker partway through each stage in turn (crashWatch), then runs the
+drives again and checks that they resume at the right stage from their journals, skip the stages before
+it and come out finished (journal closed, stamped with the current image when imaging).
+
+Plain files only support the modes that never mount or repartition through the kernel (e.g. golden
+image cloning); use loop devices for the full imaging and tools modes.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import signal
+import subprocess
+import threading
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+from time import ctime, sleep, time
+
+import fat32
+import usb_updater
+
+def makeTree(root, numFiles, minSize, maxSize, seed):
+	"""Creates a reproducible tree of files (10 files per directory, 3 directory levels deep)
+	@param root - the directory to create
+	@param numFiles - how many files
+	@param minSize, maxSize - range of file sizes in bytes
+	@param seed - random seed, so the same options give the same tree
+	@returns total bytes
+	"""
+	rand = random.Random(seed)
+	total = 0
+	for i in range(numFiles):
+		dirPath = os.path.join(root, 'd%d' % (i / 1000), 'd%d' % (i / 100 % 10), 'd%d' % (i / 10 % 10))
+		if not os.path.isdir(dirPath):
+			os.makedirs(dirPath)
+		size = rand.randint(minSize, maxSize)
+		f = open(os.path.join(dirPath, 'file%d.bin' % i), 'wb')
+		f.write(os.urandom(min(size, 4096)) * (size / 4096) + os.urandom(size % 4096))
+		f.close()
+		total += size
+	return total
+
+def makeLive(root, sizeMB):
+	"""Creates a fake live folder: one big image file plus a few small boot files
+	@returns total bytes
+	"""
+	os.makedirs(root)
+	block = os.urandom(1024 * 1024)
+	f = open(os.path.join(root, 'live.iso'), 'wb')
+	for i in range(sizeMB):
+		f.write(block)
+	f.close()
+	for name in [ 'syslinux.cfg', 'vmlinuz', 'initrd.img' ]:
+		f = open(os.path.join(root, name), 'wb')
+		f.write(os.urandom(64 * 1024))
+		f.close()
+	return sizeMB * 1024 * 1024 + 3 * 64 * 1024
+
+class fakeDrive:
+	"""A drive backed by a sparse file, attached as a loop device (with partition scanning) if possible"""
+	def __init__(self, workDir, index, sizeMB, useLoop):
+		self.backing = os.path.join(workDir, 'disks', 'disk%d' % index)
+		f = open(self.backing, 'wb')
+		f.truncate(sizeMB * 1000000)
+		f.close()
+		self.loop = None
+		self.disk = self.backing
+		if useLoop:
+			self.loop = subprocess.Popen([ 'losetup', '-f', '-P', '--show', self.backing ], stdout=subprocess.PIPE).communicate()[0].strip()
+			self.disk = self.loop
+		self.partitions = []
+		for num in [1, 2]:
+			node = usb_updater.partitionNode(self.disk, num)
+			if self.loop is None:
+				# plain files have no partition nodes; give the links something to point at
+				open(node, 'wb').close()
+			self.partitions.append(node)
+
+	def bytesWritten(self):
+		"""Bytes written to the drive so far (loop device statistics, or space allocated in the file)"""
+		if self.loop is not None:
+			stat = open('/sys/block/' + os.path.basename(self.loop) + '/stat').read().split()
+			return int(stat[6]) * 512
+		return os.stat(self.backing).st_blocks * 512
+
+	def reset(self):
+		"""Zeroes the drive, so the next run starts from a blank drive again"""
+		f = open(self.backing, 'r+b')
+		size = os.fstat(f.fileno()).st_size
+		f.truncate(0)
+		f.truncate(size)
+		f.close()
+
+	def detach(self):
+		if self.loop is not None:
+			subprocess.call([ 'losetup', '-d', self.loop ])
+
+class fakeSysfs:
+	"""A fake sysfs tree and /dev for usb_updater's device model: USB drives with partitions, sizes, block
+	sizes and USB IDs that can be plugged in and unplugged without any hardware"""
+	def __init__(self, root):
+		self.sysfs = os.path.join(root, 'sys')
+		self.dev = os.path.join(root, 'dev')
+		self.controller = os.path.join(self.sysfs, 'devices', 'pci0000:00', '0000:00:14.0')
+		for path in [ os.path.join(self.sysfs, 'class', 'block'), os.path.join(self.sysfs, 'bus', 'usb', 'devices'), self.dev ]:
+			os.makedirs(path)
+		self.hosts = 0
+
+	def write(self, path, value):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		f = open(path, 'w')
+		f.write(str(value) + "\n")
+		f.close()
+
+	def link(self, target, link):
+		os.symlink(os.path.relpath(target, os.path.dirname(link)), link)
+
+	def plug(self, name, size, partitions, serial, usbPath='2-1.3', model='Fake Stick', physical=512, speed=480):
+		"""Adds a drive
+		@param name - its kernel name (e.g. 'sdb')
+		@param size - its size in bytes
+		@param partitions - list of (start sector, number of sectors) for partitions 1, 2, ...
+		@param serial - its USB serial number
+		@param usbPath - the USB port it is plugged into, e.g. '2-1.3' (port 3 of the hub on root port 2-1)
+		"""
+		bus = usbPath.split('-')[0]
+		usbDir = os.path.join(self.controller, 'usb' + bus)
+		ports = usbPath.split('-')[1].split('.')
+		for i in range(len(ports)):
+			port = bus + '-' + '.'.join(ports[:i + 1])
+			usbDir = os.path.join(usbDir, port)
+			if not os.path.isdir(usbDir):
+				self.write(os.path.join(usbDir, 'speed'), speed)
+				self.link(usbDir, os.path.join(self.sysfs, 'bus', 'usb', 'devices', port))
+		self.write(os.path.join(usbDir, 'serial'), serial)
+		self.write(os.path.join(usbDir, 'idVendor'), '0781')
+		self.write(os.path.join(usbDir, 'idProduct'), '5567')
+		self.hosts += 1
+		host = self.hosts
+		diskDir = os.path.join(usbDir, usbPath + ':1.0', 'host%d' % host, 'target%d:0:0' % host, '%d:0:0:0' % host)
+		self.write(os.path.join(diskDir, 'vendor'), 'Fake')
+		self.write(os.path.join(diskDir, 'model'), model)
+		diskDir = os.path.join(diskDir, 'block', name)
+		self.write(os.path.join(diskDir, 'size'), size / 512)
+		self.write(os.path.join(diskDir, 'removable'), 1)
+		self.write(os.path.join(diskDir, 'stat'), '0 0 0 0 0 0 0 0 0 0 0')
+		self.write(os.path.join(diskDir, 'queue', 'logical_block_size'), 512)
+		self.write(os.path.join(diskDir, 'queue', 'physical_block_size'), physical)
+		self.link(os.path.join(diskDir, '..', '..'), os.path.join(diskDir, 'device'))
+		self.link(diskDir, os.path.join(self.sysfs, 'class', 'block', name))
+		open(os.path.join(self.dev, name), 'w').close()
+		for (num, (start, sectors)) in enumerate(partitions):
+			partName = usb_updater.partitionNode(name, num + 1)
+			self.write(os.path.join(diskDir, partName, 'partition'), num + 1)
+			self.write(os.path.join(diskDir, partName, 'start'), start)
+			self.write(os.path.join(diskDir, partName, 'size'), sectors)
+			self.link(os.path.join(diskDir, partName), os.path.join(self.sysfs, 'class', 'block', partName))
+			open(os.path.join(self.dev, partName), 'w').close()
+
+	def unplug(self, name):
+		"""Removes a drive and its partitions"""
+		classDir = os.path.join(self.sysfs, 'class', 'block')
+		diskDir = os.path.realpath(os.path.join(classDir, name))
+		for entry in os.listdir(classDir):
+			if entry == name or os.path.dirname(os.path.realpath(os.path.join(classDir, entry))) == diskDir:
+				os.remove(os.path.join(classDir, entry))
+				os.remove(os.path.join(self.dev, entry))
+		# the drive's SCSI host and everything under it
+		shutil.rmtree(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(diskDir)))))
+
+def checkDevices(workDir):
+	"""Checks the device model against a fake sysfs tree, including a drive replaced by another one
+	under the same kernel name (which a pipeline stage worker must not mistake for the old one)
+	@returns a list of problems (empty if everything matched)
+	"""
+	problems = []
+	def expect(what, got, wanted):
+		if got != wanted:
+			problems.append("%s: got %r, expected %r" % (what, got, wanted))
+
+	sysfs = fakeSysfs(os.path.join(workDir, 'sysfs'))
+	saved = (usb_updater.SYSFS_ROOT, usb_updater.DEV_ROOT)
+	usb_updater.SYSFS_ROOT, usb_updater.DEV_ROOT = sysfs.sysfs, sysfs.dev
+	usb_updater.forgetBlockDevices()
+	try:
+		sysfs.plug('sdb', 8000000000, [ (2048, 1000000), (1002048, 500000) ], 'SERIAL1', '2-1.3', physical=4096)
+		link = os.path.join(workDir, 'dev', 'usb1part2')
+		os.symlink(os.path.join(sysfs.dev, 'sdb2'), link)
+		part = usb_updater.lookupBlockDevice(link)
+		disk = usb_updater.lookupBlockDevice(part.disk)
+		expect("partition's drive", part.disk, os.path.join(sysfs.dev, 'sdb'))
+		expect("partition number", part.number, 2)
+		expect("partition start", usb_updater.partitionStart(link), 1002048)
+		expect("partition size", usb_updater.getDeviceSize(link), 500000 * 512)
+		expect("drive size", usb_updater.getDeviceSize(part.disk), 8000000000)
+		expect("block sizes", (disk.logicalBlockSize, disk.physicalBlockSize), (512, 4096))
+		expect("removable", disk.removable, True)
+		expect("vendor and model", (disk.vendor, disk.model), ('Fake', 'Fake Stick'))
+		expect("partitions", [ p.node for p in disk.partitions() ], [ os.path.join(sysfs.dev, 'sdb1'), os.path.join(sysfs.dev, 'sdb2') ])
+		expect("drive ID", usb_updater.stableDriveId(part.disk), '0781-5567-SERIAL1')
+		topology = usb_updater.usbTopology(part.disk) or {}
+		expect("USB path", (disk.usbPath, topology.get('rootPort'), topology.get('hub'), topology.get('speed')), ('2-1.3', '2-1', '2-1', 480))
+
+		# another stick takes over sdb; a stage worker forgets the old one when it takes the new drive
+		sysfs.unplug('sdb')
+		sysfs.plug('sdb', 16000000000, [ (2048, 30000000) ], 'SERIAL2', '2-1.4')
+		usb_updater.forgetBlockDevice(link)
+		disk = usb_updater.lookupBlockDevice(os.path.join(sysfs.dev, 'sdb'))
+		expect("replaced drive size", usb_updater.getDeviceSize(disk.node), 16000000000)
+		expect("replaced drive ID", usb_updater.stableDriveId(disk.node), '0781-5567-SERIAL2')
+		expect("replaced drive partitions", [ p.number for p in disk.partitions() ], [1])
+		expect("replaced drive USB path", disk.usbPath, '2-1.4')
+	finally:
+		usb_updater.SYSFS_ROOT, usb_updater.DEV_ROOT = saved
+		usb_updater.forgetBlockDevices()
+	return problems
+
+class stubPipeline:
+	"""Stands in for drivePipeline in hotplugDaemon(): records every drive submitted to it, with the
+	generation drivePipeline would give it, and never finishes any"""
+	def __init__(self, submissions):
+		"""
+		@param submissions - Queue that gets (device, partition links, generation, time) for each submission
+		"""
+		self.submissions = submissions
+		self.submitted = 0
+		self.pending = 0
+
+	def submit(self, dev, paths=None):
+		self.submitted += 1
+		self.pending += 1
+		self.submissions.put((dev, paths, self.submitted, time()))
+
+	def poll(self, timeout=1):
+		return None
+
+	def wait(self):
+		pass
+
+def checkHotplug(workDir):
+	"""Runs the hotplug daemon against a scratch device directory and checks that a drive is submitted
+	once, once all its links are there; that it isn't submitted again when its links change while it is
+	being worked on; and that plugging it in again after it was removed submits a new generation
+	@returns a list of problems (empty if the daemon behaved)
+	"""
+	root = os.path.join(workDir, 'hotplug')
+	targets = os.path.join(workDir, 'hotplug-targets')
+	os.makedirs(root)
+	os.makedirs(targets)
+	def plug(drive, parts, target='sd'):
+		for num in parts:
+			node = os.path.join(targets, '%s%d' % (target, num))
+			open(node, 'wb').close()
+			os.symlink(node, os.path.join(root, 'usb%dpart%d' % (drive, num)))
+	def unplug(drive, parts):
+		for num in parts:
+			os.remove(os.path.join(root, 'usb%dpart%d' % (drive, num)))
+	def links(drive):
+		return [ os.path.join(root, 'usb%dpart%d' % (drive, num)) for num in [1, 2] ]
+
+	saved = (usb_updater.HOTPLUG_SETTLE, usb_updater.HOTPLUG_RESCAN_INTERVAL)
+	usb_updater.HOTPLUG_SETTLE = 0.3
+	usb_updater.HOTPLUG_RESCAN_INTERVAL = 0.2
+	submissions = Queue()
+	daemon = Process(target=usb_updater.hotplugDaemon, args=(stubPipeline(submissions), root))
+	daemon.start()
+	settle = 4 * usb_updater.HOTPLUG_SETTLE + 1
+	marks = {}
+	try:
+		# drive 1 plugged in; drive 2's partition links show up one after the other
+		plug(1, [1, 2])
+		plug(2, [1])
+		sleep(usb_updater.HOTPLUG_SETTLE / 2)
+		plug(2, [2])
+		sleep(settle)
+		# drive 1 is repartitioned while it is being worked on: its links go and come back
+		marks['changed'] = time()
+		unplug(1, [2])
+		sleep(usb_updater.HOTPLUG_SETTLE / 2)
+		plug(1, [2], 'sdx')
+		sleep(settle)
+		# drive 1 is taken out and plugged in again
+		marks['removed'] = time()
+		unplug(1, [1, 2])
+		sleep(settle)
+		marks['replugged'] = time()
+		plug(1, [1, 2], 'sdy')
+		sleep(settle)
+	finally:
+		os.kill(daemon.pid, signal.SIGINT)
+		daemon.join(10)
+		if daemon.is_alive():
+			daemon.terminate()
+		usb_updater.HOTPLUG_SETTLE, usb_updater.HOTPLUG_RESCAN_INTERVAL = saved
+
+	got = []
+	while not submissions.empty():
+		got.append(submissions.get())
+	problems = []
+	dev1, dev2 = os.path.join(root, 'usb1part'), os.path.join(root, 'usb2part')
+	first = [ (dev, paths, generation) for (dev, paths, generation, at) in got if at < marks['changed'] ]
+	if sorted(first) != sorted([ (dev1, links(1), 1), (dev2, links(2), 2) ]) and sorted(first) != sorted([ (dev1, links(1), 2), (dev2, links(2), 1) ]):
+		problems.append("plugging in two drives submitted %r" % first)
+	changed = [ (dev, generation) for (dev, paths, generation, at) in got if marks['changed'] <= at < marks['replugged'] ]
+	if changed:
+		problems.append("changing or removing a busy drive's links submitted %r" % changed)
+	replugged = [ (dev, paths, generation) for (dev, paths, generation, at) in got if at >= marks['replugged'] ]
+	if replugged != [ (dev1, links(1), 3) ]:
+		problems.append("plugging drive 1 in again submitted %r instead of a new generation of it" % replugged)
+	return problems
+
+def checkFat(workDir, toolsFiles, minSize, maxSize, seed):
+	"""Builds FAT32 filesystems with the fat32 module (an empty one, and ones holding a generated tree
+	and the fake live folder) and runs 'fsck.vfat -n' on each
+	@returns a list of problems (empty if fsck.vfat found nothing), or None if fsck.vfat isn't installed
+	"""
+	fsck = usb_updater.findCommand('fsck.vfat')
+	if fsck is None:
+		return None
+	tools = os.path.join(workDir, 'fat-tools')
+	live = os.path.join(workDir, 'fat-live')
+	makeTree(tools, toolsFiles, minSize, maxSize, seed)
+	makeLive(live, 5)
+	problems = []
+	for (name, sizeMB, source) in [ ('empty', 100, None), ('tools', 600, tools), ('live', 1536, live), ('big', 5000, tools) ]:
+		path = os.path.join(workDir, 'fat-' + name + '.img')
+		sectors = sizeMB * 1000000 / usb_updater.SECTOR_SIZE
+		f = open(path, 'wb')
+		f.truncate(sectors * usb_updater.SECTOR_SIZE)
+		f.close()
+		try:
+			fat32.buildFilesystem(path, sectors, name.upper(), source, hiddenSectors=usb_updater.PARTITION_ALIGN_SECTORS)
+		except (IOError, OSError, ValueError), e:
+			problems.append("%s: building the filesystem failed: %s" % (name, e))
+			continue
+		p = subprocess.Popen([ fsck, '-n', path ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output = p.communicate()[0]
+		if p.returncode != 0:
+			problems.append("%s: fsck.vfat exited with %d:\n%s" % (name, p.returncode, output.strip()))
+		os.remove(path)
+	return problems
+
+def setMode(mode, golden, buildFat):
+	"""Sets usb_updater up for one mode ('image' or 'tools')"""
+	usb_updater.IMAGE_DRIVES = mode == 'image'
+	usb_updater.SYNC_DRIVES = mode == 'tools'
+	usb_updater.GOLDEN_IMAGES = golden and mode == 'image'
+	usb_updater.FAT_BUILD = buildFat and mode == 'image' and not golden
+	if usb_updater.SYNC_DRIVES:
+		usb_updater.TOOLS_MANIFEST = usb_updater.buildManifest(usb_updater.TOOLS_SOURCE)
+
+def runMode(mode, devices, drives, workDir, golden, buildFat=False, engine='processes'):
+	"""Runs processDrive() on every drive at once in one mode and measures it
+	@param mode - 'image' or 'tools'
+	@param engine - 'processes' (a worker process per drive) or 'threads' (see runDriveThreads())
+	@returns a result dict
+	"""
+	traceDir = os.path.join(workDir, 'trace-%s-%s' % (mode, engine))
+	os.makedirs(traceDir)
+	usb_updater.TRACE_DIR = traceDir
+	setMode(mode, golden, buildFat)
+
+	before = [ drive.bytesWritten() for drive in drives ]
+	start = time()
+	error = None
+	if usb_updater.GOLDEN_IMAGES:
+		try:
+			usb_updater.buildGoldenImages(devices)
+		except (IOError, OSError), e:
+			error = "golden image build failed: " + str(e)
+		except SystemExit:
+			# usb_updater exits on a failed command; keep going and let the drives record their own failures
+			error = "golden image build failed (see the failed commands in the trace)"
+	usb_updater.THREAD_ENGINE = engine == 'threads'
+	if usb_updater.THREAD_ENGINE:
+		usb_updater.RESULT_QUEUE = Queue()
+		results = usb_updater.runResults()
+		usb_updater.runDriveThreads(devices, results)
+		usb_updater.RESULT_QUEUE = None
+		workerFailures = len(results.failed())
+	else:
+		processes = []
+		for dev in devices:
+			p = Process(target=usb_updater.processDrive, args=(devices[dev],))
+			p.start()
+			processes.append(p)
+		for p in processes:
+			p.join()
+		workerFailures = len([ p for p in processes if p.exitcode != 0 ])
+	wallTime = time() - start
+
+	records = usb_updater.loadTrace(traceDir)
+	commands = [ record for record in records if record['argv'] ]
+	phases = {}
+	for record in records:
+		if not record['argv']:
+			phases[record['action']] = phases.get(record['action'], 0.0) + record['duration']
+	usb_updater.exportTrace(traceDir)
+	return { 'mode' : mode,
+			 'engine' : engine,
+			 'golden' : usb_updater.GOLDEN_IMAGES,
+			 'buildFat' : usb_updater.FAT_BUILD,
+			 'wallTime' : wallTime,
+			 'drivesPerHour' : len(devices) * 3600 / max(wallTime, 0.001),
+			 'phaseTime' : phases,
+			 'commands' : len(commands),
+			 'commandTime' : sum([ record['duration'] for record in commands ]),
+			 'failedCommands' : len([ record for record in commands if record['exit'] != 0 ]),
+			 'workerFailures' : workerFailures,
+			 'error' : error,
+			 'bytesWritten' : sum([ drive.bytesWritten() - b for (drive, b) in zip(drives, before) ]) }
+
+def commandSequences(traceDir):
+	"""Returns the commands each drive ran, in order, from a run's trace: { drive : [argument lists] }"""
+	sequences = {}
+	for record in usb_updater.loadTrace(traceDir):
+		if record['argv']:
+			sequences.setdefault(record['drive'], []).append(record['argv'])
+	return sequences
+
+def compareEngines(mode, devices, drives, workDir, golden, buildFat):
+	"""Runs one mode under both engines with a recordingRunner standing in for the real commands and
+	compares the commands each drive asked for
+	@returns a list of differences (empty if the engines agree)
+	"""
+	runner = usb_updater.recordingRunner()
+	usb_updater.COMMAND_RUNNER = runner
+	sequences = {}
+	for engine in [ 'processes', 'threads' ]:
+		for drive in drives:
+			drive.reset()
+		runMode(mode, devices, drives, workDir, golden, buildFat, engine)
+		sequences[engine] = commandSequences(usb_updater.TRACE_DIR)
+	usb_updater.COMMAND_RUNNER = None
+	differences = []
+	for drive in sorted(set(sequences['processes'].keys() + sequences['threads'].keys())):
+		(a, b) = (sequences['processes'].get(drive, []), sequences['threads'].get(drive, []))
+		if a != b:
+			at = min([ i for i in range(min(len(a), len(b))) if a[i] != b[i] ] or [ min(len(a), len(b)) ])
+			differences.append("%s: %d vs %d command(s), first difference at command %d: %s vs %s" % (drive,
+				len(a), len(b), at, at < len(a) and ' '.join(a[at]) or '-', at < len(b) and ' '.join(b[at]) or '-'))
+	return differences
+
+class crashWatch(usb_updater.driveWatch):
+	"""A driveWatch that kills its worker (and the command it is running) partway through one stage:
+	'delay' seconds into it, or as the stage ends if it finishes sooner. The last stage is only killed
+	while it runs, since a drive that finished it is done."""
+	def __init__(self, stage, delay, last):
+		"""
+		@param stage - index of the stage to crash in
+		@param delay - seconds into the stage to crash
+		@param last - True if it is the drive's last stage
+		"""
+		usb_updater.driveWatch.__init__(self)
+		self.crashStage = stage
+		self.delay = delay
+		self.last = last
+		self.timer = None
+
+	def enter(self, i, dev):
+		usb_updater.driveWatch.enter(self, i, dev)
+		if i == self.crashStage:
+			self.timer = threading.Timer(self.delay, self.crash)
+			self.timer.start()
+
+	def leave(self):
+		usb_updater.driveWatch.leave(self)
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+			if not self.last:
+				self.crash()
+
+	def crash(self):
+		pgid = self.command.value
+		if pgid:
+			try:
+				os.killpg(pgid, signal.SIGKILL)
+			except OSError:
+				pass
+		os.kill(os.getpid(), signal.SIGKILL)
+
+def runWorkers(devices, watches):
+	"""Runs processDrive() in a worker process per drive and waits for them all
+	@param watches - dictionary of "device : driveWatch" (or None) to hand each worker
+	@returns (runResults of the drives that sent one, dictionary of "device : worker exit code")
+	"""
+	usb_updater.RESULT_QUEUE = Queue()
+	results = usb_updater.runResults()
+	processes = {}
+	for dev in devices:
+		processes[dev] = Process(target=usb_updater.processDrive, args=(devices[dev], watches.get(dev)))
+		processes[dev].start()
+	for dev in processes:
+		while processes[dev].is_alive():
+			results.drain(usb_updater.RESULT_QUEUE, 0.2)
+		processes[dev].join()
+	results.drain(usb_updater.RESULT_QUEUE)
+	usb_updater.RESULT_QUEUE = None
+	return (results, dict([ (dev, processes[dev].exitcode) for dev in processes ]))
+
+def crashTest(mode, devices, drives, workDir, golden, buildFat):
+	"""For each stage in turn: kills every drive's worker partway through it, checks what the drives'
+	journals record, then runs the drives again and checks that each one runs exactly the stages from
+	its resume point on and comes out finished. The delay before the kill is half of the stage's time
+	in a clean run of the mode first, which every drive has to pass.
+	@returns (a list of problems (empty if every drive resumed correctly), a list of the cases run)
+	"""
+	usb_updater.TRACE_DIR = None
+	usb_updater.SOURCE_VERSION = None
+	setMode(mode, golden, buildFat)
+	if usb_updater.GOLDEN_IMAGES:
+		usb_updater.buildGoldenImages(devices)
+	stages = usb_updater.driveStages()
+	names = [ stage for (stage, method) in stages ]
+	for drive in drives:
+		drive.reset()
+	(reference, exitcodes) = runWorkers(devices, {})
+	failed = [ dev for dev in sorted(devices) if not reference.succeeded(dev) ]
+	if failed:
+		return ([ "%s failed without a crash; nothing to check the resume against" % dev for dev in failed ], [])
+
+	journalDir = os.path.join(workDir, 'journal')
+	usb_updater.JOURNAL_DIR = journalDir
+	problems, cases = [], []
+	try:
+		for (k, stage) in enumerate(names):
+			delay = sum([ reference.results[dev]['stages'].get(stage, 0.0) for dev in devices ]) / len(devices) / 2
+			for drive in drives:
+				drive.reset()
+			shutil.rmtree(journalDir, ignore_errors=True)
+			watches = dict([ (dev, crashWatch(k, delay, k == len(names) - 1)) for dev in devices ])
+			(results, exitcodes) = runWorkers(devices, watches)
+
+			resumes = {}
+			for dev in sorted(devices):
+				journal = usb_updater.driveJournal(devices[dev][0].getDisk())
+				resume = journal.resumePoint(stages)
+				completed = [ entry['stage'] for entry in journal.completed ]
+				case = { 'drive' : dev, 'crashStage' : stage, 'delay' : delay, 'exitcode' : exitcodes[dev],
+						 'resumeStage' : resume < len(names) and names[resume] or None }
+				cases.append(case)
+				if k == len(names) - 1 and (exitcodes[dev] == 0 or not os.path.exists(journal.path)):
+					# the last stage finished (and closed the journal) before the kill: the drive is done
+					case['resumeStage'] = 'not crashed'
+					continue
+				if exitcodes[dev] != -signal.SIGKILL:
+					problems.append("%s: the worker exited with code %s before it was killed in %s" % (dev, exitcodes[dev], stage))
+					continue
+				if resume not in (k, k + 1):
+					problems.append("%s killed in %s: resumes at %s" % (dev, stage, case['resumeStage']))
+				if completed != names[:resume]:
+					problems.append("%s killed in %s: the journal records %s" % (dev, stage, ', '.join(completed) or 'nothing'))
+				resumes[dev] = resume
+
+			ran = Queue()
+			saved = {}
+			for (name, method) in stages:
+				saved[method] = usb_updater.media.__dict__[method]
+				def record(self, otherParts, name=name, original=saved[method]):
+					ran.put((self.getDev()[:-1], name))
+					return original(self, otherParts)
+				setattr(usb_updater.media, method, record)
+			try:
+				(results, exitcodes) = runWorkers(dict([ (dev, devices[dev]) for dev in resumes ]), {})
+			finally:
+				for method in saved:
+					setattr(usb_updater.media, method, saved[method])
+			rerun = {}
+			while not ran.empty():
+				(dev, name) = ran.get()
+				rerun.setdefault(dev, []).append(name)
+
+			for dev in sorted(resumes):
+				disk = devices[dev][0].getDisk()
+				if rerun.get(dev, []) != names[resumes[dev]:]:
+					problems.append("%s killed in %s: the next run ran %s instead of %s" % (dev, stage,
+						', '.join(rerun.get(dev, [])) or 'nothing', ', '.join(names[resumes[dev]:]) or 'nothing'))
+				if not results.succeeded(dev):
+					problems.append("%s killed in %s: the next run failed the drive" % (dev, stage))
+				elif os.path.exists(usb_updater.driveJournal(disk).path):
+					problems.append("%s killed in %s: the next run left the journal open" % (dev, stage))
+				elif usb_updater.IMAGE_DRIVES and not usb_updater.diskStampCurrent(disk):
+					problems.append("%s killed in %s: the next run didn't stamp the drive" % (dev, stage))
+	finally:
+		usb_updater.JOURNAL_DIR = None
+	return (problems, cases)
+
+if __name__=="__main__":
+	parser = OptionParser(
+		usage = "usage: %prog [options]",
+		description = "USB Updater benchmark.")
+	parser.add_option("-n", "--drives", dest = "drives", type = "int", default = 4,
+				help = "Number of fake drives.")
+	parser.add_option("-s", "--drive-size", dest = "driveSize", type = "int", default = 4000,
+				help = "Size of each fake drive in MB.")
+	parser.add_option("-f", "--tools-files", dest = "toolsFiles", type = "int", default = 2000,
+				help = "Number of files in the tools tree.")
+	parser.add_option("--min-size", dest = "minSize", type = "int", default = 1024,
+				help = "Smallest tools file in bytes.")
+	parser.add_option("--max-size", dest = "maxSize", type = "int", default = 256 * 1024,
+				help = "Largest tools file in bytes.")
+	parser.add_option("-l", "--live-size", dest = "liveSize", type = "int", default = 200,
+				help = "Size of the live image in MB.")
+	parser.add_option("-m", "--modes", dest = "modes", default = "image,tools",
+				help = "Comma separated modes to run, in order: image, tools.")
+	parser.add_option("-g", "--golden", action = "store_true", dest = "golden", default = False,
+				help = "Image by cloning golden images.")
+	parser.add_option("-b", "--build-fat", action = "store_true", dest = "buildFat", default = False,
+				help = "Image by building the filesystems directly (fat32.py).")
+	parser.add_option("-e", "--engine", dest = "engine", default = "processes",
+				help = "Run the drives as 'processes' (one per drive) or 'threads' of one process.")
+	parser.add_option("--compare-engines", action = "store_true", dest = "compareEngines", default = False,
+				help = "Check that both engines run the same commands (with a recording fake command runner) instead of timing.")
+	parser.add_option("--crash-test", action = "store_true", dest = "crashTest", default = False,
+				help = "Kill the drives' workers partway through each stage and check that the next run resumes them correctly.")
+	parser.add_option("--check-fat", action = "store_true", dest = "checkFat", default = False,
+				help = "Check the FAT32 filesystems the fat32 module builds with fsck.vfat instead of timing.")
+	parser.add_option("--check-hotplug", action = "store_true", dest = "checkHotplug", default = False,
+				help = "Check the hotplug daemon against a scratch device directory instead of timing.")
+	parser.add_option("--check-devices", action = "store_true", dest = "checkDevices", default = False,
+				help = "Check the device model against a fake sysfs tree instead of timing.")
+	parser.add_option("--files", action = "store_true", dest = "files", default = False,
+				help = "Use plain files even when running as root.")
+	parser.add_option("--seed", dest = "seed", type = "int", default = 1,
+				help = "Random seed for the generated trees.")
+	parser.add_option("-w", "--work-dir", dest = "workDir", default = "/tmp/usb_benchmark",
+				help = "Scratch directory (emptied first).")
+	parser.add_option("-o", "--output", dest = "output", default = "benchmark.json",
+				help = "Where to write the results.")
+	parser.add_option("-d", "--debug", dest = "debug", type = "int", default = 0,
+				help = "usb_updater debug level.")
+	(options, args) = parser.parse_args()
+
+	workDir = os.path.abspath(options.workDir)
+	if os.path.exists(workDir):
+		shutil.rmtree(workDir)
+	os.makedirs(os.path.join(workDir, 'disks'))
+	os.makedirs(os.path.join(workDir, 'dev'))
+	os.makedirs(os.path.join(workDir, 'mnt'))
+
+	if options.checkDevices:
+		problems = checkDevices(workDir)
+		for line in problems or [ "the device model matches the fake sysfs tree" ]:
+			print line
+		sys.exit(problems and 1 or 0)
+
+	if options.checkFat:
+		problems = checkFat(workDir, options.toolsFiles, options.minSize, options.maxSize, options.seed)
+		if problems is None:
+			print "fsck.vfat isn't installed; nothing checked"
+			sys.exit(1)
+		for line in problems or [ "fsck.vfat found nothing wrong with the built filesystems" ]:
+			print line
+		sys.exit(problems and 1 or 0)
+
+	if options.checkHotplug:
+		problems = checkHotplug(workDir)
+		for line in problems or [ "the hotplug daemon submitted each drive once, and a new generation when plugged in again" ]:
+			print line
+		sys.exit(problems and 1 or 0)
+
+	useLoop = os.getuid() == 0 and not options.files
+	print "Creating %d %dMB fake drive(s) (%s), a %d file tools tree and a %dMB live folder..." % (options.drives,
+		options.driveSize, useLoop and "loop devices" or "plain files", options.toolsFiles, options.liveSize)
+	toolsBytes = makeTree(os.path.join(workDir, 'tools'), options.toolsFiles, options.minSize, options.maxSize, options.seed)
+	liveBytes = makeLive(os.path.join(workDir, 'live'), options.liveSize)
+
+	usb_updater.DEBUG_LEVEL = options.debug
+	usb_updater.MEDIA_DEV_ROOT = os.path.join(workDir, 'dev')
+	usb_updater.MEDIA_MOUNT_POINT_ROOT = os.path.join(workDir, 'mnt')
+	usb_updater.LIVE_SOURCE = os.path.join(workDir, 'live') + '/'
+	usb_updater.TOOLS_SOURCE = os.path.join(workDir, 'tools') + '/'
+	usb_updater.TOOLS_MANIFEST_CACHE = os.path.join(workDir, 'tools.manifest')
+	usb_updater.GOLDEN_IMAGE_DIR = os.path.join(workDir, 'golden')
+	# every run starts from scratch: no resuming from journals, no skipping drives that are already current
+	usb_updater.JOURNAL_DIR = None
+	usb_updater.force = True
+
+	drives = []
+	try:
+		for i in range(options.drives):
+			drive = fakeDrive(workDir, i, options.driveSize, useLoop)
+			drives.append(drive)
+			for (num, node) in zip([1, 2], drive.partitions):
+				os.symlink(node, os.path.join(usb_updater.MEDIA_DEV_ROOT, 'usb%dpart%d' % (i + 1, num)))
+
+		usb_updater.enumerateDrives()
+		devices = {}
+		for current in usb_updater.drives:
+			devices.setdefault(current.getDev()[:-1], []).append(current)
+
+		results = { 'started' : ctime(),
+					'config' : { 'drives' : options.drives, 'driveSizeMB' : options.driveSize, 'loop' : useLoop,
+								 'toolsFiles' : options.toolsFiles, 'toolsBytes' : toolsBytes,
+								 'minSize' : options.minSize, 'maxSize' : options.maxSize,
+								 'liveSizeMB' : options.liveSize, 'liveBytes' : liveBytes, 'seed' : options.seed },
+					'runs' : [] }
+		for mode in options.modes.split(','):
+			if options.compareEngines:
+				print "Comparing the engines in mode '%s'..." % mode
+				differences = compareEngines(mode.strip(), devices, drives, workDir, options.golden, options.buildFat)
+				results['runs'].append({ 'mode' : mode.strip(), 'engineDifferences' : differences })
+				for line in differences or [ "same commands under both engines" ]:
+					print "  " + line
+				continue
+			if options.crashTest:
+				print "Crash testing mode '%s'..." % mode
+				(problems, cases) = crashTest(mode.strip(), devices, drives, workDir, options.golden, options.buildFat)
+				results['runs'].append({ 'mode' : mode.strip(), 'crashProblems' : problems, 'crashCases' : cases })
+				for case in cases:
+					print "  %s killed %.1fs into %s: resumed at %s" % (case['drive'], case['delay'], case['crashStage'],
+						case['resumeStage'] or 'the end')
+				for line in problems or [ "every drive resumed at the right stage and finished" ]:
+					print "  " + line
+				continue
+			print "Running mode '%s'..." % mode
+			result = runMode(mode.strip(), devices, drives, workDir, options.golden, options.buildFat, options.engine)
+			results['runs'].append(result)
+			print "  %.1fs wall, %.1f drives/hour, %d command(s) (%d failed), %.1f MB written" % (result['wallTime'],
+				result['drivesPerHour'], result['commands'], result['failedCommands'], result['bytesWritten'] / 1000000.0)
+			for phase in sorted(result['phaseTime']):
+				print "  %-12s %.1fs (summed over drives)" % (phase, result['phaseTime'][phase])
+	finally:
+		for drive in drives:
+			drive.detach()
+
+	output = open(options.output, 'w')
+	json.dump(results, output, indent=2, sort_keys=True)
+	output.close()
+	print "Results written to " + options.output
@@ -12,12 +12,31 @@ import os
 import sys
 import csv
 import subprocess
-from multiprocessing import Process, Pool, Lock
+from multiprocessing import Process, Pool, Lock, Condition, Array, Value, Semaphore, Queue
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
 import string
+import threading
+from collections import deque
 from optparse import OptionParser
 import re
+import select
+import signal
+import socket
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import shutil
+import stat
+import struct
 from time import ctime, sleep, time
 
+import fat32
+
 DEBUG_LEVEL = 0
 # location that the USB drives (aka /dev/sdX#)
 MEDIA_DEV_ROOT = ''
@@ -40,8 +59,168 @@ email = False
 emailFile = 'mainEmail.log'
 # Email recipients, as a list
 recipients = ['me@email.com']
-# List of drives that failed/errored
+# Where the drive logs for the email report are kept
+LOG_DIR = '/scripts/logs'
+# Queue every process sends its log records to, and the process writing them out (see logAggregator)
+LOG_QUEUE = None
+LOG_PROCESS = None
+LOG_OWNER = None
+# The aggregator writes a drive's lines out in batches of this many, or after this many seconds
+LOG_BATCH_LINES = 200
+LOG_FLUSH_INTERVAL = 2
+# List of drives that failed/errored (in this process; the main process learns of failures from RESULT_QUEUE)
 failed_drives = []
+# Queue the drive workers send their results to (see driveResult())
+RESULT_QUEUE = None
+# Kernel mount table for this process (see getMountTable())
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+MOUNT_TABLE = None
+# How long (seconds) to wait for an unmount / partition rescan to settle before giving up
+SETTLE_TIMEOUT = 30
+# The fixed sleep each settle wait replaces, used to report how much waiting was saved
+SETTLE_FIXED_SLEEP = 10
+# Files that exist while udev still has events queued (systemd udev, older udev)
+UDEV_QUEUE_PATHS = [ '/run/udev/queue', '/dev/.udev/queue' ]
+# Per-phase wait counters for this process: phase -> {'waits', 'waited', 'timeouts', 'replaced'}
+WAIT_STATS = {}
+# Directory to record every external command in (one file per process), or None to not record
+TRACE_DIR = None
+# This process' open trace file, and the lock the drive threads share it under
+TRACE_FILE = None
+TRACE_LOCK = threading.Lock()
+# Directory to publish live progress in (progress.jsonl and Prometheus *.prom textfiles), or None
+PROGRESS_DIR = None
+# Seconds between progress updates for each drive
+PROGRESS_INTERVAL = 1.0
+# Total bytes under each copy source, worked out once per process (see sourceSize())
+SOURCE_SIZES = {}
+# Where the live image and tools are copied from
+LIVE_SOURCE = '/live_directory/'
+TOOLS_SOURCE = '/local_tools/'
+# Where -t fetches the latest tools from, and the remote shell rsync reaches the server with
+TOOLS_SERVER = 'user@server:/tools_directory/'
+TOOLS_SERVER_RSH = 'ssh -i /scripts/tools_server_key'
+# Local cache of immutable snapshots of the live and tools folders (see snapshotCache); a run copies from
+# the snapshots it pinned at startup. None copies straight from LIVE_SOURCE and TOOLS_SOURCE.
+SNAPSHOT_DIR = '/scripts/snapshots'
+# How many older snapshots of each folder are kept besides the current one
+SNAPSHOT_KEEP = 2
+# The snapshot ID this run is pinned to, by folder ('live', 'tools')
+PINNED_SNAPSHOTS = {}
+# Size of the LIVE partition (MB) for each drive size class; drives under 7000MB are '4gb' drives
+LIVE_PARTITION_SIZE_MB = { '4gb' : 1536, '8gb' : 2436 }
+# Flag for whether we will image the drives by cloning a prebuilt golden image
+GOLDEN_IMAGES = False
+# Where the golden images are built
+GOLDEN_IMAGE_DIR = '/scripts/golden'
+# Size (MB) of the golden image prebuilt for each size class in daemon mode, where the drives aren't known
+# in advance: the smallest stick of the class it fits. Otherwise each class' image is built at the size of
+# its smallest drive (see buildGoldenImages()); a drive smaller than its class' image fails on its own.
+GOLDEN_IMAGE_SIZE_MB = { '4gb' : 3500, '8gb' : 7000 }
+# Golden image path for each size class that has been built (set before the workers start)
+GOLDEN_IMAGE_PATHS = {}
+# Size of each sequential write when streaming an image to a drive
+IMAGE_WRITE_CHUNK = 4 * 1024 * 1024
+# Only the allocated extents of a golden image are written: each is rounded out to EXTENT_ALIGN bytes and
+# extents closer together than EXTENT_MERGE_GAP are merged into one write (cheaper than a seek on flash)
+EXTENT_ALIGN = 64 * 1024
+EXTENT_MERGE_GAP = 1024 * 1024
+# Discard (TRIM) the skipped free space of a cloned drive, if it supports it
+IMAGE_DISCARD = False
+# ioctl discarding a byte range of a block device (BLKDISCARD from <linux/fs.h>)
+BLKDISCARD = 0x1277
+SECTOR_SIZE = 512
+# A GPT is a header sector plus 32 sectors of entries, at both the start and the end of the drive
+GPT_SECTORS = 33
+# ioctl asking the kernel to re-read a drive's partition table (BLKRRPART from <linux/fs.h>)
+BLKRRPART = 0x125f
+# ioctls returning a block device's logical and physical block sizes (BLKSSZGET, BLKPBSZGET from <linux/fs.h>)
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127b
+# Flag for whether the live/tools copies are done once for all drives by the fan-out writer
+FANOUT_POPULATE = False
+# Build the TOOLS and LIVE filesystems, contents included, directly onto freshly partitioned drives (see fat32.py)
+FAT_BUILD = False
+# Fan-out ring: number of shared buffers and the size of each
+FANOUT_SLOTS = 64
+FANOUT_CHUNK = 1024 * 1024
+# Seconds the fan-out reader will wait on a slow drive before detaching it
+FANOUT_DETACH_TIMEOUT = 5
+# Name of the manifest (path, size, mtime, hash of every tools file) kept on each TOOLS partition
+TOOLS_MANIFEST_NAME = '.usb_updater_manifest'
+# Where the manifest of TOOLS_SOURCE is cached between runs, so unchanged files aren't hashed again
+TOOLS_MANIFEST_CACHE = '/scripts/tools.manifest'
+# Manifest of TOOLS_SOURCE for this run (computed once, before the workers start) and the file it is saved in
+TOOLS_MANIFEST = None
+TOOLS_MANIFEST_PATH = TOOLS_MANIFEST_CACHE
+# Manifest of LIVE_SOURCE (for verifying imaged drives) and where it is cached between runs
+LIVE_MANIFEST = None
+LIVE_MANIFEST_CACHE = '/scripts/live.manifest'
+# Read back and check everything written in the verify stage. Reads bypass the page cache (O_DIRECT),
+# VERIFY_BLOCK bytes at a time, hashed by VERIFY_THREADS threads per drive
+VERIFY_READBACK = True
+VERIFY_BLOCK = 1024 * 1024
+VERIFY_THREADS = 4
+# Offsets, lengths and buffers of O_DIRECT reads are aligned to this
+DIRECT_IO_ALIGN = 4096
+# The C library (see libc())
+LIBC = None
+# Where sysfs is mounted
+SYSFS_ROOT = '/sys'
+# Where the kernel's block device nodes are (a blockDevice's node is DEV_ROOT/<kernel name>)
+DEV_ROOT = '/dev'
+# Block devices already described from sysfs, by kernel name (see lookupBlockDevice); a device is
+# forgotten when its partition table is re-read or drives are plugged in or removed
+BLOCK_DEVICES = {}
+# How many drives may run a heavy I/O phase (copying, image writing) at once behind one USB link,
+# by the link speed in Mbps; links of other speeds get USB_DOMAIN_DEFAULT_LIMIT
+USB_DOMAIN_LIMITS = { 12 : 1, 480 : 2, 5000 : 4, 10000 : 6 }
+USB_DOMAIN_DEFAULT_LIMIT = 2
+# Bandwidth domain of each device (keyed like 'devices'), set by the scheduler before the workers start
+IO_DOMAINS = {}
+# Every bandwidth domain, keyed by "controller/root port"
+USB_DOMAINS = {}
+# Flag for whether the drives go through the stages as a pipeline rather than one process per drive
+PIPELINE = False
+# Number of worker processes for each pipeline stage
+STAGE_WORKERS = { 'wipe' : 4, 'partition' : 4, 'format' : 4, 'populate' : 8, 'bootloader' : 4, 'verify' : 4 }
+# Seconds a drive may spend in each stage before the watchdog kills the command it is running and
+# fails the drive (0 or missing: no deadline)
+PHASE_DEADLINES = { 'wipe' : 600, 'partition' : 300, 'format' : 600, 'populate' : 5400, 'bootloader' : 300, 'verify' : 1800 }
+# Seconds to wait after killing a drive's command before killing its whole worker (one process per drive mode)
+WATCHDOG_GRACE = 30
+# State of the worker (process or thread) running in this thread: the watch of the drive it is on
+# (see driveWatch) and what it is doing, for the command records (e.g. the drive stage)
+WORKER = threading.local()
+# Runs the drives' external commands (see processRunner); tests swap in a recordingRunner
+COMMAND_RUNNER = None
+# A command's output is consumed line by line (see commandOutput): only this much of its standard output
+# is kept for the caller, and this many of its last lines for the failure report
+OUTPUT_KEEP_BYTES = 64 * 1024
+OUTPUT_TAIL_LINES = 40
+# Whether every drive runs in a thread of this process rather than a worker process of its own
+THREAD_ENGINE = False
+# Daemon mode: seconds a new drive's partition links must stay unchanged before we start on it,
+# and how often to rescan the device directory when no change notification arrives
+HOTPLUG_SETTLE = 2
+HOTPLUG_RESCAN_INTERVAL = 5
+# A drive that was imaged successfully gets a stamp of the image version in the sector after the primary
+# GPT area (unused on an MBR drive, and cleared whenever the drive is partitioned or cloned), so later runs
+# can tell it is already current from two sector reads
+DISK_STAMP_SECTOR = 1 + GPT_SECTORS
+DISK_STAMP_MAGIC = 'USB_Updater stamp'
+# The MBR disk signature (the 4 bytes at this offset) stays random, different on every drive
+DISK_SIGNATURE_OFFSET = 440
+# Hash of the live folder and partition layout an imaged drive is made from (see imageVersion())
+IMAGE_VERSION = None
+# Stages that only do imaging work, skipped on drives that already carry the current image
+IMAGE_ONLY_STAGES = [ 'wipe', 'partition', 'format', 'bootloader' ]
+# Where each drive's stage journal is kept, so an interrupted run resumes where it stopped ('' turns it off)
+JOURNAL_DIR = '/scripts/journal'
+# Hash of what the stages' results depend on (see sourceVersion()); worked out once, before the workers start
+SOURCE_VERSION = None
+# First partition starts 1MiB into the drive
+PARTITION_ALIGN_SECTORS = 2048
 
 
 def debug(text, level):
@@ -61,8 +240,15 @@ def emailBuilder(text):
 	"""Appends 'text' to the email body
 	@param text - the text to append
 	"""
-	emailBody.write("\n" + text)
-	emailBody.flush()
+	logRecord(None, text)
+
+def logRecord(name, text):
+	"""Sends a log line to the aggregator (see logAggregator)
+	@param name - the partition the line is about (None for the main log)
+	@param text - the line to log
+	"""
+	if LOG_QUEUE is not None:
+		LOG_QUEUE.put(('log', name, text))
 	
 def errorHandler(ErrorType, error, job, stderr="", quit=False):
 	"""Handles possible exceptions/errors and reports them
@@ -82,36 +268,132 @@ def errorHandler(ErrorType, error, job, stderr="", quit=False):
 		debug("Exiting...", 0)
 		exit()
 	
-def sendEmail(body):
-	"""Compiles and sends the email with the individual logs concatenated in a logical format
-	@param body - the email body that had been built by 'emailBuilder()'
-	"""
-	if len(failed_drives) > 0: # Check for failed drives and note them if necessary
-		body.write("\nPartitions that errored:\n")
-		body.write("\n".join(failed_drives))
-	body.write("\n-----------------------\nDrive-specific debugging\n")
-	sb = [] # Begin putting all the drive logs together
-	for cur in drives:
-		sb.append('\n---------Log for:'+cur.getName()+'-----------\n')
-		sb.append(cur.readEmail())
-		sb.append('\n---------END OF LOG:'+cur.getName()+'-----------\n')
-		os.system('rm -f ' + cur.getDebuggerFile())
-	body.write(''.join(sb))
-	body.write("\n\nSent email: " + ctime())
-	# close the file after final write
-	body.close()
-	# reopen the file for read-only
-	body = open(emailFile, "r")
-	# read each line into variable bodyText
-	bodyText = ""
-	for line in body.readlines():
-		bodyText += line
-	# close the file after reading
-	body.close()
+class logAggregator:
+	"""Collects the log records of every process from one queue and writes them out in batches. Each
+	partition's lines are appended to a single spool file in chunks, with an index of where its chunks
+	are, so the report can be put together in one streaming pass without holding the logs in memory.
+	"""
+	def __init__(self, logDir, reportPath):
+		"""
+		@param logDir - where to keep the spool file and its index
+		@param reportPath - where to write the email report
+		"""
+		self.reportPath = reportPath
+		self.spoolPath = os.path.join(logDir, 'drives.log')
+		self.indexPath = os.path.join(logDir, 'drives.index')
+		self.spool = open(self.spoolPath, 'w+b')
+		self.pending = {}		# partition name (None for the main log) : lines not written out yet
+		self.index = {}			# partition name : [ (offset, length) of each of its chunks in the spool ]
+		self.lastFlush = time()
+
+	def add(self, name, text):
+		"""Takes one line (see logRecord())"""
+		lines = self.pending.setdefault(name, [])
+		lines.append("\n" + text)
+		if len(lines) >= LOG_BATCH_LINES:
+			self.flush(name)
+
+	def flush(self, name):
+		"""Appends a partition's pending lines to the spool as one chunk"""
+		chunk = ''.join(self.pending.pop(name, []))
+		if not chunk:
+			return
+		self.spool.seek(0, os.SEEK_END)
+		self.index.setdefault(name, []).append((self.spool.tell(), len(chunk)))
+		self.spool.write(chunk)
+
+	def flushAll(self):
+		"""Writes out every partition's pending lines"""
+		for name in self.pending.keys():
+			self.flush(name)
+		self.spool.flush()
+		self.lastFlush = time()
+
+	def copyLog(self, name, report):
+		"""Copies a partition's chunks from the spool to the report"""
+		for (offset, length) in self.index.get(name, []):
+			self.spool.seek(offset)
+			report.write(self.spool.read(length))
+
+	def writeReport(self, started, summary):
+		"""Writes the email report: the main log, the drive results and each partition's log
+		@param started - when the run started (text)
+		@param summary - lines describing the drive results (see runResults.summary())
+		"""
+		self.flushAll()
+		f = open(self.indexPath, 'w')
+		json.dump([ [ name, chunks ] for (name, chunks) in self.index.items() ], f)
+		f.close()
+		report = open(self.reportPath, 'w')
+		report.write("Started: " + started + "\n\n")
+		self.copyLog(None, report)
+		if summary:
+			report.write("\n-----------------------\nDrive results\n")
+			report.write("\n".join(summary))
+		report.write("\n-----------------------\nDrive-specific debugging\n")
+		for name in sorted([ name for name in self.index if name is not None ], key=naturalKey):
+			report.write('\n---------Log for:' + name + '-----------\n')
+			self.copyLog(name, report)
+			report.write('\n---------END OF LOG:' + name + '-----------\n')
+		report.write("\n\nSent email: " + ctime())
+		report.close()
+		self.spool.close()
+
+	def run(self, queue):
+		"""Takes records until told to stop, then writes the report
+		@param queue - the queue the records arrive on; a ('close', None, summary) record ends the run
+		"""
+		started = ctime()
+		# the workers get our signals too; leave it to the main process to tell us when to stop
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		while True:
+			try:
+				(kind, name, text) = queue.get(True, LOG_FLUSH_INTERVAL)
+			except Empty:
+				self.flushAll()
+				continue
+			if kind == 'close':
+				break
+			self.add(name, text)
+			if time() - self.lastFlush >= LOG_FLUSH_INTERVAL:
+				self.flushAll()
+		self.writeReport(started, text)
+
+def naturalKey(name):
+	"""Sort key that puts usb2part1 before usb10part1"""
+	return [ part.isdigit() and int(part) or part for part in re.split(r'(\d+)', name) ]
+
+def startLogging():
+	"""Starts the log aggregator process; must happen before any worker process starts"""
+	global LOG_QUEUE, LOG_PROCESS, LOG_OWNER
+	if not os.path.isdir(LOG_DIR):
+		os.makedirs(LOG_DIR)
+	LOG_QUEUE = Queue()
+	LOG_OWNER = os.getpid()
+	LOG_PROCESS = Process(target=logAggregator(LOG_DIR, emailFile).run, args=(LOG_QUEUE,))
+	LOG_PROCESS.daemon = True
+	LOG_PROCESS.start()
+
+def finishLogging(summary=None):
+	"""Tells the log aggregator to write the report and waits for it
+	@param summary - (optional) lines describing the drive results, for the top of the report
+	"""
+	LOG_QUEUE.put(('close', None, summary))
+	LOG_PROCESS.join()
+
+def sendEmail(results=None):
+	"""Has the log aggregator compile the report (the main log, the drive results, then each partition's
+	log) and mails it
+	@param results - the runResults of the run (None if it was cut short)
+	"""
+	if LOG_PROCESS is None or LOG_OWNER != os.getpid() or threading.current_thread().name != 'MainThread':
+		# only the main process can finish the logs; a worker giving up leaves that to it
+		return
+	finishLogging(results and results.summary())
 
 	subjectLine = "USB Status Report"
-	# If there is an error in the log, dump some information so that we can look at them later
-	if bodyText.lower().__contains__('error:'):
+	# If a drive failed (or the run was cut short), dump some information so that we can look at it later
+	if results is None or results.failed():
 		subjectLine = "USB Status Report - ERROR"
 		os.system("/bin/dmesg > /scripts/dmesg-" + str(time()) + ".log")
 		os.system("/bin/mount > /scripts/mount-" + str(time()) + ".log")
@@ -125,13 +407,16 @@ def sendEmail(body):
 					" ".join(recipients)		#and send it to 'recipients' joined with a space
 					]
 	# Does NOT use runCommand() because the body of the email must be passed to subprocess as input
+	stderr = ""
 	try:
-		p = subprocess.Popen(emailCommand, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-		# pass the contents of 'bodyText' to mailx as the body of the email
-		(stdout, stderr) = p.communicate(bodyText)
+		body = open(emailFile, "r")
+		# mailx reads the report straight from the file
+		p = subprocess.Popen(emailCommand, stdin = body, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+		(stdout, stderr) = p.communicate()
+		body.close()
 		if stderr:
 			raise ValueError, emailCommand
-	except OSError, e:
+	except (IOError, OSError), e:
 		errorHandler("OSError", e, "send the status email", stderr)
 	except ValueError, e:
 		errorHandler("ValueError", "send the status email", stderr)
@@ -139,32 +424,39 @@ def sendEmail(body):
 def syncUSBFolder():
 	"""Copies the tools from the resources server to this local machine using rsync
 	This will then be used to copy to each drive. Useful for updating the tools folder.
+	With SNAPSHOT_DIR, the tools land in a staging folder that only becomes visible to drives once
+	it is published as a snapshot (see pinSnapshot()).
+	@returns the local folder the tools were copied to
 	"""
 	debug("I'm starting to copy the lastest tools from the server to the local machine for faster copying to the drives.", 1)
+	destination = TOOLS_SOURCE
+	if SNAPSHOT_DIR:
+		destination = snapshotCache(SNAPSHOT_DIR).stagingDir('tools')
 	#We'll start with constructing the command to sync the files to the media.
-	command = [ '/usr/bin/rsync', '-rtqvv8D', \
-			'--delete', \				# deletes extra files/folders at the destination that don't exist at the source
+	command = [ '/usr/bin/rsync', '-rtqvv8D',
+			'--delete',				# deletes extra files/folders at the destination that don't exist at the source
 										# if we remove something from tools, we won't continue to put it on the usb drives
-			'-e', \
-			rshArg, \
-			'user@server:/tools_directory/',\
-			'/local_tools/']
+			'-e', TOOLS_SERVER_RSH,
+			TOOLS_SERVER,
+			destination]
 	action = "sync the server USB folder to a local location"
 	
 	#This actually executes the command.
 	std_out, std_err = runCommand(command, action)
+	return destination
 
-def runCommand( command, actionMsg, expectedErr = "", exitOnFail=False, debugLvl=1 ):
+def runCommand( command, actionMsg, expectedErr = "", exitOnFail=False, debugLvl=1, okStatus=(0,) ):
 	"""Helper method to run a (bash) command/script and handle exceptions and 'expected' output in the
 	standard error stream. This also displays helpful information about what action is being performed, etc.
 	@param command - the bash command/script to be executed
 						to avoid bugs, have the command split by arguments before using this method (not necessarily split on whitespace!)
 	@param actionMsg - human readable message that describes what this command is doing
-	@param expectedErr - (optional) expected error stream output that shouldn't trigger a failure
+	@param expectedErr - (optional) pattern of expected error stream lines that shouldn't trigger a failure
 	@param exitOnFail - (optional) flag to specify whether this is a critical process or not
 	@param debugLvl - (optional) value to specify the priority of the debug messages for this command
+	@param okStatus - (optional) exit statuses that mean success (see commandOutput)
 	
-	@returns (stdout, stderr) - returns the strings that contain the standard output and error stream contents 
+	@returns (stdout, stderr) - the standard output (up to OUTPUT_KEEP_BYTES) and the last lines of the error stream
 	"""
 	#make sure command is a list split on spaces (THIS SHOULD BE SPLIT ON ARGUMENTS)
 	if type(command).__name__ == 'str':
@@ -173,23 +465,681 @@ def runCommand( command, actionMsg, expectedErr = "", exitOnFail=False, debugLvl
 	debug("Starting: " + actionMsg, debugLvl)
 	debug("Using: " + ' '.join(command), debugLvl)
 
-	command_stdout, command_stderr = "", ""
+	output = commandOutput(expectedErr, okStatus=okStatus)
+	started, returncode = time(), None
 	
 	try:
-		p =	subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		(command_stdout, command_stderr) = p.communicate()
-		if command_stderr:
-			if expectedErr != "" and not command_stderr.endswith(expectedErr):
-				raise ValueError, command
-			elif expectedErr == "":
-				raise ValueError, command
+		returncode = commandRunner().run(command, output)
+		if not output.ok(returncode):
+			raise ValueError, command
 	except OSError, e:
-		errorhandler("OSError", e, actionMsg, command_stderr, exitOnFail)
+		recordCommand('main', command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
+		errorHandler("OSError", e, actionMsg, output.report(), exitOnFail)
 	except ValueError, e:
-		errorHandler("ValueError", e, actionMsg, command_stderr, exitOnFail)
+		recordCommand('main', command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
+		errorHandler("ValueError", e, actionMsg, output.report(returncode), exitOnFail)
+	else:
+		recordCommand('main', command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
 	
 	debug("Completed: " + actionMsg, debugLvl)
-	return (command_stdout, command_stderr)
+	return (output.stdoutText(), output.stderrText())
+
+def waitFor(condition, phase, timeout=None, mounts=None, replaced=0):
+	"""Waits until 'condition()' holds, returning as soon as it does instead of sleeping a fixed time
+	@param condition - callable returning True once we're done waiting
+	@param phase - name of what we're waiting for (used for the wait counters, e.g. "umount")
+	@param timeout - (optional) seconds to wait before giving up (default: SETTLE_TIMEOUT)
+	@param mounts - (optional) mount table to poll, so mount/umount events wake us immediately
+	@param replaced - (optional) seconds of fixed sleep this wait replaces (for reporting)
+	@returns True if the condition held, False if we timed out
+	"""
+	if timeout is None:
+		timeout = SETTLE_TIMEOUT
+	stats = WAIT_STATS.setdefault(phase, { 'waits' : 0, 'waited' : 0.0, 'timeouts' : 0, 'replaced' : 0.0 })
+	start = time()
+	interval = 0.05
+	met = condition()
+	while not met and time() - start < timeout:
+		wait = min(interval, timeout - (time() - start))
+		if mounts is not None:
+			# wakes up early if the kernel reports a mount table change, and re-reads the table then
+			if mounts.changed(int(wait * 1000)):
+				mounts.snapshot()
+		else:
+			sleep(max(wait, 0))
+		interval = min(interval * 2, 0.5)
+		met = condition()
+	stats['waits'] += 1
+	stats['waited'] += time() - start
+	stats['replaced'] += replaced
+	if not met:
+		stats['timeouts'] += 1
+	return met
+
+def udevSettled():
+	"""Returns True once udev has no events queued"""
+	for path in UDEV_QUEUE_PATHS:
+		if os.path.exists(path):
+			return False
+	return True
+
+def reportWaitStats():
+	"""Displays the per-phase wait counters for this process"""
+	for phase in sorted(WAIT_STATS):
+		stats = WAIT_STATS[phase]
+		debug("Waited for '%s' %d time(s): %.1fs total, %.1fs less than fixed sleeps, %d timeout(s)" % (phase,
+			stats['waits'], stats['waited'], stats['replaced'] - stats['waited'], stats['timeouts']), 1)
+
+def recordCommand(drive, command, action, started, returncode, stdout, stderr, row=None, outBytes=None):
+	"""Records an external command in this process' trace file (if tracing is on)
+	@param drive - name of the partition the command was run for ('main' for the script itself)
+	@param command - the argument list
+	@param action - human readable description of the command
+	@param started - time() the command was started
+	@param returncode - exit status (None if it couldn't be run)
+	@param stdout, stderr - the command's output
+	@param row - (optional) the drive's row in the timeline (default: the partition name without its number)
+	@param outBytes - (optional) how much output the command produced (default: the length of stdout and stderr)
+	"""
+	global TRACE_FILE
+	if TRACE_DIR is None:
+		return
+	if row is None:
+		row = drive
+		if drive != 'main':
+			row = drive[:-1]
+	record = json.dumps({ 'drive' : drive, 'row' : row, 'phase' : tracePhase(), 'argv' : command,
+						  'action' : action, 'pid' : os.getpid(), 'start' : started,
+						  'duration' : time() - started, 'exit' : returncode,
+						  'outBytes' : outBytes or len(stdout or '') + len(stderr or '') }) + "\n"
+	TRACE_LOCK.acquire()
+	try:
+		if TRACE_FILE is None or TRACE_FILE.name != os.path.join(TRACE_DIR, 'commands-%d.jsonl' % os.getpid()):
+			TRACE_FILE = open(os.path.join(TRACE_DIR, 'commands-%d.jsonl' % os.getpid()), 'a')
+		TRACE_FILE.write(record)
+		TRACE_FILE.flush()
+	finally:
+		TRACE_LOCK.release()
+
+def tracePhase():
+	"""Returns what this worker is doing, for the command records (see setTracePhase())"""
+	return getattr(WORKER, 'phase', 'setup')
+
+def setTracePhase(phase, row=None, started=None):
+	"""Sets the phase recorded with the commands that follow; when the previous phase for a drive ends,
+	pass the drive and when that phase started to record the phase itself
+	@param phase - the new phase
+	@param row - (optional) the drive (timeline row) the previous phase was for
+	@param started - (optional) time() the previous phase started
+	"""
+	if TRACE_DIR is not None and row is not None and started is not None:
+		# a record with no arguments is the phase itself
+		recordCommand(row, [], tracePhase(), started, 0, '', '', row)
+	WORKER.phase = phase
+
+def loadTrace(traceDir):
+	"""Reads back every record written by every process into 'traceDir', sorted by start time"""
+	records = []
+	for name in sorted(os.listdir(traceDir)):
+		if not (name.startswith('commands-') and name.endswith('.jsonl')):
+			continue
+		f = open(os.path.join(traceDir, name), 'r')
+		for line in f:
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				pass	# a process killed mid-write
+		f.close()
+	records.sort(key=lambda record: record['start'])
+	return records
+
+def exportTrace(traceDir, top=15):
+	"""Writes the recorded commands out as a Chrome trace-event timeline (trace.json, open it in
+	chrome://tracing or Perfetto; one row per drive) and a summary of the slowest commands and
+	phases (summary.txt), which is also displayed
+	@param traceDir - the directory the processes recorded into
+	@param top - (optional) how many of the slowest commands to list
+	"""
+	records = loadTrace(traceDir)
+	if not records:
+		return
+	origin = records[0]['start']
+	drives = sorted(set([ record['row'] for record in records if record['row'] != 'main' ]))
+	rows = dict([ (drive, i + 1) for (i, drive) in enumerate(drives) ])
+	events = [ { 'name' : 'thread_name', 'ph' : 'M', 'pid' : 1, 'tid' : 0, 'args' : { 'name' : 'main' } } ]
+	for drive in drives:
+		events.append({ 'name' : 'thread_name', 'ph' : 'M', 'pid' : 1, 'tid' : rows[drive], 'args' : { 'name' : drive } })
+
+	commands = []
+	phases = {}
+	for record in records:
+		row = rows.get(record['row'], 0)
+		if record['argv']:
+			commands.append(record)
+			name = os.path.basename(record['argv'][0])
+			category = record['phase']
+		else:
+			name = record['action']
+			category = 'phase'
+			stats = phases.setdefault(record['action'], [0, 0.0])
+			stats[0] += 1
+			stats[1] += record['duration']
+		events.append({ 'name' : name, 'cat' : category, 'ph' : 'X', 'pid' : 1, 'tid' : row,
+						'ts' : int((record['start'] - origin) * 1000000), 'dur' : int(record['duration'] * 1000000),
+						'args' : { 'drive' : record['drive'], 'action' : record['action'], 'argv' : ' '.join(record['argv']),
+								   'exit' : record['exit'], 'outBytes' : record['outBytes'] } })
+	traceFile = open(os.path.join(traceDir, 'trace.json'), 'w')
+	json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, traceFile)
+	traceFile.close()
+
+	lines = [ "%d command(s) recorded, %.1fs in total" % (len(commands), sum([ c['duration'] for c in commands ])),
+			  "", "Slowest commands:" ]
+	for record in sorted(commands, key=lambda record: -record['duration'])[:top]:
+		lines.append("  %8.1fs  %-12s %-10s exit %-4s %s" % (record['duration'], record['drive'], record['phase'],
+			record['exit'], ' '.join(record['argv'])[:100]))
+	lines += [ "", "Phases (count, total, average):" ]
+	for phase in sorted(phases, key=lambda phase: -phases[phase][1]):
+		(count, total) = phases[phase]
+		lines.append("  %-12s %4d %9.1fs %8.1fs" % (phase, count, total, total / count))
+	summaryFile = open(os.path.join(traceDir, 'summary.txt'), 'w')
+	summaryFile.write("\n".join(lines) + "\n")
+	summaryFile.close()
+	debug("Command trace written to " + os.path.join(traceDir, 'trace.json') + "\n" + "\n".join(lines), 1)
+
+class progressTracker:
+	"""Tracks how far a drive is through a phase (bytes done of bytes total, current rate and ETA)
+	and publishes it at most every PROGRESS_INTERVAL seconds as a line in PROGRESS_DIR/progress.jsonl
+	and as a Prometheus textfile (PROGRESS_DIR/usb_updater_<drive>_<phase>.prom) for node_exporter.
+	"""
+	def __init__(self, drive, phase, total):
+		"""
+		@param drive - name of the drive (partition) being written
+		@param phase - what is being written (e.g. 'live', 'tools', 'clone')
+		@param total - bytes expected in total
+		"""
+		self.drive = drive
+		self.phase = phase
+		self.total = total
+		self.done = 0
+		self.rate = 0.0
+		self.started = time()
+		self.lastTime = self.started
+		self.lastDone = 0
+		self.update(0, True)
+
+	def update(self, done, force=False):
+		"""Records that 'done' bytes have been written so far"""
+		self.done = done
+		if PROGRESS_DIR is None:
+			return
+		now = time()
+		if not force and now - self.lastTime < PROGRESS_INTERVAL:
+			return
+		if now > self.lastTime:
+			current = (done - self.lastDone) / (now - self.lastTime)
+			if self.rate == 0.0:
+				self.rate = current
+			else:
+				self.rate = 0.3 * current + 0.7 * self.rate	# smooth out bursts
+		self.lastTime, self.lastDone = now, done
+		self.publish()
+
+	def add(self, count):
+		"""Records 'count' more bytes written"""
+		self.update(self.done + count)
+
+	def finish(self):
+		"""Marks the phase complete (leaving the last measured rate alone)"""
+		self.done = max(self.done, self.total)
+		if PROGRESS_DIR is not None:
+			self.publish()
+
+	def eta(self):
+		if self.rate <= 0:
+			return -1
+		return max(self.total - self.done, 0) / self.rate
+
+	def publish(self):
+		event = { 'time' : time(), 'drive' : self.drive, 'phase' : self.phase, 'bytesDone' : self.done,
+				  'bytesTotal' : self.total, 'mbPerSec' : round(self.rate / 1000000, 2), 'eta' : round(self.eta(), 1),
+				  'elapsed' : round(time() - self.started, 1) }
+		# one small O_APPEND write per event, so lines from different workers don't interleave
+		fd = os.open(os.path.join(PROGRESS_DIR, 'progress.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		os.write(fd, json.dumps(event) + "\n")
+		os.close(fd)
+
+		labels = '{drive="%s",phase="%s"}' % (self.drive, self.phase)
+		metrics = [ ('bytes_done', 'Bytes written so far', self.done),
+					('bytes_total', 'Bytes to write in total', self.total),
+					('rate_bytes_per_second', 'Current write rate', self.rate),
+					('eta_seconds', 'Estimated seconds left (-1 if unknown)', self.eta()) ]
+		lines = []
+		for (name, help, value) in metrics:
+			lines.append('# HELP usb_updater_%s %s' % (name, help))
+			lines.append('# TYPE usb_updater_%s gauge' % name)
+			lines.append('usb_updater_%s%s %s' % (name, labels, value))
+		promPath = os.path.join(PROGRESS_DIR, 'usb_updater_%s_%s.prom' % (self.drive, self.phase))
+		promFile = open(promPath + '.tmp', 'w')
+		promFile.write("\n".join(lines) + "\n")
+		promFile.close()
+		os.rename(promPath + '.tmp', promPath)
+
+# rsync --progress lines look like "    1238099  45%  146.38MB/s    0:00:00" (rsync 3.1 adds commas)
+RSYNC_PROGRESS = re.compile(r'^\s*([0-9,]+)\s+([0-9]+)%')
+
+class rsyncProgress:
+	"""Feeds rsync --progress output into a progressTracker"""
+	def __init__(self, tracker):
+		self.tracker = tracker
+		self.completed = 0	# bytes in files rsync has finished
+		self.current = 0	# bytes of the file in progress
+
+	def line(self, text):
+		match = RSYNC_PROGRESS.match(text)
+		if match is None:
+			return
+		count = int(match.group(1).replace(',', ''))
+		if count < self.current:
+			# a new file started without us seeing the end of the last one
+			self.completed += self.current
+		self.current = count
+		if match.group(2) == '100':
+			self.completed += count
+			self.current = 0
+		self.tracker.update(self.completed + self.current)
+
+def sourceSize(root):
+	"""Returns the total size of the files under 'root' (cached for the rest of the run)"""
+	if root not in SOURCE_SIZES:
+		total = 0
+		for (dirPath, dirs, files) in os.walk(root):
+			for name in files:
+				try:
+					total += os.lstat(os.path.join(dirPath, name)).st_size
+				except OSError:
+					pass
+		SOURCE_SIZES[root] = total
+	return SOURCE_SIZES[root]
+
+def rsyncArgs():
+	"""Returns rsync's flags: quiet normally, or with per-file progress when we're publishing progress"""
+	if PROGRESS_DIR is None:
+		return [ '-rtqvv8D' ]
+	return [ '-rtv8D', '--progress' ]
+
+class driveWatch:
+	"""Shared between a worker process and the main process's watchdog: which stage the worker's drive is
+	in and since when, and the process group of the command it is running. When the stage overruns its
+	deadline (PHASE_DEADLINES) the watchdog kills that command's process group, so only that drive fails.
+	"""
+	def __init__(self):
+		self.stage = Value('i', -1, lock=False)		# index of the stage the drive is in (-1: idle)
+		self.started = Value('d', 0.0, lock=False)
+		self.command = Value('i', 0, lock=False)	# process group of the running command (0: none)
+		self.timedOut = Value('b', 0, lock=False)
+		self.drive = Array('c', 256, lock=False)
+		self.killedAt = None						# (main process only) when the watchdog stepped in
+
+	def enter(self, i, dev):
+		"""The worker starts stage i on a drive"""
+		self.drive.value = dev[-255:]
+		self.timedOut.value = 0
+		self.command.value = 0
+		self.started.value = time()
+		self.stage.value = i
+
+	def leave(self):
+		"""The worker is done with the drive's stage"""
+		self.stage.value = -1
+
+	def check(self, stages, now):
+		"""(main process) Kills the running command if the stage is past its deadline
+		@param stages - the list of (name, media method name) the stage index refers to
+		@returns True if the drive is past its deadline
+		"""
+		i = self.stage.value
+		if i < 0:
+			return False
+		if self.timedOut.value:
+			return True
+		name = stages[i][0]
+		deadline = PHASE_DEADLINES.get(name)
+		if not deadline or now - self.started.value < deadline:
+			return False
+		self.timedOut.value = 1
+		self.killedAt = now
+		debug("%s has been in the %s stage for over %ds; stopping it" % (self.drive.value, name, deadline), 0)
+		pgid = self.command.value
+		if pgid:
+			try:
+				os.killpg(pgid, signal.SIGKILL)
+			except OSError:
+				pass
+		return True
+
+def currentWatch():
+	"""Returns the driveWatch of the drive this worker is on, or None"""
+	return getattr(WORKER, 'watch', None)
+
+def startCommand(command):
+	"""Starts a command for the drive this worker is on. Under a drive watch the command gets a process
+	group of its own, which the watchdog can kill along with everything the command started. The group is
+	made by exec'ing the command through setsid rather than with a preexec_fn, which would run Python code
+	in the forked child while other drive threads hold locks (-E thread)."""
+	watch = currentWatch()
+	if watch is None:
+		return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	# our child isn't a process group leader, so setsid execs the command in place: its pid is the group's ID
+	p = subprocess.Popen([ 'setsid' ] + list(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	watch.command.value = p.pid
+	return p
+
+def commandFinished():
+	"""The command started by startCommand() is done"""
+	watch = currentWatch()
+	if watch is not None:
+		watch.command.value = 0
+
+def commandTimedOut():
+	"""Returns True if the watchdog has stopped the drive this worker is on"""
+	watch = currentWatch()
+	return watch is not None and watch.timedOut.value != 0
+
+class processRunner:
+	"""Runs the drives' external commands as child processes, at most 'limit' at once across every
+	worker (0: no limit)"""
+	def __init__(self, limit=0):
+		self.slots = None
+		if limit > 0:
+			self.slots = Semaphore(limit)
+
+	def run(self, command, output):
+		"""Runs a command to completion (raises OSError if it can't be started)
+		@param command - the argument list
+		@param output - commandOutput to hand the output to, line by line as it arrives
+		@returns the exit status
+		"""
+		if self.slots is not None:
+			self.slots.acquire()
+		try:
+			p = startCommand(command)
+			try:
+				streamLines(p, output)
+			finally:
+				commandFinished()
+			return p.returncode
+		finally:
+			if self.slots is not None:
+				self.slots.release()
+
+class recordingRunner:
+	"""Stands in for processRunner without running anything: records every command with the worker
+	thread that asked for it, and answers from 'respond' (fed through the commandOutput like real output)"""
+	def __init__(self, respond=None):
+		"""
+		@param respond - (optional) function taking the argument list and returning (stdout, stderr,
+							returncode), or None for ('', '', 0)
+		"""
+		self.respond = respond
+		self.commands = []		# (thread name, argument list) in the order they were asked for
+		self.lock = threading.Lock()
+
+	def run(self, command, output):
+		self.lock.acquire()
+		self.commands.append((threading.current_thread().name, list(command)))
+		self.lock.release()
+		answer = None
+		if self.respond is not None:
+			answer = self.respond(command)
+		(stdout, stderr, returncode) = answer or ('', '', 0)
+		output.feed(stdout, 'stdout')
+		output.feed(stderr, 'stderr')
+		output.close()
+		return returncode
+
+def commandRunner():
+	"""Returns COMMAND_RUNNER, starting the default one the first time"""
+	global COMMAND_RUNNER
+	if COMMAND_RUNNER is None:
+		COMMAND_RUNNER = processRunner()
+	return COMMAND_RUNNER
+
+def streamLines(p, output):
+	"""Like p.communicate(), but hands both output streams to 'output' (a commandOutput) as they arrive
+	instead of collecting them, and waits for the command to exit"""
+	poller = select.poll()
+	streams = { p.stdout.fileno() : 'stdout', p.stderr.fileno() : 'stderr' }
+	for fd in streams:
+		poller.register(fd, select.POLLIN | select.POLLHUP)
+	while streams:
+		for (fd, event) in poller.poll():
+			data = os.read(fd, 65536)
+			if not data:
+				poller.unregister(fd)
+				del streams[fd]
+				continue
+			output.feed(data, streams[fd])
+	output.close()
+	p.stdout.close()
+	p.stderr.close()
+	p.wait()
+
+class commandOutput:
+	"""Takes a command's output line by line as it arrives and keeps only what is needed: the standard
+	output up to OUTPUT_KEEP_BYTES (for the few commands whose output we parse), each line of it for an
+	optional line handler (e.g. rsync progress), the error lines sorted into expected and unexpected,
+	and the last OUTPUT_TAIL_LINES lines of both streams for the failure report.
+	"""
+	def __init__(self, expectedErr="", lineHandler=None, okStatus=(0,)):
+		"""
+		@param expectedErr - (optional) pattern (searched for in each line) of error lines that are expected
+		@param lineHandler - (optional) function to call with each line of standard output
+		@param okStatus - (optional) exit statuses that mean success
+		"""
+		self.expected = None
+		if expectedErr.strip():
+			self.expected = re.compile(expectedErr.strip())
+		self.lineHandler = lineHandler
+		self.okStatus = okStatus
+		self.pending = { 'stdout' : '', 'stderr' : '' }
+		self.stdout = []
+		self.stdoutBytes = 0
+		self.truncated = False
+		self.tail = deque(maxlen=OUTPUT_TAIL_LINES)
+		self.errorLines = deque(maxlen=OUTPUT_TAIL_LINES)
+		self.unexpected = 0		# error lines that weren't expected
+		self.warnings = 0		# error lines that were
+		self.bytes = 0
+
+	def feed(self, data, stream):
+		"""Takes the next piece of one stream, splitting it into lines (standard output lines also end at
+		a carriage return, which progress displays use)"""
+		self.bytes += len(data)
+		if stream == 'stdout':
+			lines = re.split(r'[\r\n]', self.pending[stream] + data)
+		else:
+			lines = (self.pending[stream] + data).split('\n')
+		self.pending[stream] = lines.pop()
+		if len(self.pending[stream]) > OUTPUT_KEEP_BYTES:
+			# not a line anyone will parse; don't let it grow without bound
+			lines.append(self.pending[stream])
+			self.pending[stream] = ''
+		for text in lines:
+			self.line(text, stream)
+
+	def close(self):
+		"""Both streams have ended; takes their unterminated last lines"""
+		for stream in [ 'stdout', 'stderr' ]:
+			if self.pending[stream]:
+				self.line(self.pending[stream], stream)
+				self.pending[stream] = ''
+
+	def line(self, text, stream):
+		if stream == 'stdout':
+			if self.lineHandler:
+				self.lineHandler(text)
+			if self.stdoutBytes + len(text) < OUTPUT_KEEP_BYTES:
+				self.stdout.append(text + "\n")
+				self.stdoutBytes += len(text) + 1
+			else:
+				self.truncated = True
+			if text:
+				self.tail.append(text)
+			return
+		if not text.strip():
+			return
+		self.tail.append("stderr: " + text)
+		self.errorLines.append(text)
+		if self.expected is not None and self.expected.search(text):
+			self.warnings += 1
+		else:
+			self.unexpected += 1
+
+	def ok(self, returncode):
+		"""Returns True if the command succeeded: it printed no unexpected error lines, and exited with one
+		of the okStatus statuses or with its failure explained by an expected error line (e.g. umount of
+		something that isn't mounted)"""
+		if self.unexpected:
+			return False
+		return returncode in self.okStatus or self.warnings > 0
+
+	def stdoutText(self):
+		"""Returns the standard output kept (see OUTPUT_KEEP_BYTES)"""
+		return ''.join(self.stdout)
+
+	def stderrText(self):
+		"""Returns the last lines of the error stream"""
+		if not self.errorLines:
+			return ""
+		return "\n".join(self.errorLines) + "\n"
+
+	def report(self, returncode=None):
+		"""Returns the last lines of output, for the failure report"""
+		lines = list(self.tail)
+		if returncode is not None:
+			lines.append("(exit status %s)" % returncode)
+		return "\n".join(lines)
+
+class mountTable:
+	"""An in-process snapshot of the kernel mount table, read from /proc/self/mountinfo.
+	The snapshot is only re-read when the kernel signals (POLLPRI/POLLERR on the open mountinfo
+	file) that something was mounted or unmounted, so asking for a mountpoint is normally free.
+	"""
+	def __init__(self, path=None):
+		"""
+		@param path - (optional) the mountinfo file to read (default: MOUNTINFO_PATH)
+		"""
+		self.path = path or MOUNTINFO_PATH
+		self.pid = os.getpid()
+		self.entries = []
+		self.refreshes = 0
+		# set when poll() has reported a change the table hasn't been re-read for yet: reporting the change
+		# clears it in the kernel, so it must not be forgotten until snapshot() re-reads the table
+		self.stale = False
+		# drive threads (see runDriveThreads) share the one open mountinfo file
+		self.lock = threading.Lock()
+		self.mountinfo = open(self.path, "r")
+		self.poller = select.poll()
+		self.poller.register(self.mountinfo.fileno(), select.POLLPRI | select.POLLERR)
+		self.refresh()
+
+	def close(self):
+		"""Close the mountinfo file"""
+		self.mountinfo.close()
+
+	def fileno(self):
+		"""Returns the mountinfo file descriptor (so callers can poll it for changes)"""
+		return self.mountinfo.fileno()
+
+	def refresh(self):
+		"""Re-read the whole mount table from the start of the mountinfo file"""
+		self.mountinfo.seek(0)
+		self.entries = [ entry for entry in map(parseMountInfoLine, self.mountinfo.read().split("\n")) if entry ]
+		self.refreshes += 1
+
+	def changed(self, timeout=0):
+		"""Returns True if the mount table has changed since it was last read (the next snapshot() re-reads it)
+		@param timeout - (optional) milliseconds to wait for a change (0 returns immediately)
+		"""
+		if self.stale:
+			return True
+		if len(self.poller.poll(timeout)) > 0:
+			self.stale = True
+		return self.stale
+
+	def snapshot(self):
+		"""Returns the current list of mount entries, re-reading the table only if it changed"""
+		self.lock.acquire()
+		try:
+			if self.changed():
+				# cleared first, so a change reported while we read is picked up next time
+				self.stale = False
+				self.refresh()
+			return self.entries
+		finally:
+			self.lock.release()
+
+	def find(self, device=None, mountPoint=None):
+		"""Returns the first mount entry that is exactly this device or exactly this mountpoint
+		@param device - (optional) device node (or a symlink to it) to look for
+		@param mountPoint - (optional) mountpoint path to look for
+		@returns the matching entry dict, or None
+		"""
+		devNum, devPath = None, None
+		if device:
+			devPath = os.path.realpath(device)
+			try:
+				devNum = os.stat(devPath).st_rdev
+			except OSError:
+				devNum = None
+		if mountPoint:
+			mountPoint = os.path.normpath(mountPoint)
+		for entry in self.snapshot():
+			if mountPoint and entry['mountPoint'] == mountPoint:
+				return entry
+			if devPath and entry['source'] == devPath:
+				return entry
+			# block device filesystems carry the device's major:minor, so this also matches
+			# mounts made through any other name for the same device
+			if devNum is not None and entry['devNum'] == devNum and entry['source'].startswith('/dev/'):
+				return entry
+		return None
+
+def parseMountInfoLine(line):
+	"""Parses a single line of /proc/self/mountinfo
+	@param line - the line to parse, e.g.
+		"36 35 8:17 / /media/usb1part1 rw,relatime shared:1 - vfat /dev/sdb1 rw,fmask=0022"
+	@returns a dict describing the mount, or None if the line is blank/malformed
+	"""
+	fields = line.split()
+	if len(fields) < 7 or '-' not in fields[6:]:
+		return None
+	# optional fields (shared:N, master:N, ...) end at the lone '-' separator
+	sep = fields.index('-', 6)
+	if len(fields) < sep + 3:
+		return None
+	major, minor = fields[2].split(':')
+	return { 'mountId' : int(fields[0]),
+			 'devNum' : os.makedev(int(major), int(minor)),
+			 'root' : unescapeMountField(fields[3]),
+			 'mountPoint' : unescapeMountField(fields[4]),
+			 'options' : fields[5],
+			 'fsType' : fields[sep + 1],
+			 'source' : unescapeMountField(fields[sep + 2]) }
+
+def unescapeMountField(field):
+	"""The kernel escapes space, tab, newline and backslash in mountinfo as octal (e.g. '\\040')"""
+	return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+def getMountTable():
+	"""Returns this process' shared mount table snapshot, opening it on first use.
+	Every partition handled by a worker process shares the same snapshot; a forked worker never
+	reuses its parent's mountinfo file (the file position would be shared between processes).
+	"""
+	global MOUNT_TABLE
+	if MOUNT_TABLE is None or MOUNT_TABLE.pid != os.getpid():
+		MOUNT_TABLE = mountTable()
+	return MOUNT_TABLE
 
 class media:
 	"""A 'media' object is any media on which we might copy USB Tools or an image (e.g., USB Flash Drive)
@@ -209,20 +1159,16 @@ class media:
 		self.debugLevel = int(debugLvl)
 		self.forceOn = forceBool
 		self.emailOn = emailBool
-		if self.emailOn:
-			#define a unique log file for this device
-			self.emailFile = "/scripts/logs/" + self.name + ".log"
-			#Remove the email log file for this drive if it exists
-			if os.path.isfile(self.emailFile):
-				os.remove(self.emailFile)
-			#Open a new email log file for this drive for writing
-			self.emailBody = open(self.emailFile, "w")
 		# The device's mountpoint on the machine
 		self.mountPoint = MEDIA_MOUNT_POINT_ROOT + '/' + self.name
-		command = [ '/bin/find', self.dev, '-type', 'l', '-exec', 'readlink', '-f', '{}', ';' ]
-		action = "follow symlink to determine correct /dev/sdX#"
-		std_out, std_err = self.runCommand(command, action)
-		self.dev_sd = std_out.strip()
+		# Where we believe this partition is mounted (False if it isn't, None if we need to look)
+		# and the mount table refresh that belief is based on
+		self.mountState = None
+		self.mountStateSeq = -1
+		# How many mount/unmount operations we ran vs. skipped because they wouldn't have changed anything
+		self.mountOps = { 'mount' : 0, 'unmount' : 0, 'skippedMount' : 0, 'skippedUnmount' : 0 }
+		# Follow the link to the real /dev/sdX# node
+		self.dev_sd = os.path.realpath(self.dev)
 		
 		debug("Name: %s, dev: %s, dev_sd: %s partNum: %s, mountPoint: %s" % (self.name, self.dev, self.dev_sd, self.partNum, self.mountPoint), 3)
 		
@@ -246,10 +1192,6 @@ class media:
 		"""Returns the partition number of this media object"""
 		return self.partNum
 
-	def getDebuggerFile(self):
-		"""Returns the path of the email file for this media object"""
-		return self.emailFile
-		
 	def errorHandler(self, ErrorType, error, job, stderr="", quit=False):#quit=True
 		"""Handles possible exceptions/errors and reports them
 		@param ErrorType - type of exception that occured (ValueError, OSError, etc)
@@ -282,7 +1224,7 @@ class media:
 				self.emailBuilder("[debug] " + text)
 		sys.stdout.flush()
 		
-	def runCommand( self, command, actionMsg, expectedErr = "", exitOnFail=False, debugLvl=1 ):
+	def runCommand( self, command, actionMsg, expectedErr = "", exitOnFail=False, debugLvl=1, lineHandler=None, okStatus=(0,) ):
 		"""Run a command using subprocess
 			@param command
 				List, where the command is split on spaces
@@ -290,12 +1232,17 @@ class media:
 			@param actionMsg
 				String describing what this command will do
 			@param expectedErr
-				String equal to the expected stderr of a specific command, if it always prints to stderr for example
+				Pattern of the expected stderr lines of a specific command, if it always prints to stderr for example
 			@param exitOnFail
 				Boolean to determine if this process should quit on an error (DEFAULT: False)
 			@param debugLvl
 				Integer to specify what level to print the debug at
-			@return (stdout, stderr) as a Tuple
+			@param lineHandler
+				Function to call with each line of standard output as it arrives (DEFAULT: None)
+			@param okStatus
+				Exit statuses that mean success (DEFAULT: only 0)
+			@return (stdout, stderr) as a Tuple: the standard output (up to OUTPUT_KEEP_BYTES) and the
+				last lines of the error stream
 		"""
 		#make sure command is a list split on spaces
 		if type(command).__name__ == 'str':
@@ -304,51 +1251,42 @@ class media:
 		self.debug("Starting: " + actionMsg, debugLvl)
 		self.debug("Using: " + ' '.join(command), debugLvl)
 
-		command_stdout, command_stderr = "", ""
+		output = commandOutput(expectedErr, lineHandler, okStatus)
+		started, returncode = time(), None
+		errorType = "ValueError"
 	
 		try:
-			p =	subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			(command_stdout, command_stderr) = p.communicate()
-			if command_stderr:
-				if expectedErr != "" and not command_stderr.endswith(expectedErr):
-					raise ValueError, command
-				elif expectedErr == "":
-					raise ValueError, command
+			if commandTimedOut():
+				# the drive is past its stage deadline; don't start anything else on it
+				errorType = "Timeout"
+				raise ValueError, command
+			returncode = commandRunner().run(command, output)
+			if commandTimedOut():
+				errorType = "Timeout"
+				raise ValueError, command
+			if not output.ok(returncode):
+				raise ValueError, command
 		except OSError, e:
 			debug("error!",1)
-			self.errorHandler("OSError", e, actionMsg, command_stderr, exitOnFail)
+			recordCommand(self.name, command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
+			self.errorHandler("OSError", e, actionMsg, output.report(), exitOnFail)
 		except ValueError, e:
 			debug("error!",1)
-			self.errorHandler("ValueError", e, actionMsg, command_stderr, exitOnFail)
+			recordCommand(self.name, command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
+			self.errorHandler(errorType, e, actionMsg, output.report(returncode), exitOnFail)
+		else:
+			recordCommand(self.name, command, actionMsg, started, returncode, '', '', outBytes=output.bytes)
+		if output.truncated:
+			self.debug("Only the first %d bytes of the output were kept" % OUTPUT_KEEP_BYTES, 3)
 	
 		self.debug("Completed: " + actionMsg, debugLvl)
-		return (command_stdout, command_stderr)
+		return (output.stdoutText(), output.stderrText())
 	
 	def emailBuilder(self,text):
 		"""Appends 'text' to the email body
 		@param text - the text to append
 		"""
-		self.emailBody.write("\n" + text)
-		self.emailBody.flush()
-
-	def readEmail(self):
-		"""Opens and reads the log file that will be used for an email report"""
-		#Make sure the file is closed first
-		self.closeDebugger()
-		toReturn = ""
-		try:
-			#Open the file readonly
-			emailReader = open(self.emailFile, "r")
-			for line in emailReader.readlines():
-				toReturn += line
-			emailReader.close()
-		except IOError, e:
-			toReturn += "No log file for this partition."
-		return toReturn
-
-	def closeDebugger(self):
-		"""Close the email log file"""
-		self.emailBody.close()
+		logRecord(self.name, text)
 	
 	def cleanMountPoint(self):
 		"""Ensures that the mountpoint assigned to the drive is removed"""
@@ -358,51 +1296,25 @@ class media:
 		std_out, std_err = self.runCommand(command, action)
 	
 	def getCurrentMountPoint(self):
-		"""Gets the mountpoint of this media device."""
-		#Let's get the results from mount.
-		command = [ '/bin/mount' ]
-		action = "get a list of mounted devices (using 'mount') - " + self.dev
-		std_out, std_err = self.runCommand(command, action)
-		
-		# Separate the output into individual lines for processing
-		result = std_out.split("\n")	
-		
-		#Now, it's time to cycle through each line and see if it's one of our media.
-		for current in result:
-			toCheck = string.split(current)
-			#if len(toCheck) < 3:
-				#return False
-			if len(toCheck) > 2:
-				#self.debug(str(toCheck), 4)
-				#currentDev = toCheck[0]
-				currentMountPoint = toCheck[2]
-
-				#Here's the actual mountpoint
-				#self.debug("Current mountpoint we're reviewing is: " + currentMountPoint, 4)
-				if currentMountPoint.find(self.name) != -1:
-					self.debug("We found the mountpoint!: (\"" + currentMountPoint + "\")\n", 2)
-					return currentMountPoint
-
-		#Let's try to get a list from /proc/mounts as well, just in case
-		command = [ '/bin/cat', '/proc/mounts' ]
-		action = "read /proc/mounts just in case 'mount' didn't get everything"
-		#Run the command
-		std_out, std_err = self.runCommand(command, action)		
-		# Separate the output into individual lines for processing
-		resultProc = std_out.split("\n")
-
-		for current in resultProc:
-			toCheck = string.split(current)
-			if len(toCheck) > 1:
-				#self.debug(str(toCheck), 4)
-				#currentDev = toCheck[0]
-				currentMountPoint = toCheck[1]
-				#self.debug("Reviewing: " + currentMountPoint, 4)
-				if currentMountPoint.find(self.name) != -1:
-					self.debug("Found mountpoint!: (\"" + currentMountPoint + "\")\n", 2)
-					return currentMountPoint
+		"""Gets the mountpoint of this media device.
+		Uses the shared in-process mount table instead of running 'mount' and 'cat /proc/mounts', and only
+		matches this exact device (or this exact mountpoint) rather than any mountpoint containing our name.
+		"""
+		mounts = getMountTable()
+		mounts.snapshot()
+		# Our own record of the mount state holds until the mount table changes
+		if self.mountState is not None and self.mountStateSeq == mounts.refreshes:
+			return self.mountState
 
-		return False
+		entry = mounts.find(device=self.dev, mountPoint=self.mountPoint)
+		self.mountStateSeq = mounts.refreshes
+		if entry is None:
+			self.mountState = False
+			return False
+
+		self.debug("We found the mountpoint!: (\"" + entry['mountPoint'] + "\")\n", 2)
+		self.mountState = entry['mountPoint']
+		return entry['mountPoint']
 		
 	def unmount(self):
 		"""Unmounts the drive from its current mountpoint."""
@@ -412,6 +1324,7 @@ class media:
 
 		if not currentMountPoint:
 			self.debug("This drive is not mounted: " + self.dev + "\n", 3)
+			self.mountOps['skippedUnmount'] += 1
 			return False
 			
 		if not os.path.exists(currentMountPoint) or not os.path.isdir(currentMountPoint):
@@ -422,8 +1335,8 @@ class media:
 		command = [ '/usr/sbin/lsof', '-t', currentMountPoint ]
 		action = "check for open processes at this mountpoint: (\"" + currentMountPoint + "\")"
 	
-		#This actually executes the command.	
-		std_out, std_err = self.runCommand(command, action)
+		#This actually executes the command (lsof exits with 1 when nothing has files open there)
+		std_out, std_err = self.runCommand(command, action, okStatus=(0, 1))
 		
 		#We'll now get a string for each process to kill, but we'll need to split it into an array
 		result = string.split(std_out)
@@ -443,15 +1356,66 @@ class media:
 			
 		#This actually executes the command.	
 		std_out, std_err = self.runCommand(command, action)
+		self.mountOps['unmount'] += 1
+		self.mountState = None
 		
-		sleep(10) # Sleep for 3 seconds to make sure it's completed the unmount process
+		# Wait until the kernel has actually dropped the mount
+		if not waitFor(lambda: not self.getCurrentMountPoint(), "umount", mounts=getMountTable(), replaced=SETTLE_FIXED_SLEEP):
+			self.debug("Timed out waiting for " + currentMountPoint + " to unmount", 1)
 		
 		self.cleanMountPoint()
 
+	def waitUnmounted(self, part):
+		"""Waits until nothing is mounted from the partition node 'part'
+		@param part - partition device node (e.g. /dev/sdb1)
+		"""
+		mounts = getMountTable()
+		if not waitFor(lambda: mounts.find(device=part) is None, "umount", mounts=mounts, replaced=SETTLE_FIXED_SLEEP):
+			self.debug("Timed out waiting for " + part + " to unmount", 1)
+
+	def waitPartitions(self, dev, partNums):
+		"""Waits after a partition table rescan until the partition nodes exist and udev is idle
+		@param dev - the whole-disk device node (e.g. /dev/sdb)
+		@param partNums - list of partition numbers that should appear
+		"""
+		nodes = [ partitionNode(dev, num) for num in partNums ]
+		if not waitFor(lambda: udevSettled() and all(os.path.exists(node) for node in nodes), "rescan"):
+			self.debug("Timed out waiting for partition(s) " + ', '.join(nodes) + " to appear", 1)
+
+	def unmountNode(self, part):
+		"""Unmounts a partition node of this drive (e.g. /dev/sdb1) if anything is mounted from it
+		@param part - partition device node
+		"""
+		if getMountTable().find(device=part) is None:
+			self.mountOps['skippedUnmount'] += 1
+			return
+
+		command = [ '/bin/umount', '-fv', part ]
+		action = "unmount this (these?) mountpoint(s): \"" + part +"\""
+
+		#This actually executes the command.	
+		std_out, std_err = self.runCommand(command, action,expectedErr="not mounted")
+		self.mountOps['unmount'] += 1
+		self.mountState = None
+
+		# Wait until the kernel has actually dropped the mount
+		self.waitUnmounted(part)
+
+	def reportMountOps(self):
+		"""Displays how many mount/unmount operations this partition ran and how many were skipped"""
+		self.debug("Mount operations: %d mount(s) run, %d skipped; %d unmount(s) run, %d skipped" % (self.mountOps['mount'],
+			self.mountOps['skippedMount'], self.mountOps['unmount'], self.mountOps['skippedUnmount']), 1)
+
 	def mount(self):
-		"""Mount the drive to the mountpoint it has been assigned."""
+		"""Mount the drive to the mountpoint it has been assigned (unless it's already mounted there)."""
+		currentMountPoint = self.getCurrentMountPoint()
+		if currentMountPoint == os.path.normpath(self.mountPoint):
+			self.debug("Already mounted at " + currentMountPoint, 3)
+			self.mountOps['skippedMount'] += 1
+			return
+
 		#We'll need to create the mountpoint, if it doesn't already exist
-		if os.path.exists( self.mountPoint ):
+		if currentMountPoint or os.path.exists( self.mountPoint ):
 			self.unmount()
 	
 		#This is the command that we will use to create the mountpoint.
@@ -467,57 +1431,210 @@ class media:
 		
 		#This actually executes the command.
 		std_out, std_err = self.runCommand(command, action)		
+		self.mountOps['mount'] += 1
+		self.mountState = None
 	
 	def imageFedora(self, otherParts):
 		"""Begin imaging the media object with live linux
 		@param otherParts - a list of media objects that are the other partitions on the same drive as this partition
 		"""
-		#Unmount the drive if it's mounted
-		self.unmount()
-		for part in otherParts:
-			part.unmount()
-		
 		#Lets start off anew! 
-		self.cleanSlate(otherParts)
-
-		self.unmount()		
-		for part in otherParts:
-			part.unmount()
+		self.wipeStage(otherParts)
 		
 		#Re-partition the drive such that partition 2 is 1GB FAT32 for WinPE/Ubuntu
 		# and partition 1 is the rest of the disk fat32 for tools
-		driveSize = self.partitionDrive(otherParts)
-
-		self.unmount()		
-		for part in otherParts:
-			part.unmount()
+		self.partitionStage(otherParts)
 		
 		#Now format the newly partitioned drive
-		self.formatDrive()
+		self.formatStage(otherParts)
 		
+		#Sync the ISO onto the second partition
+		self.populateLive(otherParts)
+			
+		#Setup Syslinux for the drive
+		self.bootloaderStage(otherParts)
+
+	def imageIsCurrent(self):
+		"""Returns True if this drive already carries the current image, so imaging it again can be
+		skipped (never in force mode)"""
+		return IMAGE_DRIVES and not force and diskStampCurrent(self.getDisk())
+
+	def stampImage(self):
+		"""Marks the drive as carrying the current image, once it has been imaged and verified"""
+		dev = self.getDisk()
+		try:
+			writeDiskStamp(dev)
+		except (IOError, OSError), e:
+			self.errorHandler("IOError", e, "stamp the image version on " + dev)
+			return
+		self.debug("Stamped " + dev + " with image version " + imageVersion()[:12], 1)
+
+	def unmountAll(self, otherParts):
+		"""Unmounts this partition and all the other partitions on the drive"""
 		self.unmount()
 		for part in otherParts:
 			part.unmount()
-		
-		if len(otherParts) < 2:
-			part2 = media(self.name[:-1]+'2', self.getDev()[:-1]+'2', self.debugLevel, self.forceOn, self.emailOn)
-			part2.setPart(2)
-			part2.sync(driveSize)
-		else:
-		#If it's the second partiton, sync the ISO onto the drive
-			for parts in otherParts:
-				if parts.getPartNum() == 2:
-					parts.sync(driveSize)
-			
-		#Setup Syslinux for the drive
+
+	# The stages a drive goes through (see driveStages()); each takes the list of the drive's partitions
+	def wipeStage(self, otherParts):
+		"""Stage 'wipe': clear the old partition tables"""
+		self.unmountAll(otherParts)
+		self.cleanSlate(otherParts)
+
+	def partitionStage(self, otherParts):
+		"""Stage 'partition': write the TOOLS/LIVE partition table"""
+		self.unmountAll(otherParts)
+		return self.partitionDrive(otherParts)
+
+	def formatStage(self, otherParts):
+		"""Stage 'format': create the TOOLS and LIVE filesystems"""
+		self.unmountAll(otherParts)
+		if FAT_BUILD:
+			self.debug("Leaving the filesystems to be built with their contents in the populate stage", 2)
+			return
+		self.formatDrive()
+
+	def populateStage(self, otherParts):
+		"""Stage 'populate': the bandwidth-bound copying (golden image, live folder and/or tools)"""
+		imaging = IMAGE_DRIVES and not self.imageIsCurrent()
+		if imaging and GOLDEN_IMAGES:
+			self.cloneImage(otherParts)
+		elif imaging and FAT_BUILD:
+			self.buildFilesystems(otherParts)
+		elif imaging:
+			self.populateLive(otherParts)
+		elif IMAGE_DRIVES:
+			self.debug("Not imaging: the drive already has the current image", 1)
+
+		# A cloned golden image or built filesystem already has the tools on it, and the fan-out writer
+		# copies them for everyone
+		if SYNC_DRIVES and not (imaging and (GOLDEN_IMAGES or FAT_BUILD)) and not FANOUT_POPULATE:
+			for part in otherParts:
+				if part.getPartNum() == 1:
+					part.copyTools()
+				else:
+					part.debug( "Not copying to [" + part.getDev() + "] because this is not the first FAT32 partition\n", 2)
+
+	def populateLive(self, otherParts):
+		"""Copies the live folder onto the second partition"""
+		self.unmountAll(otherParts)
+		if FANOUT_POPULATE:
+			self.debug("Leaving the live folder copy to the fan-out writer", 2)
+			return
+		livePartition(otherParts).sync(getDeviceSize(self.getDisk()) / 1000000)
+
+	def buildFilesystems(self, otherParts):
+		"""Writes the TOOLS filesystem (with the tools, when syncing) and the LIVE filesystem with the live
+		folder straight onto the freshly partitioned drive, in place of formatDrive(), sync() and copyTools()
+		@param otherParts - a list of media objects that are the other partitions on the same drive as this partition
+		"""
+		dev = self.getDisk()
+		self.unmountAll(otherParts)
+
+		jobs = [ (1, 'TOOLS', SYNC_DRIVES and TOOLS_SOURCE), (2, 'LIVE', LIVE_SOURCE) ]
+		progress = None
+		if PROGRESS_DIR is not None:
+			total = sourceSize(LIVE_SOURCE)
+			if SYNC_DRIVES:
+				total += sourceSize(TOOLS_SOURCE)
+			progress = progressTracker(self.name, 'populate', total)
+
+		#Don't start writing until this drive's USB link has room for it
+		self.acquireIO("populate")
+		try:
+			for (num, label, source) in jobs:
+				part = partitionNode(dev, num)
+				extraFiles = []
+				if source == TOOLS_SOURCE and TOOLS_MANIFEST is not None and os.path.isfile(TOOLS_MANIFEST_PATH):
+					# so the next tools refresh of this drive is incremental
+					extraFiles.append((TOOLS_MANIFEST_PATH, TOOLS_MANIFEST_NAME))
+				action = "build the " + label + " filesystem on " + part
+				self.debug("Starting: " + action, 1)
+				try:
+					written = fat32.buildFilesystem(part, getDeviceSize(part) / SECTOR_SIZE, label, source, extraFiles,
+													hiddenSectors=partitionStart(part), progress=progress and progress.add)
+				except (IOError, OSError, ValueError), e:
+					self.errorHandler("IOError", e, action, "", True)
+				self.debug("Completed: %s (%d MB written)" % (action, written / 1000000), 1)
+		finally:
+			self.releaseIO()
+		if progress is not None:
+			progress.finish()
+
+	def bootloaderStage(self, otherParts):
+		"""Stage 'bootloader': install syslinux and the MBR"""
 		self.setupSyslinux()
-		
+
+	def verifyStage(self, otherParts):
+		"""Stage 'verify': read back what we wrote straight from the drive (not the page cache), compare it
+		with hashes computed once from the sources, and run a read-only check of the filesystems"""
+		dev = self.getDisk()
+		self.unmountAll(otherParts)
+		imaging = IMAGE_DRIVES and not self.imageIsCurrent()
+		if VERIFY_READBACK and imaging and GOLDEN_IMAGES:
+			imagePath = GOLDEN_IMAGE_PATHS.get(sizeClass(getDeviceSize(dev) / 1000000))
+			self.verifyDrive(dev, imagePath and loadImageMap(imagePath, 'blocks'), "golden image")
+		elif VERIFY_READBACK and imaging:
+			self.verifyDrive(dev, mbrBlocks(), "MBR boot code")
+
+		partNums = []
+		if IMAGE_DRIVES:
+			partNums = [1, 2]
+		elif SYNC_DRIVES:
+			partNums = [1]
+		for num in partNums:
+			command = [ 'dosfsck', '-n', partitionNode(dev, num) ]
+			action = "check the filesystem on " + partitionNode(dev, num)
+			std_out, std_err = self.runCommand(command, action)
+
+		if not VERIFY_READBACK or (imaging and GOLDEN_IMAGES):
+			return
+		if FANOUT_POPULATE:
+			self.debug("Not verifying the files: the fan-out writer copies them after this stage", 2)
+			return
+		if imaging and LIVE_MANIFEST is not None:
+			livePartition(otherParts).verifyCopy(LIVE_MANIFEST, "live folder")
+		if SYNC_DRIVES and TOOLS_MANIFEST is not None:
+			for part in otherParts:
+				if part.getPartNum() == 1:
+					part.verifyCopy(TOOLS_MANIFEST, "tools")
+
+	def verifyDrive(self, dev, blocks, what):
+		"""Reads blocks back from the drive and compares their hashes; a mismatch fails the drive
+		@param dev - the whole-disk device node
+		@param blocks - list of [offset, length, sha1], or None if there is nothing to compare with
+		@param what - what the blocks are, for the report
+		"""
+		if not blocks:
+			self.debug("Nothing to verify the " + what + " on " + dev + " against", 1)
+			return
+		total = sum([ length for (offset, length, digest) in blocks ])
+		started = time()
+		bad = verifyBlocks(dev, blocks)
+		if bad is not None:
+			self.errorHandler("ValueError", "%s at byte %d" % (bad[1], bad[0]), "verify the " + what + " on " + dev)
+			return
+		self.debug("Verified the %s on %s: %d MB read back in %.1fs" % (what, dev, total / 1000000, time() - started), 1)
+
+	def verifyCopy(self, manifest, what):
+		"""Mounts this partition and reads every file in the manifest back; a mismatch fails the drive
+		@param manifest - manifest of the source that was copied
+		@param what - what was copied, for the report
+		"""
+		self.mount()
+		started = time()
+		bad = verifyFiles(self.mountPoint, manifest)
+		self.unmount()
+		if bad:
+			(relPath, reason) = bad[0]
+			self.errorHandler("ValueError", "%d file(s) differ, first %s: %s" % (len(bad), relPath, reason),
+				"verify the " + what + " on " + self.mountPoint)
+			return
+		self.debug("Verified the %s: %d file(s) read back in %.1fs" % (what, len(manifest['files']), time() - started), 1)
+
 	def setupSyslinux(self):
 		"""Install syslinux on this device"""
-		if re.match('[0-9]', self.dev_sd[-1]):
-			dev = self.dev_sd[:-1]
-		else:
-			dev = self.dev_sd
+		dev = self.getDisk()
 		
 		#Make sure we're unmounted before applying Syslinux
 		self.unmount()
@@ -540,140 +1657,178 @@ class media:
 		
 		self.debug("Completed Activating Partition", 3)'''
 		
-		command = [ 'syslinux','-f','-i','-d','/',dev+'2'] #Use the syslinux command to install to the 2nd partition
-		action = "install syslinux on the drive '" + str(dev) + "2'"
+		command = [ 'syslinux','-f','-i','-d','/',partitionNode(dev, 2)] #Use the syslinux command to install to the 2nd partition
+		action = "install syslinux on the drive '" + partitionNode(dev, 2) + "'"
 		
 		#Run the command
 		std_out, std_err = self.runCommand(command, action)
 		
-		# Did NOT use the runCommand method because of special expectedSTDERR handling		
 		command = ['/bin/dd','bs=440','conv=notrunc','count=1','if=mbr.bin','of='+dev] #Install MBRto drive
+		action = "install MBR onto the drive"
 		
-		self.debug("Installing MBR",4)
-		
-		expectedSTDERR = "1+0 records"
-		
-		#Execute the command
-		command_stdout, command_stderr = "", ""
-		try:
-			p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			(command_stdout, command_stderr) = p.communicate()
-			if command_stderr.find(expectedSTDERR) == -1 or ( len(command_stderr) >= 100 ):	
-				raise ValueError, command
-			self.debug("dd's stderr (output):\n" + command_stderr, 2)
-		except OSError, e:
-			self.errorHandler("OSError", e, "attempting to install MBR onto the drive", command_stderr)
-		except ValueError, e:
-			self.errorHandler("ValueError", e, "attempting to install MBR onto the drive", command_stderr)
-		
-		self.debug("Completed installing MBR", 4)
+		# dd reports what it copied on stderr: exactly one whole 440 byte record is expected
+		std_out, std_err = self.runCommand(command, action, expectedErr=r"^1\+0 records (in|out)$|^440 bytes .*copied", debugLvl=4)
 		
 	def sync(self,driveSize):
 		"""Sync the contents of the live folder (for live linux, WinPE, etc) to the media device
 		@param driveSize - the size of this device (to calculate whether we should include lubuntu.iso or not)
 		"""
-		self.unmount()
 		self.mount()
 
+		#Don't start copying until this drive's USB link has room for it
+		self.acquireIO("populate")
+
 		#We'll start with constructing the command to copy the files to the media.
 		if driveSize < 7000:
-			command = [ '/usr/bin/rsync', \
-						'-rtqvv8D', \
-						'/live_directory/', \
+			command = [ '/usr/bin/rsync' ] + rsyncArgs() + [ \
+						LIVE_SOURCE, \
 						self.mountPoint + '/' ]
 		else:
-			command = [ '/usr/bin/rsync', \
-						'-rtqvv8D', \
-						'/live_directory/', \
+			command = [ '/usr/bin/rsync' ] + rsyncArgs() + [ \
+						LIVE_SOURCE, \
 						self.mountPoint + '/' ]
 		action = "copy the contents of the live folder"
 		
 		#Run the actual command		
-		std_out, std_err = self.runCommand(command, action)
+		progress = None
+		if PROGRESS_DIR is not None:
+			progress = progressTracker(self.name, 'live', sourceSize(LIVE_SOURCE))
+		try:
+			std_out, std_err = self.runCommand(command, action, lineHandler=progress and rsyncProgress(progress).line)
+		finally:
+			self.releaseIO()
+		if progress is not None:
+			progress.finish()
 		
 		#Unmount itself after completion
 		self.unmount()
 
+	def acquireIO(self, phase):
+		"""Waits for a free heavy I/O slot on this drive's USB bandwidth domain (if it has one)
+		@param phase - name of the phase that needs the slot, for the debug output
+		"""
+		domain = self.getIODomain()
+		if domain is not None:
+			self.debug("Waiting for an I/O slot on " + domain.key + " to " + phase, 2)
+			domain.acquire()
+
+	def releaseIO(self):
+		"""Gives back the heavy I/O slot taken by acquireIO()"""
+		domain = self.getIODomain()
+		if domain is not None:
+			domain.release()
+
+	def getIODomain(self):
+		"""Returns this drive's USB bandwidth domain, or None if it isn't limited.
+		Drives that were plugged in after the scheduler started are looked up by their topology."""
+		dev = self.dev[:-1]
+		if dev not in IO_DOMAINS:
+			topology = usbTopology(self.getDisk())
+			if topology is not None:
+				IO_DOMAINS[dev] = USB_DOMAINS.get(topology['controller'] + '/' + topology['rootPort'])
+			else:
+				IO_DOMAINS[dev] = None
+		return IO_DOMAINS[dev]
+
+	def getDisk(self):
+		"""Returns the whole-disk device node this partition is on (e.g. /dev/sdb, or /dev/loop0 for /dev/loop0p1)"""
+		return lookupBlockDevice(self.dev_sd).disk
+
+	def cloneImage(self, otherParts):
+		"""Images the drive by streaming its size class' golden image onto it with large sequential writes.
+		Only the allocated extents of the image are written (and the rest discarded, with IMAGE_DISCARD).
+		@param otherParts - a list of media objects that are the other partitions on the same drive as this partition
+		"""
+		dev = self.getDisk()
+		self.unmount()
+		for part in otherParts:
+			part.unmount()
+
+		driveSize = getDeviceSize(dev)
+		imageClass = sizeClass(driveSize / 1000000)
+		imagePath = GOLDEN_IMAGE_PATHS.get(imageClass)
+		if imagePath is None:
+			self.errorHandler("ValueError", "no golden image for size class " + imageClass, "attempting to clone the golden image")
+			return
+		if getDeviceSize(imagePath) > driveSize:
+			self.errorHandler("ValueError", imagePath + " is bigger than the drive", "attempting to clone the golden image")
+			return
+
+		imageSize = getDeviceSize(imagePath)
+		extents = loadImageExtents(imagePath)
+		if extents is None:
+			self.debug("No extent map for " + imagePath + ", writing all of it", 1)
+			extents = [ (0, imageSize) ]
+		toWrite = sum([ length for (offset, length) in extents ])
+		self.debug("Writing golden image %s to %s (%d MB of %d MB)" % (imagePath, dev, toWrite / 1000000, imageSize / 1000000), 1)
+		self.acquireIO("clone")
+		progress = progressTracker(self.name, 'clone', toWrite)
+		try:
+			image = open(imagePath, 'rb')
+			out = os.open(dev, os.O_WRONLY)
+			try:
+				discard = IMAGE_DISCARD and stat.S_ISBLK(os.fstat(out).st_mode)
+				gptStart = driveSize / SECTOR_SIZE * SECTOR_SIZE - GPT_SECTORS * SECTOR_SIZE
+				pos = 0
+				for (offset, length) in extents + [ (gptStart, 0) ]:
+					if discard and offset > pos:
+						discard = discardRange(out, pos, offset - pos)
+					image.seek(offset)
+					os.lseek(out, offset, os.SEEK_SET)
+					remaining = length
+					while remaining:
+						chunk = image.read(min(remaining, IMAGE_WRITE_CHUNK))
+						if not chunk:
+							raise IOError("%s is shorter than its extent map" % imagePath)
+						os.write(out, chunk)
+						progress.add(len(chunk))
+						remaining -= len(chunk)
+					pos = offset + length
+				# a backup GPT at the end of the drive would still describe the old partitions
+				os.lseek(out, gptStart, os.SEEK_SET)
+				os.write(out, '\0' * (GPT_SECTORS * SECTOR_SIZE))
+				os.fsync(out)
+				progress.finish()
+			finally:
+				os.close(out)
+				image.close()
+		except (IOError, OSError), e:
+			self.releaseIO()
+			self.errorHandler("IOError", e, "attempting to write the golden image to " + dev, "", True)
+		self.releaseIO()
+		self.debug("Completed writing golden image to " + dev, 1)
+
+		# Let the kernel pick up the new partition table
+		self.rereadPartitions(dev, [1, 2])
+
 	def repairDrive(self):
 		"""Checks and repairs drive"""
-		if re.match('[0-9]', self.dev_sd[-1]):
-			dev = self.dev_sd[:-1]
-		else:
-			dev = self.dev_sd
+		dev = self.getDisk()
 			
-		command = ['dosfsck', '-a', dev+'1']
+		command = ['dosfsck', '-a', partitionNode(dev, 1)]
 		action = "attempt to repair any disk errors on the volume"
 		
-		std_out, std_err = self.runCommand(command, action)
+		# dosfsck exits with 1 when it found errors and repaired them
+		std_out, std_err = self.runCommand(command, action, okStatus=(0, 1))
 
 	def cleanSlate(self, otherParts):
 		"""Clears partition table to one partition and formats it to fat32 to wipe out old partitions"""
-		if re.match('[0-9]', self.dev_sd[-1]):
-			dev = self.dev_sd[:-1]
-		else:
-			dev = self.dev_sd
-			
-			
-		command = [ '/scripts/gdisk_script.sh',						#Use gdisk to wipe any possible GPT partition
-					 				 dev,																		#use device 'dev' 
-					 				 '/scripts/gdisk_cleanslate.commands']					#use the clean slate gdisk command file
-		action = "wiping all partition tables of: " + dev
-		
-		expectedSTDERR = "Warning: The kernel is still using the old partition table."
-		
-		#Actually execute the partition command
-		std_out, std_err = self.runCommand(command, action, expectedSTDERR)
-		
-		command = [ '/scripts/fdisk_script.sh',						#Use 'fdisk' to re-partition in bash script
-					 				 dev,																		#use device 'dev' 
-					 				 '/scripts/fdisk_cleanslate.commands']					#use the clean slate fdisk command file
-		action = "partition this drive: " + dev
-		
-		expectedSTDERR = "Warning: invalid flag 0x0000 of partition table 4 will be corrected by w(rite)\n"
+		dev = self.getDisk()
 
-		#Actually execute the partition command
-		std_out, std_err = self.runCommand(command, action, expectedSTDERR)
-		
-		#Let's just make sure we're unmounted
-		self.unmount()		
-		for part in otherParts:
-			part.unmount()
-		
-		#If a drive began with only one partition, we don't have it listed as in 'otherParts' yet
-		# so this will manually try to unmount every partition under the same device /dev/sdX
-		command = [ '/bin/find', '/dev/' ]
-		action = "getting a list of all partitions for device: " + dev
-		
-		std_out, std_err = self.runCommand(command, action)
-		parts = std_out.split()
-		for part in parts:
-			if part != dev and part.startswith(dev):
-				command = [ '/bin/umount', '-fv', part ]
-				action = "unmount this (these?) mountpoint(s): \"" + part +"\""
+		#Let's just make sure nothing on the drive is mounted, including partitions we have no media object for
+		self.unmountAll(otherParts)
+		self.unmountDisk(dev)
 
-				#This actually executes the command.	
-				std_out, std_err = self.runCommand(command, action,expectedErr="not mounted\n")
-		
-				sleep(10) # Sleep for 3 seconds to make sure it's completed the unmount process
-	
-		# Ok, since it's a dummy let's force it to rescan the usb drive partition table
-		command = [ '/sbin/hdparm', #use hdparm
-								 '-z',	   #to force a partition table re-scan
-								 dev ]	   #on the device
-		action = "rescan the partition table for drive: " + dev
-		
-		std_out, std_err = self.runCommand(command, action)
-		
-		self.unmount()
-		for part in otherParts:
-			part.unmount()		
+		#One partition spanning the drive, written over any MBR and both copies of any GPT
+		totalSectors = getDeviceSize(dev) / SECTOR_SIZE
+		self.writePartitions(dev, [ (PARTITION_ALIGN_SECTORS, totalSectors - PARTITION_ALIGN_SECTORS, False) ], [1])
 
 		command = [ 	'/sbin/mkdosfs',	# use 'mkfs.vfat' to format the partition as fat32 for TOOL
 								'-n',		# set the name of the partition
 								'CLEAN_BABY',	# name = TOOLS
 								'-F',		# FAT size
 								'32',		# FAT size = 32 (FAT32)	
-								dev + '1'		# Format the whole thing
+								partitionNode(dev, 1)		# Format the whole thing
 							]
 		action = "wipe drive: " + dev
 		
@@ -683,106 +1838,61 @@ class media:
 	def partitionDrive(self, otherParts):
 		"""Partitions the drive this partition is located on
 		@param otherParts - a list of other partitions on this drive so that we can unmount them all
+		@returns the size of the drive in MB
 		"""
-		if re.match('[0-9]', self.dev_sd[-1]):
-			dev = self.dev_sd[:-1]
-		else:
-			dev = self.dev_sd
-		
-		command = [ '/sbin/fdisk', 
-					'-l',
-					dev
-				  ]
-				  
-		action = "get the size of drive: " + dev
-		
-		std_out, std_err = self.runCommand(command, action)
-		if not std_out:
-			self.errorHandler("ValueError", command, action, ' '.join(command), True)
-		
-		# split the output from fdisk by new line first, and take the second line (which contains the size info)
-		line = std_out.split("\n")[1]
-		# split the line by spaces " " and take the fourth item, which should contain the number of bytes
-		size = line.split(" ")[4]
-		# Make sure we *actually* got a number for the number of bytes
-		if not size.isdigit():
-			self.errorHandler("ValueError", "Size is not a number!!! [" + size + "]", "attempting to parse disk size", "", True)
-
-		numSize = int(size) / 1000000 # turn bytes into MB
-		if numSize < 7000:
-			toolSize = numSize - 1536 # LINUX_PARTITION_SIZE_MB = 1536 # for 4gb drives
-		else:
-			toolSize = numSize - 2436 # LINUX_PARTITION_SIZE_MB = 2436 # for 8gb drives
-		fdiskFile = self.buildFdiskCommandFile( toolSize )
-		
-		
-		command = [ '/fdisk_script.sh',	#Use 'fdisk' to re-partition in bash script
-					 dev,						#use device 'dev' 
-					 fdiskFile]					#use the correct fdisk command file (4gb or 8gb drives)
-		action = "partition drive: " + dev
-		
-		expectedSTDERR = "Warning: invalid flag 0x0000 of partition table 4 will be corrected by w(rite)\n"
-		
-		std_out, std_err = self.runCommand(command, action, expectedSTDERR)
-		
-		self.unmount()		
-		for part in otherParts:
-			part.unmount()
-		
+		dev = self.getDisk()
+
+		try:
+			numSize = getDeviceSize(dev) / 1000000 # turn bytes into MB
+		except OSError, e:
+			self.errorHandler("OSError", e, "attempting to get the size of drive: " + dev, "", True)
+
+		self.unmountAll(otherParts)
 		#If a drive began with only one partition, we don't have it listed as in 'otherParts' yet
-		# so this will manually try to unmount every partition under the same device /dev/sdX
-		command = [ '/bin/find', '/dev/' ]
-		action = "getting a list of all partitions for device: " + dev
-		
-		std_out, std_err = self.runCommand(command, action)
-		parts = std_out.split()
-		for part in parts:
-			if part != dev and part.startswith(dev):
-				command = [ '/bin/umount', '-fv', part ]
-				action = "unmount this (these?) mountpoint(s): \"" + part +"\""
+		self.unmountDisk(dev)
+
+		#Partition 1 is the rest of the disk fat32 for tools, partition 2 the bootable LIVE partition
+		self.writePartitions(dev, partitionLayout(numSize), [1, 2])
 
-				#This actually executes the command.	
-				std_out, std_err = self.runCommand(command, action,expectedErr="not mounted\n")
-		
-				sleep(10) # Sleep for 3 seconds to make sure it's completed the unmount process
-		
-		
-		# Ok, since it's a dummy let's force it to rescan the usb drive partition table
-		command = [ '/sbin/hdparm', #use hdparm
-					 '-z',	   #to force a partition table re-scan
-					 dev ]	   #on the device
-		action = "rescan partition table for: " + dev
-		
-		std_out, std_err = self.runCommand(command, action)
-		
 		return numSize
-		
-	def buildFdiskCommandFile( self, toolSize ):
+
+	def unmountDisk(self, dev):
+		"""Unmounts every mounted partition of a drive, including ones we have no media object for
+		@param dev - the whole-disk device node (e.g. /dev/sdb)
+		"""
+		for part in lookupBlockDevice(dev).partitions():
+			self.unmountNode(part.node)
+
+	def writePartitions(self, dev, layout, partNums):
+		"""Writes a partition table onto the drive and waits for the kernel to pick it up
+		@param dev - the whole-disk device node (e.g. /dev/sdb)
+		@param layout - list of (startSector, numSectors, bootable), see partitionLayout()
+		@param partNums - the partition numbers that should appear
+		"""
+		action = "partition drive: " + dev
+		self.debug("Starting: " + action, 1)
 		try:
-			defaultCommands = open( '/fdisk_4gb.commands', 'r' ) # open the default fdisk commands file for readonly
-			commandsFileName = '/tmp/fdiskCommands'
-			try:
-				commandsFile = open( commandsFileName, 'w' ) # open the new fdisk commands file for writing
-				for line in defaultCommands.readlines():
-					if line.startswith("+"):
-						commandsFile.write("+" + str(toolSize) + "MB\n")
-					else:
-						commandsFile.write(line)
-				commandsFile.close()
-			except IOError, e:
-				self.errorHandler("IOError", e, "attempting to open the custom fdisk commands file", "", True)
-			
-			defaultCommands.close()		
-		except IOError, e:
-			self.errorHandler("IOError", e, "attempting to open the default fdisk commands file", "", True)
+			writePartitionTable(dev, layout)
+		except (IOError, OSError), e:
+			self.errorHandler("IOError", e, action, "", True)
+		self.debug("Completed: " + action, 1)
+		self.rereadPartitions(dev, partNums)
+
+	def rereadPartitions(self, dev, partNums):
+		"""Asks the kernel to re-read the drive's partition table and waits for the partitions to appear
+		@param dev - the whole-disk device node (e.g. /dev/sdb)
+		@param partNums - the partition numbers that should appear
+		"""
+		try:
+			rereadPartitionTable(dev)
+		except (IOError, OSError), e:
+			self.errorHandler("IOError", e, "rescan the partition table for drive: " + dev, "", True)
+		self.waitPartitions(dev, partNums)
+		# the partitions (and their sizes and offsets) are new now
+		forgetBlockDevice(dev)
 
-		return commandsFileName
-		
 	def formatDrive(self):
-		if re.match('[0-9]', self.dev_sd[-1]):
-			dev = self.dev_sd[:-1]
-		else:
-			dev = self.dev_sd
+		dev = self.getDisk()
 
 		# Make sure it's unmounted before formatting as fat32 (just in case)
 		self.debug("Unmounting before FAT format....", 2)
@@ -793,9 +1903,9 @@ class media:
 					'TOOLS',	# name = TOOLS
 					'-F',		# FAT size
 					'32',		# FAT size = 32 (FAT32)	
-					dev + '1'	# use the FIRST partition on the device (windows will only mount first partition)
+					partitionNode(dev, 1)	# use the FIRST partition on the device (windows will only mount first partition)
 					]
-		action = "format partition as fat32: " + dev + '1'
+		action = "format partition as fat32: " + partitionNode(dev, 1)
 		
 		#Actually execute the format command
 		std_out, std_err = self.runCommand(command, action)
@@ -809,42 +1919,101 @@ class media:
 					'LIVE',	# name = LIVE
 					'-F',		# FAT size
 					'32',		# FAT size = 32 (FAT32)	
-					dev + '2'	# use the second partition
+					partitionNode(dev, 2)	# use the second partition
 					]
-		action = "format partition as fat32: " + dev + '2'
+		action = "format partition as fat32: " + partitionNode(dev, 2)
 		
 		#Actually execute the format command
 		std_out, std_err = self.runCommand(command, action)
 	
 	def copyTools(self):
-		
+		"""Brings the tools on this partition up to date with TOOLS_SOURCE.
+		If the partition has a manifest from an earlier run, only the files that changed are copied or
+		deleted; otherwise everything is rsynced. A new manifest is written after a successful copy.
+		"""
 		#First, let's ensure that the drives are mounted properly.
-		self.unmount()
 		self.mount()
-		
 
-		#We'll start with constructing the command to copy the files to the media.
-		command = [ '/usr/bin/rsync', '-rtqvv8D', \
-					'--delete', \
-					'/local_tools/',\
-					self.mountPoint ]
-		action = "copy tools to this mountpoint: " + self.mountPoint
-		
-		#This actually executes the command.
-		std_out, std_err = self.runCommand(command, action)
+		manifestPath = os.path.join(self.mountPoint, TOOLS_MANIFEST_NAME)
+		driveManifest = None
+		if TOOLS_MANIFEST is not None:
+			driveManifest = loadManifest(manifestPath)
+
+		#Don't start copying until this drive's USB link has room for it
+		self.acquireIO("tools")
+		progress = None
+		if PROGRESS_DIR is not None:
+			progress = progressTracker(self.name, 'tools', sourceSize(TOOLS_SOURCE))
+		try:
+			if driveManifest is not None:
+				self.refreshTools(driveManifest, TOOLS_MANIFEST, progress)
+			else:
+				#We'll start with constructing the command to copy the files to the media.
+				command = [ '/usr/bin/rsync' ] + rsyncArgs() + [ \
+							'--delete', \
+							TOOLS_SOURCE,\
+							self.mountPoint ]
+				action = "copy tools to this mountpoint: " + self.mountPoint
+				
+				#This actually executes the command.
+				std_out, std_err = self.runCommand(command, action, lineHandler=progress and rsyncProgress(progress).line)
+		finally:
+			self.releaseIO()
+		if progress is not None:
+			progress.finish()
+
+		if TOOLS_MANIFEST is not None and self.name not in failed_drives:
+			try:
+				saveManifest(TOOLS_MANIFEST, manifestPath)
+			except (IOError, OSError), e:
+				self.errorHandler("IOError", e, "write the tools manifest to " + manifestPath)
 		
 		self.unmount()
-		
-def enumerateDrives():
-	#This is the command that we will use to get a list of the drives that the OS has mounted.
-	command = [ '/bin/find', MEDIA_DEV_ROOT, '-type', 'l']
-	action = "enumerate drives"
 
-	#This actually executes the command.
-	(std_out, std_err) = runCommand(command=command, actionMsg=action, expectedErr="", exitOnFail=True)
-	
-	#We'll now get a string of each mountpoint, each on a new line; but we'll split those lines up into an array 
-	result = string.split(std_out)
+	def refreshTools(self, driveManifest, sourceManifest, progress=None):
+		"""Copies/deletes only the files that differ between the drive's manifest and the source's
+		@param driveManifest - manifest of what is on this partition
+		@param sourceManifest - manifest of TOOLS_SOURCE
+		@param progress - (optional) progressTracker to report the copied bytes to
+		"""
+		driveFiles = driveManifest['files']
+		sourceFiles = sourceManifest['files']
+		copied, deleted = 0, 0
+		try:
+			for relPath in sorted(driveFiles):
+				if relPath not in sourceFiles:
+					path = os.path.join(self.mountPoint, relPath)
+					if os.path.lexists(path):
+						os.remove(path)
+					deleted += 1
+			for relDir in sorted(driveManifest['dirs'], reverse=True):
+				path = os.path.join(self.mountPoint, relDir)
+				if relDir not in sourceManifest['dirs'] and os.path.isdir(path):
+					shutil.rmtree(path)
+			for relDir in sourceManifest['dirs']:
+				path = os.path.join(self.mountPoint, relDir)
+				if not os.path.isdir(path):
+					os.makedirs(path)
+			for relPath in sorted(sourceFiles):
+				(size, mtime, digest) = sourceFiles[relPath]
+				old = driveFiles.get(relPath)
+				if old and old[0] == size and old[2] == digest:
+					continue
+				dest = os.path.join(self.mountPoint, relPath)
+				shutil.copyfile(os.path.join(TOOLS_SOURCE, relPath), dest)
+				os.utime(dest, (mtime, mtime))
+				copied += 1
+				if progress is not None:
+					progress.add(size)
+		except (IOError, OSError), e:
+			self.errorHandler("IOError", e, "refresh the tools on " + self.mountPoint)
+		self.debug("Tools refresh: %d file(s) copied, %d deleted, %d unchanged" % (copied, deleted,
+			len(sourceFiles) - copied), 1)
+
+def enumerateDrives():
+	#Get a list of the partition links for the drives that the OS has found.
+	present = enumeratePartitions(MEDIA_DEV_ROOT)
+	result = [ link for dev in sorted(present, key=naturalKey) for link in present[dev] ]
 
 	#We're going to want to name each drive so we have something logical for each drive's mountpoint.
 	#We'll just call them drive0, drive1, drive[...]	
@@ -855,31 +2024,2228 @@ def enumerateDrives():
 		currentDrive += 1
 	numDrives = currentDrive
 
+def partitionNode(disk, num):
+	"""Returns the device node of partition 'num' on a disk: /dev/sdb -> /dev/sdb1, /dev/loop0 -> /dev/loop0p1"""
+	if re.match('[0-9]', disk[-1]):
+		return disk + 'p' + str(num)
+	return disk + str(num)
+
+def partitionStart(part):
+	"""Returns the first sector of a partition on its drive (from sysfs), or 0 if it isn't known
+	@param part - the partition's device node (e.g. /dev/sdb2)
+	"""
+	return lookupBlockDevice(part).start
+
+class blockDevice:
+	"""A block device (a whole drive or one of its partitions) as sysfs describes it: the drive a partition
+	is on, a drive's partitions, the size and block sizes, and the drive's removable flag, vendor, model,
+	serial number and USB path. Everything is read in-process from SYSFS_ROOT; nothing is parsed out of
+	another tool's output. A node sysfs doesn't know (an image file, or a plain file standing in for a
+	drive) is described from its name and size instead.
+	"""
+	def __init__(self, node):
+		"""
+		@param node - the device node (or a link to it, or a file)
+		"""
+		realNode = os.path.realpath(node)
+		self.name = os.path.basename(realNode)
+		self.node = realNode
+		self.sysfsPath = os.path.realpath(os.path.join(SYSFS_ROOT, 'class', 'block', self.name))
+		self.known = os.path.isdir(self.sysfsPath)
+		self.number, self.start = None, 0
+		self.removable = False
+		self.vendor, self.model, self.serial = None, None, None
+		self.idVendor, self.idProduct, self.usbPath, self.usbDir = None, None, None, None
+		if not self.known:
+			self.disk = diskNodeOf(realNode)
+			self.size = nodeSize(realNode)
+			self.logicalBlockSize = self.physicalBlockSize = nodeBlockSize(realNode, BLKSSZGET)
+			return
+		self.node = os.path.join(DEV_ROOT, self.name)
+		diskPath = self.sysfsPath
+		if os.path.exists(os.path.join(self.sysfsPath, 'partition')):
+			diskPath = os.path.dirname(self.sysfsPath)
+			self.number = sysfsInt(os.path.join(self.sysfsPath, 'partition'))
+			self.start = sysfsInt(os.path.join(self.sysfsPath, 'start')) or 0
+		self.disk = os.path.join(DEV_ROOT, os.path.basename(diskPath))
+		self.diskPath = diskPath
+		# sysfs sizes are always in 512 byte units, whatever the device's block size
+		self.size = (sysfsInt(os.path.join(self.sysfsPath, 'size')) or 0) * 512
+		self.logicalBlockSize = sysfsInt(os.path.join(diskPath, 'queue', 'logical_block_size')) or SECTOR_SIZE
+		self.physicalBlockSize = sysfsInt(os.path.join(diskPath, 'queue', 'physical_block_size')) or self.logicalBlockSize
+		self.removable = readSysfsFile(os.path.join(diskPath, 'removable')) == '1'
+		self.vendor = readSysfsFile(os.path.join(diskPath, 'device', 'vendor'))
+		self.model = readSysfsFile(os.path.join(diskPath, 'device', 'model'))
+		# the USB device is the last directory named like a USB path (e.g. '2-1.3') above the drive
+		components = diskPath.split('/')
+		ports = [ i for i in range(len(components)) if re.match(r'^[0-9]+-[0-9.]+$', components[i]) ]
+		if ports:
+			self.usbPath = components[ports[-1]]
+			self.usbDir = '/'.join(components[:ports[-1] + 1])
+			self.serial = readSysfsFile(os.path.join(self.usbDir, 'serial'))
+			self.idVendor = readSysfsFile(os.path.join(self.usbDir, 'idVendor'))
+			self.idProduct = readSysfsFile(os.path.join(self.usbDir, 'idProduct'))
+
+	def partitions(self):
+		"""Returns the partitions the kernel knows on this device's drive, in partition number order"""
+		if not self.known:
+			return []
+		parts = []
+		try:
+			names = os.listdir(self.diskPath)
+		except OSError:
+			# the drive has been unplugged
+			return []
+		for name in names:
+			if os.path.exists(os.path.join(self.diskPath, name, 'partition')):
+				parts.append(lookupBlockDevice(os.path.join(DEV_ROOT, name)))
+		return sorted(parts, key=lambda part: part.number)
+
+def lookupBlockDevice(node):
+	"""Returns the blockDevice for a device node (or a link to it), describing it from sysfs the first time
+	@param node - the device node, e.g. /dev/sdb1 or /dev/usb1part1
+	"""
+	name = os.path.basename(os.path.realpath(node))
+	device = BLOCK_DEVICES.get(name)
+	if device is None:
+		device = blockDevice(node)
+		if device.known:
+			BLOCK_DEVICES[name] = device
+	return device
+
+def forgetBlockDevice(node):
+	"""Forgets what we know about a drive and its partitions (e.g. after its partition table changed)
+	@param node - the drive's (or any of its partitions') device node
+	"""
+	disk = os.path.basename(lookupBlockDevice(node).disk)
+	for (name, device) in BLOCK_DEVICES.items():
+		if name == disk or os.path.basename(device.disk) == disk:
+			BLOCK_DEVICES.pop(name, None)
+
+def forgetBlockDevices():
+	"""Forgets every device (drives have been plugged in or removed)"""
+	BLOCK_DEVICES.clear()
+
+def diskNodeOf(node):
+	"""Returns the whole-disk node of a partition node from its name alone: /dev/sdb1 -> /dev/sdb,
+	/dev/loop0p1 -> /dev/loop0 (for nodes sysfs doesn't know)"""
+	match = re.match(r'^(.*[0-9])p[0-9]+$', node)
+	if match:
+		return match.group(1)
+	if re.match('[0-9]', node[-1]):
+		return node[:-1]
+	return node
+
+def nodeSize(node):
+	"""Returns the size in bytes of a device node or file by seeking to its end (0 if it can't be opened)"""
+	try:
+		fd = os.open(node, os.O_RDONLY)
+	except OSError:
+		return 0
+	try:
+		return os.lseek(fd, 0, os.SEEK_END)
+	finally:
+		os.close(fd)
+
+def nodeBlockSize(node, request):
+	"""Returns a block size of a block device sysfs doesn't describe (BLKSSZGET or BLKPBSZGET), or
+	SECTOR_SIZE for anything else"""
+	try:
+		fd = os.open(node, os.O_RDONLY)
+	except OSError:
+		return SECTOR_SIZE
+	try:
+		if stat.S_ISBLK(os.fstat(fd).st_mode):
+			return struct.unpack('i', fcntl.ioctl(fd, request, struct.pack('i', 0)))[0]
+		return SECTOR_SIZE
+	except IOError:
+		return SECTOR_SIZE
+	finally:
+		os.close(fd)
+
+def sysfsInt(path):
+	"""Returns a sysfs attribute as an integer, or None if it can't be read"""
+	try:
+		return int(readSysfsFile(path))
+	except (TypeError, ValueError):
+		return None
+
+def sizeClass(sizeMB):
+	"""Returns the size class ('4gb' or '8gb') of a drive, which decides how big its LIVE partition is
+	@param sizeMB - size of the drive in MB
+	"""
+	if sizeMB < 7000:
+		return '4gb'
+	return '8gb'
+
+def getDeviceSize(dev):
+	"""Returns the size in bytes of a block device (or image file)
+	@param dev - the device node or file
+	"""
+	device = lookupBlockDevice(dev)
+	if not device.known:
+		# a file: seek to its end (which, unlike sysfs, fails if it can't be opened)
+		fd = os.open(dev, os.O_RDONLY)
+		try:
+			return os.lseek(fd, 0, os.SEEK_END)
+		finally:
+			os.close(fd)
+	return device.size
+
+def partitionLayout(sizeMB):
+	"""Computes the two partition layout used on every drive: partition 1 is TOOLS (the rest of
+	the drive, so Windows mounts it), partition 2 is the bootable LIVE partition at the end.
+	@param sizeMB - size of the drive in MB
+	@returns a list of (startSector, numSectors, bootable) for partitions 1 and 2
+	"""
+	totalSectors = sizeMB * 1000000 / SECTOR_SIZE
+	toolSectors = (sizeMB - LIVE_PARTITION_SIZE_MB[sizeClass(sizeMB)]) * 1000000 / SECTOR_SIZE
+	# keep the LIVE partition aligned as well
+	liveStart = (PARTITION_ALIGN_SECTORS + toolSectors) / PARTITION_ALIGN_SECTORS * PARTITION_ALIGN_SECTORS
+	return [ (PARTITION_ALIGN_SECTORS, liveStart - PARTITION_ALIGN_SECTORS, False),
+			 (liveStart, totalSectors - liveStart, True) ]
+
+def mbrPartitionTable(layout, partType=0x0c):
+	"""Builds the 64 byte MBR partition table (plus the 0x55AA signature) for a layout
+	@param layout - list of (startSector, numSectors, bootable), see partitionLayout()
+	@param partType - (optional) partition type byte (default: 0x0c, FAT32 LBA)
+	@returns the 66 bytes that belong at offset 446 of the MBR
+	"""
+	table = ''
+	for (start, sectors, bootable) in layout:
+		status = 0x00
+		if bootable:
+			status = 0x80
+		# CHS values of 0xFEFFFF tell the BIOS to use the LBA fields
+		table += struct.pack('<B3sB3sII', status, '\xfe\xff\xff', partType, '\xfe\xff\xff', start, sectors)
+	table += '\0' * (64 - len(table))
+	return table + '\x55\xaa'
+
+def writePartitionTable(dev, layout, bootCode='mbr.bin'):
+	"""Writes a fresh MBR (boot code, disk signature and partition table) to a drive or image. Any GPT
+	is destroyed too: the MBR and the sectors of the primary GPT go out in a single write at the start,
+	and the backup GPT at the end of the drive is zeroed.
+	@param dev - the whole-disk device node (or image file)
+	@param layout - list of (startSector, numSectors, bootable), see partitionLayout()
+	@param bootCode - (optional) file holding the 440 bytes of MBR boot code (zeros if it can't be read)
+	"""
+	code = ''
+	try:
+		f = open(bootCode, 'rb')
+		code = f.read(440)
+		f.close()
+	except IOError:
+		pass
+	mbr = code.ljust(DISK_SIGNATURE_OFFSET, '\0') + os.urandom(4) + '\0\0' + mbrPartitionTable(layout)
+	fd = os.open(dev, os.O_WRONLY)
+	try:
+		size = os.lseek(fd, 0, os.SEEK_END)
+		os.lseek(fd, 0, os.SEEK_SET)
+		# the primary GPT area and any old image stamp after it
+		os.write(fd, mbr + '\0' * (DISK_STAMP_SECTOR * SECTOR_SIZE))
+		if size >= (1 + 2 * GPT_SECTORS) * SECTOR_SIZE:
+			os.lseek(fd, size / SECTOR_SIZE * SECTOR_SIZE - GPT_SECTORS * SECTOR_SIZE, os.SEEK_SET)
+			os.write(fd, '\0' * (GPT_SECTORS * SECTOR_SIZE))
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def rereadPartitionTable(dev):
+	"""Asks the kernel to re-read a drive's partition table (does nothing for image files)
+	@param dev - the whole-disk device node
+	"""
+	fd = os.open(dev, os.O_RDONLY)
+	try:
+		if stat.S_ISBLK(os.fstat(fd).st_mode):
+			fcntl.ioctl(fd, BLKRRPART)
+	finally:
+		os.close(fd)
+
+def copyIntoImage(source, image, offset):
+	"""Copies a file into an image at 'offset', leaving all-zero chunks as holes so the image stays sparse
+	@param source - the file to copy (e.g. a partition image)
+	@param image - open image file object to copy into
+	@param offset - byte offset in the image
+	"""
+	src = open(source, 'rb')
+	try:
+		pos = offset
+		chunk = src.read(IMAGE_WRITE_CHUNK)
+		while chunk:
+			if chunk.count('\0') != len(chunk):
+				image.seek(pos)
+				image.write(chunk)
+			pos += len(chunk)
+			chunk = src.read(IMAGE_WRITE_CHUNK)
+	finally:
+		src.close()
+
+def buildGoldenImage(imageClass, sizeMB, includeTools=False):
+	"""Builds a partitioned, formatted and populated disk image for a size class, entirely in files
+	(no drive, loop device or mount needed) using the fat32 module and syslinux on partition images.
+	@param imageClass - the size class to build ('4gb' or '8gb')
+	@param sizeMB - size of the image in MB (no bigger than the smallest drive it will be cloned to)
+	@param includeTools - (optional) also copy the tools onto the TOOLS partition
+	@returns the path of the image
+	"""
+	layout = partitionLayout(sizeMB)
+	if not os.path.isdir(GOLDEN_IMAGE_DIR):
+		os.makedirs(GOLDEN_IMAGE_DIR)
+	imagePath = os.path.join(GOLDEN_IMAGE_DIR, 'golden-%s-%dmb.img' % (imageClass, sizeMB))
+	debug("Building the " + imageClass + " golden image: " + imagePath, 1)
+
+	partFiles = []
+	for (num, label, source) in [ (1, 'TOOLS', includeTools and TOOLS_SOURCE), (2, 'LIVE', LIVE_SOURCE) ]:
+		(start, sectors, bootable) = layout[num - 1]
+		partFile = imagePath + '.part' + str(num)
+		partFiles.append(partFile)
+		f = open(partFile, 'wb')
+		f.truncate(sectors * SECTOR_SIZE) # sparse
+		f.close()
+
+		extraFiles = []
+		if source == TOOLS_SOURCE and TOOLS_MANIFEST is not None:
+			# so the first tools refresh of a cloned drive is incremental
+			saveManifest(TOOLS_MANIFEST, os.path.join(GOLDEN_IMAGE_DIR, TOOLS_MANIFEST_NAME))
+			extraFiles.append((os.path.join(GOLDEN_IMAGE_DIR, TOOLS_MANIFEST_NAME), TOOLS_MANIFEST_NAME))
+		try:
+			fat32.buildFilesystem(partFile, sectors, label, source, extraFiles,
+								  hiddenSectors=start)	# hidden sectors = where this partition starts on the drive
+		except (IOError, OSError, ValueError), e:
+			errorHandler("IOError", e, "build the " + label + " partition of the golden image", "", True)
+
+		if bootable:
+			command = [ 'syslinux', '-f', '-i', '-d', '/', partFile ]
+			runCommand(command, "install syslinux on the golden image " + label + " partition", exitOnFail=True)
+		checkFilesystem(partFile, "the golden image " + label + " partition")
+
+	image = open(imagePath, 'wb')
+	image.truncate(sizeMB * 1000000)
+	image.close()
+	writePartitionTable(imagePath, layout)
+	image = open(imagePath, 'r+b')
+	try:
+		for (partFile, (start, sectors, bootable)) in zip(partFiles, layout):
+			copyIntoImage(partFile, image, start * SECTOR_SIZE)
+	finally:
+		image.close()
+	for partFile in partFiles:
+		os.remove(partFile)
+
+	extents = imageExtents(imagePath, layout)
+	saveImageMap(imagePath, 'extents', extents)
+	# computed once here, so each drive's verify stage only reads the drive
+	saveImageMap(imagePath, 'blocks', blockHashes(imagePath, extents))
+	debug("Finished building the %s golden image (%d MB of %d MB allocated)" % (imageClass,
+		sum([ length for (offset, length) in extents ]) / 1000000, sizeMB), 1)
+	return imagePath
+
+def findCommand(name):
+	"""Returns the path of a command on the PATH, or None if it isn't installed"""
+	for directory in os.environ.get('PATH', '/usr/sbin:/usr/bin:/sbin:/bin').split(':'):
+		path = os.path.join(directory, name)
+		if os.path.isfile(path) and os.access(path, os.X_OK):
+			return path
+	return None
+
+def checkFilesystem(path, what):
+	"""Has dosfstools check a FAT32 filesystem the fat32 module built (read-only), exiting if it finds
+	anything wrong. Skipped when fsck.vfat isn't installed.
+	@param path - the partition image or device
+	@param what - what it is, for the messages
+	"""
+	if findCommand('fsck.vfat') is None:
+		debug("fsck.vfat isn't installed; not checking the filesystem of " + what, 1)
+		return
+	runCommand([ 'fsck.vfat', '-n', path ], "check the filesystem of " + what, exitOnFail=True)
+
+def imageExtents(imagePath, layout):
+	"""Works out which byte ranges of a disk image have to be written to a drive: the MBR and the
+	primary GPT area and image stamp sector (which must be overwritten) and the allocated parts of each
+	FAT32 partition
+	@param imagePath - the disk image
+	@param layout - its partition layout, see partitionLayout()
+	@returns a sorted list of aligned, coalesced (offset, length)
+	"""
+	extents = [ (0, (DISK_STAMP_SECTOR + 1) * SECTOR_SIZE) ]
+	for (start, sectors, bootable) in layout:
+		extents += fat32.allocatedExtents(imagePath, start * SECTOR_SIZE)
+	return coalesceExtents(extents, getDeviceSize(imagePath))
+
+def coalesceExtents(extents, limit):
+	"""Sorts byte ranges, rounds them out to EXTENT_ALIGN and merges the ones less than EXTENT_MERGE_GAP apart
+	@param extents - list of (offset, length)
+	@param limit - the size of the image (nothing is extended past it)
+	"""
+	merged = []
+	for (offset, length) in sorted(extents):
+		start = offset / EXTENT_ALIGN * EXTENT_ALIGN
+		end = min(limit, (offset + length + EXTENT_ALIGN - 1) / EXTENT_ALIGN * EXTENT_ALIGN)
+		if merged and start <= merged[-1][1] + EXTENT_MERGE_GAP:
+			merged[-1][1] = max(merged[-1][1], end)
+		else:
+			merged.append([start, end])
+	return [ (start, end - start) for (start, end) in merged ]
+
+def saveImageMap(imagePath, name, data):
+	"""Writes a map of an image (its 'extents' or block hashes, 'blocks') next to it, as imagePath + '.' + name"""
+	st = os.stat(imagePath)
+	tmpPath = imagePath + '.' + name + '.tmp'
+	f = open(tmpPath, 'w')
+	try:
+		json.dump({ 'size' : st.st_size, 'mtime' : st.st_mtime, name : data }, f)
+	finally:
+		f.close()
+	os.rename(tmpPath, imagePath + '.' + name)
+
+def loadImageMap(imagePath, name):
+	"""Reads a map written by saveImageMap(), returning None if there is none or the image changed since"""
+	try:
+		f = open(imagePath + '.' + name, 'r')
+		try:
+			imageMap = json.load(f)
+		finally:
+			f.close()
+		st = os.stat(imagePath)
+	except (IOError, OSError, ValueError):
+		return None
+	if imageMap.get('size') != st.st_size or imageMap.get('mtime') != st.st_mtime:
+		return None
+	return imageMap.get(name)
+
+def loadImageExtents(imagePath):
+	"""Reads the extent map of an image as a list of (offset, length), or None"""
+	extents = loadImageMap(imagePath, 'extents')
+	if extents is None:
+		return None
+	return [ (offset, length) for (offset, length) in extents ]
+
+def blockHashes(path, extents, blockSize=None):
+	"""Hashes the extents of a file in blocks, for verifyBlocks()
+	@param path - the image (or other file) the blocks will be compared with
+	@param extents - list of (offset, length) to cover
+	@param blockSize - (optional) bytes per block (default: VERIFY_BLOCK)
+	@returns a list of [offset, length, sha1]
+	"""
+	blockSize = blockSize or VERIFY_BLOCK
+	blocks = []
+	f = open(path, 'rb')
+	try:
+		for (offset, length) in extents:
+			f.seek(offset)
+			for blockOffset in xrange(offset, offset + length, blockSize):
+				data = f.read(min(blockSize, offset + length - blockOffset))
+				blocks.append([ blockOffset, len(data), hashlib.sha1(data).hexdigest() ])
+	finally:
+		f.close()
+	return blocks
+
+def mbrBlocks():
+	"""The block list checking a drive's MBR boot code against mbr.bin (empty if it can't be read)"""
+	try:
+		f = open('mbr.bin', 'rb')
+		code = f.read(440)
+		f.close()
+	except IOError:
+		return []
+	return [ [ 0, len(code), hashlib.sha1(code).hexdigest() ] ]
+
+def libc():
+	"""The C library, with pread64() set up for directReader"""
+	global LIBC
+	if LIBC is None:
+		# only published once set up: a verify thread calling pread64() without its argtypes would
+		# pass the buffer address as a 32 bit int
+		lib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		lib.pread64.argtypes = [ ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong ]
+		lib.pread64.restype = ctypes.c_ssize_t
+		LIBC = lib
+	return LIBC
+
+class directReader:
+	"""Reads a file or device with O_DIRECT into a page aligned buffer, so the data comes from the device
+	and not the page cache (falls back to ordinary reads where O_DIRECT isn't supported). The read itself
+	runs without the GIL, so several readers in threads overlap."""
+	def __init__(self, path, blockSize=None):
+		"""
+		@param path - the file or device node to read
+		@param blockSize - (optional) the largest read that will be asked for (default: VERIFY_BLOCK)
+		"""
+		self.size = (blockSize or VERIFY_BLOCK) + 2 * DIRECT_IO_ALIGN
+		# anonymous maps are page aligned
+		self.buf = mmap.mmap(-1, self.size)
+		self.address = ctypes.addressof(ctypes.c_char.from_buffer(self.buf))
+		self.fd = None
+		try:
+			self.open(path)
+		except OSError:
+			self.buf.close()
+			raise
+
+	def open(self, path):
+		"""Switches to reading another file or device, keeping the buffer"""
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		self.direct = True
+		try:
+			self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+		except OSError, e:
+			if e.errno != errno.EINVAL:
+				raise
+			self.direct = False
+			self.fd = os.open(path, os.O_RDONLY)
+
+	def read(self, offset, length):
+		"""Returns the 'length' bytes at 'offset' (fewer at the end of the file)"""
+		start = offset / DIRECT_IO_ALIGN * DIRECT_IO_ALIGN
+		end = (offset + length + DIRECT_IO_ALIGN - 1) / DIRECT_IO_ALIGN * DIRECT_IO_ALIGN
+		done = 0
+		while start + done < end:
+			n = libc().pread64(self.fd, self.address + done, end - start - done, start + done)
+			if n < 0:
+				err = ctypes.get_errno()
+				raise OSError(err, os.strerror(err))
+			if n == 0:
+				break
+			done += n
+		return self.buf[offset - start:min(done, offset - start + length)]
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+		self.buf.close()
+
+class readerPool:
+	"""A directReader for each thread of a verify pool, which the thread reuses for every block or file
+	it reads rather than opening and mapping a new one each time"""
+	def __init__(self, path=None, blockSize=None):
+		"""
+		@param path - (optional) the file or device every read is from (otherwise given to get())
+		@param blockSize - (optional) the largest read that will be asked for (default: VERIFY_BLOCK)
+		"""
+		self.path = path
+		self.blockSize = blockSize
+		self.local = threading.local()
+		self.readers = []
+
+	def get(self, path=None):
+		"""Returns this thread's reader, switched to 'path' if one is given"""
+		reader = getattr(self.local, 'reader', None)
+		if reader is None:
+			reader = directReader(path or self.path, self.blockSize)
+			self.local.reader = reader
+			self.readers.append(reader)
+		elif path is not None:
+			reader.open(path)
+		return reader
+
+	def close(self):
+		"""Closes every thread's reader (once the pool is done)"""
+		for reader in self.readers:
+			reader.close()
+
+def verifyBlock(readers, block):
+	"""Reads one block back and checks it (run in verifyBlocks()' thread pool)
+	@param readers - readerPool of the drive
+	@returns None if it matches, otherwise (offset of the bad block, what was wrong)
+	"""
+	(offset, length, digest) = block
+	try:
+		data = readers.get().read(offset, length)
+	except (IOError, OSError), e:
+		return (offset, "read error: " + str(e))
+	if len(data) != length:
+		return (offset + len(data), "short read")
+	if hashlib.sha1(data).hexdigest() != digest:
+		return (offset, "data differs")
+	return None
+
+def verifyBlocks(path, blocks, threads=None):
+	"""Reads blocks back from a drive with a pool of threads and compares them with their hashes
+	@param path - the drive's device node
+	@param blocks - list of [offset, length, sha1] (see blockHashes())
+	@param threads - (optional) number of reader threads (default: VERIFY_THREADS)
+	@returns (offset of the first bad block, what was wrong), or None if everything matched
+	"""
+	readers = readerPool(path, max([ length for (offset, length, digest) in blocks ] + [ 1 ]))
+	pool = ThreadPool(threads or VERIFY_THREADS)
+	try:
+		results = pool.map(lambda block: verifyBlock(readers, block), blocks, 1)
+	finally:
+		pool.close()
+		pool.join()
+		readers.close()
+	bad = [ result for result in results if result is not None ]
+	if bad:
+		return min(bad)
+	return None
+
+def verifyFile(readers, root, relPath, entry):
+	"""Reads one file back from a mounted drive and checks it against its manifest entry
+	@param readers - readerPool of verifyFiles()' thread pool
+	@returns None if it matches, otherwise (relPath, what was wrong)
+	"""
+	(size, mtime, digest) = entry
+	h = hashlib.sha1()
+	done = 0
+	try:
+		reader = readers.get(os.path.join(root, relPath))
+		data = reader.read(0, VERIFY_BLOCK)
+		while data:
+			h.update(data)
+			done += len(data)
+			data = reader.read(done, VERIFY_BLOCK)
+	except (IOError, OSError), e:
+		return (relPath, "read error at byte %d: %s" % (done, e))
+	if done != size:
+		return (relPath, "%d bytes instead of %d" % (done, size))
+	if h.hexdigest() != digest:
+		return (relPath, "contents differ")
+	return None
+
+def verifyFiles(root, manifest, threads=None):
+	"""Reads every file in a manifest back from a mounted drive with a pool of threads and checks it
+	@param root - where the drive is mounted
+	@param manifest - manifest of the source (see buildManifest())
+	@param threads - (optional) number of reader threads (default: VERIFY_THREADS)
+	@returns a sorted list of (relPath, what was wrong) for the files that didn't match
+	"""
+	readers = readerPool()
+	pool = ThreadPool(threads or VERIFY_THREADS)
+	try:
+		results = pool.map(lambda relPath: verifyFile(readers, root, relPath, manifest['files'][relPath]),
+						   sorted(manifest['files']), 1)
+	finally:
+		pool.close()
+		pool.join()
+		readers.close()
+	return [ result for result in results if result is not None ]
+
+def discardRange(fd, offset, length):
+	"""Discards (TRIMs) a byte range of a block device
+	@returns False if the device doesn't support it
+	"""
+	try:
+		fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', offset, length))
+	except IOError, e:
+		if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+			return False
+		raise
+	return True
+
+def buildGoldenImages(devices):
+	"""Builds one golden image for each size class present among the drives, as big as the smallest
+	drive of the class, so every drive can be cloned and the TOOLS partition uses as much of them as it can
+	@param devices - dictionary of "device : [media partitions]"
+	"""
+	sizes = {}		# size class : MB of its smallest drive
+	for dev in devices:
+		sizeMB = getDeviceSize(devices[dev][0].getDisk()) / 1000000
+		imageClass = sizeClass(sizeMB)
+		sizes[imageClass] = min(sizes.get(imageClass, sizeMB), sizeMB)
+	for imageClass in sorted(sizes):
+		GOLDEN_IMAGE_PATHS[imageClass] = buildGoldenImage(imageClass, sizes[imageClass], SYNC_DRIVES)
+
+class fanOutWriter:
+	"""Copies a source tree to several target directories at once, reading each chunk of the source
+	only once into a ring of buffers shared with one writer process per target.
+	A target that falls more than the whole ring behind for FANOUT_DETACH_TIMEOUT seconds is detached
+	and finishes the copy with its own reads, so one slow drive can't stall the rest.
+	"""
+	def __init__(self, source, targets, delete=False, slots=None, chunkSize=None, detachTimeout=None, labels=None):
+		"""
+		@param source - directory to copy from
+		@param targets - list of directories to copy to (e.g. mountpoints)
+		@param labels - (optional) drive name of each target, for progress reporting
+		@param delete - (optional) remove files in the targets that aren't in the source (like rsync --delete)
+		@param slots - (optional) number of buffers in the ring (default: FANOUT_SLOTS)
+		@param chunkSize - (optional) size of each buffer (default: FANOUT_CHUNK)
+		@param detachTimeout - (optional) seconds to wait for a slow target (default: FANOUT_DETACH_TIMEOUT)
+		"""
+		self.source = source
+		self.targets = targets
+		self.labels = labels or [ os.path.basename(target.rstrip('/')) for target in targets ]
+		self.delete = delete
+		self.slots = slots or FANOUT_SLOTS
+		self.chunkSize = chunkSize or FANOUT_CHUNK
+		self.detachTimeout = detachTimeout or FANOUT_DETACH_TIMEOUT
+		self.files = [] # (relative path, size, mtime) in copy order
+		self.dirs = []
+		for (root, dirs, files) in os.walk(source):
+			dirs.sort()
+			for name in dirs:
+				self.dirs.append(os.path.relpath(os.path.join(root, name), source))
+			for name in sorted(files):
+				path = os.path.join(root, name)
+				st = os.stat(path)
+				self.files.append((os.path.relpath(path, source), st.st_size, st.st_mtime))
+
+		# shared between the reader (this process) and the writer processes
+		self.ring = mmap.mmap(-1, self.slots * self.chunkSize)
+		self.lengths = Array('l', self.slots, lock=False)
+		self.produced = Value('l', 0, lock=False)	# number of chunks put in the ring
+		self.consumed = Array('l', len(targets), lock=False)	# number of chunks each target has written
+		self.detached = Array('b', len(targets), lock=False)
+		self.failed = Array('b', len(targets), lock=False)
+		self.maxLag = Array('l', len(targets), lock=False)	# furthest (in chunks) each target fell behind
+		self.written = Array('d', len(targets), lock=False)	# bytes written by each target
+		self.stalled = [ 0.0 ] * len(targets)	# seconds each target has held up the reader (reader only)
+		self.cond = Condition()
+
+	def run(self):
+		"""Copies the source to every target
+		@returns a list of per-target result dicts ('target', 'failed', 'detached', 'bytes', 'maxLagMB')
+		"""
+		start = time()
+		writers = []
+		for i in range(len(self.targets)):
+			p = Process(target=self.writer, args=(i,))
+			p.start()
+			writers.append(p)
+
+		total = sum([ size for (relPath, size, mtime) in self.files ])
+		progress = [ progressTracker(label, 'fanout', total) for label in self.labels ]
+		seq = 0
+		for (relPath, size, mtime) in self.files:
+			for i in range(len(self.targets)):
+				progress[i].update(self.written[i])
+			try:
+				src = open(os.path.join(self.source, relPath), 'rb')
+			except IOError, e:
+				# every target would get a short file: fail them all rather than truncate silently
+				self.failAll("can't read " + relPath + ": " + str(e))
+				break
+			read = 0
+			for n in range(self.numChunks(size)):
+				try:
+					data = src.read(self.chunkSize)
+				except IOError, e:
+					self.failAll("can't read " + relPath + ": " + str(e))
+					break
+				if not data:
+					break
+				read += len(data)
+				self.waitForSlot(seq)
+				slot = seq % self.slots
+				self.ring[slot * self.chunkSize:slot * self.chunkSize + len(data)] = data
+				self.lengths[slot] = len(data)
+				self.cond.acquire()
+				seq += 1
+				self.produced.value = seq
+				self.cond.notify_all()
+				self.cond.release()
+			src.close()
+			if read != size and [ i for i in range(len(self.targets)) if self.attached(i) ]:
+				self.failAll(relPath + " changed size while it was being copied")
+			if not [ i for i in range(len(self.targets)) if self.attached(i) ]:
+				# every target has failed or is copying on its own
+				break
+
+		for p in writers:
+			while p.is_alive():
+				p.join(PROGRESS_INTERVAL)
+				for i in range(len(self.targets)):
+					progress[i].update(self.written[i])
+		for i in range(len(self.targets)):
+			if not self.failed[i]:
+				progress[i].finish()
+		elapsed = max(time() - start, 0.001)
+
+		results = []
+		total = 0.0
+		for i in range(len(self.targets)):
+			total += self.written[i]
+			results.append({ 'target' : self.targets[i],
+							 'failed' : bool(self.failed[i]),
+							 'detached' : bool(self.detached[i]),
+							 'bytes' : self.written[i],
+							 'maxLagMB' : self.maxLag[i] * self.chunkSize / 1000000.0 })
+			debug("Fan-out to %s: %.1f MB written, fell up to %.1f MB behind%s%s" % (self.targets[i],
+				self.written[i] / 1000000, results[-1]['maxLagMB'],
+				self.detached[i] and ", detached" or "", self.failed[i] and ", FAILED" or ""), 1)
+		debug("Fan-out of %s to %d target(s): %.1f MB in %.1fs, %.1f MB/s aggregate" % (self.source,
+			len(self.targets), total / 1000000, elapsed, total / 1000000 / elapsed), 1)
+		return results
+
+	def failAll(self, reason):
+		"""Fails the copy on every target (the source can't be read)"""
+		debug("Fan-out of " + self.source + " failed: " + reason, 0)
+		self.cond.acquire()
+		for i in range(len(self.targets)):
+			self.failed[i] = 1
+		self.cond.notify_all()
+		self.cond.release()
+
+	def numChunks(self, size):
+		"""Returns the number of ring chunks a file of 'size' bytes takes (empty files take none)"""
+		return (size + self.chunkSize - 1) / self.chunkSize
+
+	def attached(self, i):
+		return not self.detached[i] and not self.failed[i]
+
+	def waitForSlot(self, seq):
+		"""Waits until every attached target has written the chunk that used to be in seq's slot.
+		The time spent waiting is charged to the slowest target; once a target has held the reader
+		up for longer than the detach timeout in total, it is detached."""
+		self.cond.acquire()
+		try:
+			while True:
+				behind = [ i for i in range(len(self.targets)) if self.attached(i) and seq - self.consumed[i] >= self.slots ]
+				for i in range(len(self.targets)):
+					if self.attached(i):
+						self.maxLag[i] = max(self.maxLag[i], seq - self.consumed[i])
+				if not behind:
+					return
+				slowest = min(behind, key=lambda i: self.consumed[i])
+				if self.stalled[slowest] >= self.detachTimeout:
+					debug("Fan-out: detaching slow target " + self.targets[slowest], 1)
+					self.detached[slowest] = 1
+					self.cond.notify_all()
+					continue
+				waitStart = time()
+				self.cond.wait(self.detachTimeout - self.stalled[slowest])
+				self.stalled[slowest] += time() - waitStart
+		finally:
+			self.cond.release()
+
+	def writer(self, i):
+		"""Writer process for target i: writes each chunk from the ring, or copies on its own once detached"""
+		target = self.targets[i]
+		seq = 0
+		try:
+			for relDir in self.dirs:
+				if not os.path.isdir(os.path.join(target, relDir)):
+					os.makedirs(os.path.join(target, relDir))
+			if self.delete:
+				self.deleteExtras(target)
+			for (index, (relPath, size, mtime)) in enumerate(self.files):
+				dest = os.path.join(target, relPath)
+				out = open(dest, 'wb')
+				fileWritten = 0
+				for n in range(self.numChunks(size)):
+					data = self.readChunk(i, seq)
+					if data is None:
+						break
+					out.write(data)
+					fileWritten += len(data)
+					self.written[i] += len(data)
+					seq += 1
+					self.cond.acquire()
+					self.consumed[i] = seq
+					self.cond.notify_all()
+					self.cond.release()
+				out.close()
+				if self.failed[i]:
+					# the reader couldn't read the source
+					return
+				if self.detached[i]:
+					# finish this file and the rest from the source ourselves; this file is copied whole again
+					self.written[i] -= fileWritten
+					for (relPath, size, mtime) in self.files[index:]:
+						dest = os.path.join(target, relPath)
+						shutil.copyfile(os.path.join(self.source, relPath), dest)
+						self.written[i] += size
+						os.utime(dest, (mtime, mtime))
+					break
+				os.utime(dest, (mtime, mtime))
+		except (IOError, OSError), e:
+			debug("Fan-out to " + target + " failed: " + str(e), 0)
+			self.cond.acquire()
+			self.failed[i] = 1
+			self.cond.notify_all()
+			self.cond.release()
+
+	def readChunk(self, i, seq):
+		"""Returns chunk 'seq' from the ring for target i, or None if the target was detached or failed"""
+		self.cond.acquire()
+		try:
+			while self.produced.value <= seq and not self.detached[i] and not self.failed[i]:
+				self.cond.wait(1)
+			if self.detached[i] or self.failed[i]:
+				return None
+		finally:
+			self.cond.release()
+		slot = seq % self.slots
+		data = self.ring[slot * self.chunkSize:slot * self.chunkSize + self.lengths[slot]]
+		# if we were detached while copying, the reader may have reused the slot
+		if self.detached[i]:
+			return None
+		return data
+
+	def deleteExtras(self, target):
+		"""Removes files and directories from 'target' that aren't in the source"""
+		keepFiles = set([ relPath for (relPath, size, mtime) in self.files ])
+		keepDirs = set(self.dirs)
+		for (root, dirs, files) in os.walk(target, topdown=False):
+			for name in files:
+				if os.path.relpath(os.path.join(root, name), target) not in keepFiles:
+					os.remove(os.path.join(root, name))
+			for name in dirs:
+				if os.path.relpath(os.path.join(root, name), target) not in keepDirs:
+					shutil.rmtree(os.path.join(root, name))
+
+def livePartition(parts):
+	"""Returns the LIVE (second) partition's media object for a drive, creating it if the drive
+	started out with only one partition
+	@param parts - list of media objects for the drive's partitions
+	"""
+	for part in parts:
+		if part.getPartNum() == 2:
+			return part
+	part2 = media(parts[0].getName()[:-1]+'2', parts[0].getDev()[:-1]+'2', parts[0].debugLevel, parts[0].forceOn, parts[0].emailOn)
+	part2.setPart(2)
+	return part2
+
+def fanOutPopulate(devices):
+	"""Copies the live folder and/or the tools to every drive at once with the fan-out writer
+	@param devices - dictionary of "device : [media partitions]"
+	"""
+	jobs = []
+	if IMAGE_DRIVES and not GOLDEN_IMAGES:
+		jobs.append((LIVE_SOURCE, [ livePartition(devices[dev]) for dev in devices ], False))
+	if SYNC_DRIVES and not (IMAGE_DRIVES and GOLDEN_IMAGES):
+		jobs.append((TOOLS_SOURCE, [ part for dev in devices for part in devices[dev] if part.getPartNum() == 1 ], True))
+
+	for (source, parts, delete) in jobs:
+		for part in parts:
+			part.mount()
+		results = fanOutWriter(source, [ part.getMountPoint() for part in parts ], delete,
+							   labels=[ part.getName() for part in parts ]).run()
+		(manifest, what) = (LIVE_MANIFEST, "live folder")
+		if source == TOOLS_SOURCE:
+			(manifest, what) = (TOOLS_MANIFEST, "tools")
+		for (part, result) in zip(parts, results):
+			if result['failed']:
+				part.errorHandler("IOError", "fan-out copy of " + source, "copy " + source + " to " + part.getMountPoint())
+			elif source == TOOLS_SOURCE and TOOLS_MANIFEST is not None:
+				saveManifest(TOOLS_MANIFEST, os.path.join(part.getMountPoint(), TOOLS_MANIFEST_NAME))
+			part.unmount()
+			# the verify stage ran before these files were copied
+			if not result['failed'] and VERIFY_READBACK and manifest is not None:
+				part.verifyCopy(manifest, what)
+
+def hashFile(path):
+	"""Returns the SHA-1 hex digest of a file's contents"""
+	h = hashlib.sha1()
+	f = open(path, 'rb')
+	try:
+		chunk = f.read(IMAGE_WRITE_CHUNK)
+		while chunk:
+			h.update(chunk)
+			chunk = f.read(IMAGE_WRITE_CHUNK)
+	finally:
+		f.close()
+	return h.hexdigest()
+
+def buildManifest(root, previous=None):
+	"""Builds a manifest of every file and directory under 'root'
+	@param root - the directory to describe
+	@param previous - (optional) an older manifest of the same tree; files whose size and mtime
+						haven't changed reuse its hash instead of being read again
+	@returns a dict: { 'dirs' : [relative paths], 'files' : { relative path : [size, mtime, sha1] } }
+	"""
+	manifest = { 'dirs' : [], 'files' : {} }
+	oldFiles = {}
+	if previous:
+		oldFiles = previous['files']
+	for (dirPath, dirs, files) in os.walk(root):
+		for name in dirs:
+			manifest['dirs'].append(os.path.relpath(os.path.join(dirPath, name), root))
+		for name in files:
+			path = os.path.join(dirPath, name)
+			relPath = os.path.relpath(path, root)
+			if relPath == TOOLS_MANIFEST_NAME:
+				continue
+			st = os.stat(path)
+			old = oldFiles.get(relPath)
+			if old and old[0] == st.st_size and old[1] == int(st.st_mtime):
+				manifest['files'][relPath] = old
+			else:
+				manifest['files'][relPath] = [ st.st_size, int(st.st_mtime), hashFile(path) ]
+	manifest['dirs'].sort()
+	return manifest
+
+def loadManifest(path):
+	"""Reads a manifest written by saveManifest(), returning None if it is missing or unreadable"""
+	try:
+		f = open(path, 'r')
+		try:
+			manifest = json.load(f)
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		return None
+	if not isinstance(manifest, dict) or 'files' not in manifest or 'dirs' not in manifest:
+		return None
+	return manifest
+
+def saveManifest(manifest, path):
+	"""Writes a manifest, replacing any old one only once the new one is completely written"""
+	tmpPath = path + '.tmp'
+	f = open(tmpPath, 'w')
+	try:
+		json.dump(manifest, f)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+	os.rename(tmpPath, path)
+
+def loadToolsManifest():
+	"""Computes the manifest of TOOLS_SOURCE, reusing the hashes cached by the last run"""
+	return loadSourceManifest(TOOLS_SOURCE, TOOLS_MANIFEST_CACHE)
+
+def loadSourceManifest(source, cachePath):
+	"""Computes the manifest of a source folder, reusing the hashes cached in 'cachePath' by the last run"""
+	debug("Building the manifest of " + source, 1)
+	manifest = buildManifest(source, loadManifest(cachePath))
+	try:
+		saveManifest(manifest, cachePath)
+	except (IOError, OSError), e:
+		debug("Couldn't cache the manifest of " + source + ": " + str(e), 1)
+	return manifest
+
+class snapshotCache:
+	"""A local cache of immutable snapshots of the source folders. Every file's contents are stored once,
+	named by their hash, under objects/; a snapshot is a tree of hard links to them plus its manifest, under
+	snapshots/<folder>/<ID> where the ID is a hash of the manifest. Publishing a snapshot replaces the
+	folder's 'current-<folder>' link atomically, so a run that pinned an older snapshot keeps reading
+	exactly the files it started with. A run's pins are files under pins/ that every run can see, and
+	publishing and pruning happen under a lock on the cache, so no run removes a snapshot another is using.
+	"""
+	def __init__(self, root):
+		"""
+		@param root - the cache directory (SNAPSHOT_DIR)
+		"""
+		self.root = root
+		self.objects = os.path.join(root, 'objects')
+		self.pins = os.path.join(root, 'pins')
+		for path in [ self.objects, self.pins, os.path.join(root, 'snapshots'), os.path.join(root, 'staging') ]:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+	def stagingDir(self, name):
+		"""Returns the folder where new contents of the folder 'name' are prepared (e.g. by rsync)"""
+		path = os.path.join(self.root, 'staging', name)
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		return path + '/'
+
+	def snapshotPath(self, name, snapshotId):
+		return os.path.join(self.root, 'snapshots', name, snapshotId)
+
+	def store(self, path):
+		"""Adds a file's contents to objects/ (unless they're already there). The file is always hashed: a
+		hash reused from a manifest because the size and mtime didn't change could name stale contents.
+		@param path - the file
+		@returns (path of the object, hash of its contents)
+		"""
+		digest = hashFile(path)
+		obj = os.path.join(self.objects, digest[:2], digest[2:])
+		if os.path.exists(obj):
+			return (obj, digest)
+		tmpPath = os.path.join(self.objects, 'tmp%d' % os.getpid())
+		shutil.copy2(path, tmpPath)
+		actual = hashFile(tmpPath)
+		if actual != digest:
+			# the file changed while we copied it; the object holds what we copied
+			obj = os.path.join(self.objects, actual[:2], actual[2:])
+		if not os.path.isdir(os.path.dirname(obj)):
+			os.makedirs(os.path.dirname(obj))
+		os.chmod(tmpPath, 0444)
+		os.rename(tmpPath, obj)
+		return (obj, actual)
+
+	def publish(self, name, source):
+		"""Snapshots a folder, pins the snapshot for this process and makes it the current one of 'name'.
+		Every file is hashed (see store()); unchanged contents are only linked, not copied again.
+		@param name - which folder this is ('live', 'tools')
+		@param source - the folder to snapshot
+		@returns the snapshot's ID
+		"""
+		debug("Snapshotting " + source, 1)
+		lock = self.lock()
+		try:
+			tmpPath = os.path.join(self.root, 'snapshots', name, 'tmp%d' % os.getpid())
+			shutil.rmtree(tmpPath, ignore_errors=True)
+			tree = os.path.join(tmpPath, 'tree')
+			os.makedirs(tree)
+			dirs, files = [], {}
+			for (dirPath, dirNames, fileNames) in os.walk(source):
+				for dirName in dirNames:
+					dirs.append(os.path.relpath(os.path.join(dirPath, dirName), source))
+					os.makedirs(os.path.join(tree, dirs[-1]))
+				for fileName in fileNames:
+					relPath = os.path.relpath(os.path.join(dirPath, fileName), source)
+					if relPath == TOOLS_MANIFEST_NAME:
+						continue
+					(obj, digest) = self.store(os.path.join(source, relPath))
+					os.link(obj, os.path.join(tree, relPath))
+					st = os.stat(obj)
+					files[relPath] = [ st.st_size, int(st.st_mtime), digest ]
+			snapshot = { 'dirs' : sorted(dirs), 'files' : files }
+			snapshotId = hashlib.sha1(json.dumps(snapshot['dirs']) + treeSignature(tree, snapshot)).hexdigest()
+			saveManifest(snapshot, os.path.join(tmpPath, 'manifest'))
+			self.pin(name, snapshotId)
+			try:
+				os.rename(tmpPath, self.snapshotPath(name, snapshotId))
+			except OSError:
+				# we already have this snapshot
+				shutil.rmtree(tmpPath, ignore_errors=True)
+			self.setCurrent(name, snapshotId)
+			self.prune(name)
+		finally:
+			lock.close()
+		return snapshotId
+
+	def lock(self):
+		"""Takes the cache's lock (released when the returned file is closed)"""
+		f = open(os.path.join(self.root, 'lock'), 'a')
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		return f
+
+	def pin(self, name, snapshotId):
+		"""Keeps a snapshot from being pruned for as long as this process runs"""
+		open(os.path.join(self.pins, '%s.%s.%d' % (name, snapshotId, os.getpid())), 'w').close()
+
+	def pinned(self, name):
+		"""Returns the snapshots of 'name' that running processes have pinned, removing the pins of
+		processes that have exited"""
+		snapshotIds = []
+		for pin in os.listdir(self.pins):
+			fields = pin.split('.')
+			if len(fields) != 3 or fields[0] != name:
+				continue
+			try:
+				os.kill(int(fields[2]), 0)
+			except OSError, e:
+				if e.errno == errno.ESRCH:
+					os.remove(os.path.join(self.pins, pin))
+					continue
+			except ValueError:
+				continue
+			snapshotIds.append(fields[1])
+		return snapshotIds
+
+	def setCurrent(self, name, snapshotId):
+		"""Points 'current-<name>' at a snapshot, replacing the old link in one step"""
+		link = os.path.join(self.root, 'current-' + name)
+		tmpLink = link + '.tmp%d' % os.getpid()
+		if os.path.lexists(tmpLink):
+			os.remove(tmpLink)
+		os.symlink(os.path.join('snapshots', name, snapshotId), tmpLink)
+		os.rename(tmpLink, link)
+
+	def current(self, name):
+		"""Returns the ID of the current snapshot of 'name', or None if there isn't one"""
+		link = os.path.join(self.root, 'current-' + name)
+		if not os.path.islink(link):
+			return None
+		return os.path.basename(os.readlink(link))
+
+	def open(self, name, snapshotId):
+		"""Returns (folder, manifest) of a snapshot: the files to copy and their sizes and hashes"""
+		path = self.snapshotPath(name, snapshotId)
+		return (os.path.join(path, 'tree') + '/', loadManifest(os.path.join(path, 'manifest')))
+
+	def prune(self, name):
+		"""Deletes all but the current, the pinned and the SNAPSHOT_KEEP newest other snapshots of 'name',
+		then the contents no snapshot links to any more (call with the lock held)"""
+		keep = [ self.current(name) ] + self.pinned(name)
+		folder = os.path.join(self.root, 'snapshots', name)
+		old = [ snapshotId for snapshotId in os.listdir(folder) if snapshotId not in keep and not snapshotId.startswith('tmp') ]
+		old.sort(key=lambda snapshotId: os.stat(os.path.join(folder, snapshotId)).st_mtime, reverse=True)
+		for snapshotId in old[SNAPSHOT_KEEP:]:
+			debug("Removing the old " + name + " snapshot " + snapshotId, 2)
+			shutil.rmtree(os.path.join(folder, snapshotId), ignore_errors=True)
+		for (dirPath, dirs, files) in os.walk(self.objects):
+			for fileName in files:
+				path = os.path.join(dirPath, fileName)
+				if os.stat(path).st_nlink == 1 and not fileName.startswith('tmp'):
+					os.remove(path)
+
+def pinSnapshot(name, source):
+	"""Publishes a snapshot of a source folder in SNAPSHOT_DIR and pins this run to it: every drive is
+	copied from the snapshot, however often the folder changes during the run
+	@param name - which folder this is ('live', 'tools')
+	@param source - the folder
+	@returns (the snapshot's folder, its manifest) to use in place of 'source' and a freshly built manifest
+	"""
+	cache = snapshotCache(SNAPSHOT_DIR)
+	snapshotId = cache.publish(name, source)
+	(tree, manifest) = cache.open(name, snapshotId)
+	PINNED_SNAPSHOTS[name] = snapshotId
+	SOURCE_SIZES[tree] = sum([ entry[0] for entry in manifest['files'].values() ])
+	debug("Using the %s snapshot %s" % (name, snapshotId), 1)
+	return (tree, manifest)
+
+def sourceSignature(name, root, manifest=None):
+	"""Describes the contents of a source folder: its pinned snapshot ID if it has one, otherwise its
+	treeSignature()"""
+	if name in PINNED_SNAPSHOTS:
+		return PINNED_SNAPSHOTS[name]
+	return treeSignature(root, manifest)
+
+def usbTopology(disk):
+	"""Works out which USB host controller, root port and hub a disk is connected through, from sysfs
+	@param disk - the whole-disk device node (e.g. /dev/sdb)
+	@returns a dict with 'controller', 'bus', 'port' (the device's USB path, e.g. '2-1.3'),
+				'rootPort' (e.g. '2-1'), 'hub' and 'speed' (Mbps), or None if it isn't a USB device
+	"""
+	device = lookupBlockDevice(disk)
+	if not device.known:
+		return None
+	components = device.diskPath.split('/')
+	bus = [ c for c in components if re.match(r'^usb[0-9]+$', c) ]
+	ports = [ c for c in components if re.match(r'^[0-9]+-[0-9.]+$', c) ]
+	if not bus or not ports:
+		return None
+	controller = components[components.index(bus[0]) - 1]
+	hub = bus[0]
+	if len(ports) > 1:
+		hub = ports[-2]
+	speed = 0
+	try:
+		speedFile = open(os.path.join(SYSFS_ROOT, 'bus', 'usb', 'devices', ports[0], 'speed'))
+		speed = int(float(speedFile.read().strip()))
+		speedFile.close()
+	except (IOError, ValueError):
+		pass
+	return { 'controller' : controller, 'bus' : bus[0], 'port' : ports[-1], 'rootPort' : ports[0],
+			 'hub' : hub, 'speed' : speed }
+
+class ioDomain:
+	"""A USB bandwidth domain: every drive behind the same root port shares that port's link.
+	Heavy I/O phases hold one of the domain's slots, so only 'limit' drives in the domain copy at once
+	and the rest queue. Counters are in shared memory so the parent can report on the workers.
+	"""
+	def __init__(self, key, speed, limit):
+		"""
+		@param key - name of the domain (controller and root port)
+		@param speed - link speed of the root port in Mbps
+		@param limit - number of drives in the domain allowed to do heavy I/O at once
+		"""
+		self.key = key
+		self.speed = speed
+		self.limit = limit
+		self.drives = []
+		self.slots = Semaphore(limit)
+		self.lock = Lock()
+		self.busy = Value('d', 0.0, lock=False)		# seconds of slot use, summed over drives
+		self.waited = Value('d', 0.0, lock=False)	# seconds drives spent queued for a slot
+		self.heldSince = {}		# thread -> when it got its slot (drive threads share one process)
+		self.holders = Array('l', limit, lock=False)	# who holds each slot (see ioHolder()), 0 if free
+
+	def acquire(self):
+		start = time()
+		self.slots.acquire()
+		heldSince = time()
+		self.heldSince[threading.current_thread().ident] = heldSince
+		self.lock.acquire()
+		self.waited.value += heldSince - start
+		self.holders[list(self.holders).index(0)] = ioHolder()
+		self.lock.release()
+
+	def release(self):
+		heldSince = self.heldSince.pop(threading.current_thread().ident)
+		self.lock.acquire()
+		try:
+			self.busy.value += time() - heldSince
+			holders = list(self.holders)
+			if ioHolder() not in holders:
+				# the watchdog gave up on us and has already handed the slot back (see reclaim())
+				return
+			self.holders[holders.index(ioHolder())] = 0
+			self.slots.release()
+		finally:
+			self.lock.release()
+
+	def reclaim(self, holder):
+		"""Hands back the slots of a drive worker the watchdog killed or gave up on, so the other drives
+		in the domain don't wait for them forever
+		@param holder - the worker's ioHolder()
+		@returns how many slots it held
+		"""
+		self.lock.acquire()
+		try:
+			count = 0
+			for i in range(self.limit):
+				if self.holders[i] == holder:
+					self.holders[i] = 0
+					self.slots.release()
+					count += 1
+			return count
+		finally:
+			self.lock.release()
+
+def ioHolder():
+	"""Identifies the drive worker taking an I/O slot: its process, or its thread under THREAD_ENGINE"""
+	if THREAD_ENGINE:
+		return threading.current_thread().ident
+	return os.getpid()
+
+def reclaimIO(holder, dev):
+	"""Hands back every I/O slot held by a drive worker that was killed or given up on
+	@param holder - the worker's ioHolder() (process ID, or thread ident under THREAD_ENGINE)
+	@param dev - the drive, for the debug output
+	"""
+	for key in sorted(USB_DOMAINS):
+		if USB_DOMAINS[key].reclaim(holder):
+			debug("Gave back the I/O slot " + dev + " held on " + key, 1)
+
+class usbScheduler:
+	"""Groups the drives into USB bandwidth domains and reports how busy each domain was"""
+	def __init__(self, limit=None):
+		"""
+		@param limit - (optional) slots per domain, overriding USB_DOMAIN_LIMITS
+		"""
+		self.limit = limit
+		self.domains = USB_DOMAINS
+		self.start = time()
+
+	def addDomain(self, key, speed):
+		"""Returns the domain called 'key', creating it if necessary"""
+		if key not in self.domains:
+			limit = self.limit or USB_DOMAIN_LIMITS.get(speed, USB_DOMAIN_DEFAULT_LIMIT)
+			self.domains[key] = ioDomain(key, speed, limit)
+		return self.domains[key]
+
+	def addPresentPorts(self):
+		"""Creates a domain for every USB root port that has something (usually a hub) plugged in,
+		so drives that are hot-plugged behind them later share the same limits.
+		This must run before the worker processes start, since the domains live in shared memory.
+		"""
+		devicesDir = os.path.join(SYSFS_ROOT, 'bus', 'usb', 'devices')
+		if not os.path.isdir(devicesDir):
+			return
+		for name in sorted(os.listdir(devicesDir)):
+			if not re.match(r'^[0-9]+-[0-9]+$', name):
+				continue
+			components = os.path.realpath(os.path.join(devicesDir, name)).split('/')
+			bus = [ c for c in components if re.match(r'^usb[0-9]+$', c) ]
+			if not bus:
+				continue
+			speed = 0
+			try:
+				speedFile = open(os.path.join(devicesDir, name, 'speed'))
+				speed = int(float(speedFile.read().strip()))
+				speedFile.close()
+			except (IOError, ValueError):
+				pass
+			self.addDomain(components[components.index(bus[0]) - 1] + '/' + name, speed)
+
+	def assign(self, devices):
+		"""Puts every device into its bandwidth domain (fills in IO_DOMAINS)
+		@param devices - dictionary of "device : [media partitions]"
+		"""
+		for dev in sorted(devices):
+			topology = usbTopology(devices[dev][0].getDisk())
+			if topology is None:
+				debug(dev + " isn't on a USB bus, so it won't be scheduled", 2)
+				continue
+			key = topology['controller'] + '/' + topology['rootPort']
+			domain = self.addDomain(key, topology['speed'])
+			domain.drives.append(dev)
+			IO_DOMAINS[dev] = domain
+			debug("%s is on %s (hub %s, %d Mbps)" % (dev, key, topology['hub'], topology['speed']), 2)
+		for key in sorted(self.domains):
+			domain = self.domains[key]
+			debug("USB domain %s: %d drive(s), %d at a time" % (key, len(domain.drives), domain.limit), 1)
+
+	def report(self):
+		"""Displays how much of each domain's capacity was used over the run"""
+		elapsed = max(time() - self.start, 0.001)
+		for key in sorted(self.domains):
+			domain = self.domains[key]
+			debug("USB domain %s (%d Mbps, %d drive(s), limit %d): %.0fs of I/O, %.0f%% utilized, drives queued %.0fs" % (key,
+				domain.speed, len(domain.drives), domain.limit, domain.busy.value,
+				100.0 * domain.busy.value / (domain.limit * elapsed), domain.waited.value), 1)
+
 def exit():
 	if email:
 		# Make a notice that we're sending the email report		
 		debug("Sending email report because of premature exit.", 0)
-		# Actually send the email with the pre-built emailBody
-		sendEmail(emailBody)
+		# Have the log aggregator put the report together and send it
+		sendEmail()
 	sys.exit(1)
 
-def processDrive(current): #"current" must be an array of media devices
+def sourceVersion():
+	"""Returns a hash of everything a drive's contents depend on: the kind of run, the partition layout
+	and the contents of the live and tools sources (from their manifests when we have them)"""
+	global SOURCE_VERSION
+	if SOURCE_VERSION is None:
+		h = hashlib.sha1()
+		h.update(json.dumps([ IMAGE_DRIVES, SYNC_DRIVES, GOLDEN_IMAGES, FAT_BUILD, LIVE_PARTITION_SIZE_MB,
+							  PARTITION_ALIGN_SECTORS ], sort_keys=True))
+		if IMAGE_DRIVES:
+			h.update(sourceSignature('live', LIVE_SOURCE, LIVE_MANIFEST))
+		if SYNC_DRIVES:
+			h.update(sourceSignature('tools', TOOLS_SOURCE, TOOLS_MANIFEST))
+		SOURCE_VERSION = h.hexdigest()
+	return SOURCE_VERSION
+
+def imageVersion():
+	"""Returns a hash of what an imaged drive is made from: the live folder (its snapshot, or file names,
+	sizes and modification times) and the partition layout. The tools aren't part of it; they're refreshed separately."""
+	global IMAGE_VERSION
+	if IMAGE_VERSION is None:
+		h = hashlib.sha1()
+		h.update(json.dumps([ LIVE_PARTITION_SIZE_MB, PARTITION_ALIGN_SECTORS ], sort_keys=True))
+		h.update(sourceSignature('live', LIVE_SOURCE))
+		IMAGE_VERSION = h.hexdigest()
+	return IMAGE_VERSION
+
+def diskStamp(mbr):
+	"""The stamp sector of a drive with this MBR when it carries the current image: a hash of the image
+	version and the partition table, so a drive whose partitions changed since isn't current"""
+	stamp = DISK_STAMP_MAGIC + '\0' + hashlib.sha1(imageVersion() + mbr[446:512]).digest()
+	return stamp.ljust(SECTOR_SIZE, '\0')
+
+def readSector(disk, sector):
+	"""Reads one sector of a drive"""
+	fd = os.open(disk, os.O_RDONLY)
+	try:
+		os.lseek(fd, sector * SECTOR_SIZE, os.SEEK_SET)
+		return os.read(fd, SECTOR_SIZE)
+	finally:
+		os.close(fd)
+
+def diskStampCurrent(disk):
+	"""Returns True if a drive carries the stamp of the current image (two sector reads)"""
+	try:
+		mbr = readSector(disk, 0)
+		stamp = readSector(disk, DISK_STAMP_SECTOR)
+	except OSError:
+		return False
+	if len(mbr) < SECTOR_SIZE or mbr[510:512] != '\x55\xaa':
+		return False
+	return stamp == diskStamp(mbr)
+
+def writeDiskStamp(disk):
+	"""Stamps a successfully imaged drive with the current image version (see diskStamp()). The drive
+	also gets a disk signature of its own: a cloned drive has the golden image's, and a drive stamped by
+	an older version of this script has one that all its drives share."""
+	mbr = readSector(disk, 0)
+	fd = os.open(disk, os.O_WRONLY)
+	try:
+		os.lseek(fd, DISK_SIGNATURE_OFFSET, os.SEEK_SET)
+		os.write(fd, os.urandom(4))
+		os.lseek(fd, DISK_STAMP_SECTOR * SECTOR_SIZE, os.SEEK_SET)
+		os.write(fd, diskStamp(mbr))
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def reportSkippedDrives(skipped, downgraded, driveTime):
+	"""Displays the drives that were already at the current image and roughly how much time that saved
+	@param skipped - drives left out of the run entirely
+	@param downgraded - drives that only had their tools refreshed
+	@param driveTime - average seconds a drive took to image this run (None if none was)
+	"""
+	if not skipped and not downgraded:
+		return
+	if skipped:
+		debug("%d drive(s) already had the current image and were skipped: %s" % (len(skipped), ', '.join(skipped)), 0)
+	if downgraded:
+		debug("%d drive(s) already had the current image and only had their tools refreshed: %s" % (len(downgraded),
+			', '.join(downgraded)), 0)
+	if driveTime:
+		debug("About %.0f drive-minute(s) saved (a drive took %.0fs to image this run)" % ((len(skipped) + len(downgraded)) * driveTime / 60,
+			driveTime), 0)
+	else:
+		debug("No drive was imaged this run to estimate the time saved from", 1)
+
+def treeSignature(root, manifest=None):
+	"""Describes the contents of a folder: every file's size and hash from its manifest, or its size
+	and modification time if there is no manifest"""
+	if manifest is None:
+		manifest = { 'files' : {} }
+		for (dirPath, dirs, files) in os.walk(root):
+			for name in files:
+				st = os.stat(os.path.join(dirPath, name))
+				manifest['files'][os.path.relpath(os.path.join(dirPath, name), root)] = [ st.st_size, int(st.st_mtime), '' ]
+	return json.dumps(sorted([ (relPath, entry[0], entry[2] or entry[1]) for (relPath, entry) in manifest['files'].items() ]))
+
+def readSysfsFile(path):
+	"""Returns the stripped contents of a sysfs attribute, or None if it can't be read"""
+	try:
+		f = open(path, 'r')
+		try:
+			return f.read().strip()
+		finally:
+			f.close()
+	except IOError:
+		return None
+
+def stableDriveId(disk):
+	"""Returns a name for a drive that stays the same when it is replugged somewhere else: its USB
+	vendor, product and serial number from sysfs (or its model and size if it has no serial number)
+	@param disk - the whole-disk device node (e.g. /dev/sdb)
+	"""
+	device = lookupBlockDevice(disk)
+	if device.serial:
+		return '%s-%s-%s' % (device.idVendor, device.idProduct, device.serial)
+	return '%s-%d' % (device.model or os.path.basename(disk), getDeviceSize(disk))
+
+class driveJournal:
+	"""A durable record of the stages a drive has completed and the source version each one used.
+	It lives in JOURNAL_DIR under the drive's stable ID and is replaced atomically after every change, so
+	after a crash it always describes stages that really finished. A run resumes a drive at its first
+	stage that isn't recorded with the current version; a drive that finishes every stage is forgotten."""
+	def __init__(self, disk, version=None):
+		"""
+		@param disk - the whole-disk device node (e.g. /dev/sdb)
+		@param version - (optional) the current source version (default: sourceVersion())
+		"""
+		self.version = version or sourceVersion()
+		self.key = stableDriveId(disk)
+		self.path = None
+		self.completed = []
+		if JOURNAL_DIR:
+			self.path = os.path.join(JOURNAL_DIR, re.sub(r'[^A-Za-z0-9._-]', '_', self.key) + '.json')
+			try:
+				f = open(self.path, 'r')
+				try:
+					self.completed = json.load(f)['completed']
+				finally:
+					f.close()
+			except (IOError, ValueError, KeyError, TypeError):
+				self.completed = []
+
+	def done(self, stage):
+		"""Returns True if the journal shows 'stage' finished with the current source version"""
+		return [ entry for entry in self.completed if entry['stage'] == stage and entry['version'] == self.version ] != []
+
+	def resumePoint(self, stages):
+		"""Returns the index of the first stage (of the list of (name, method)) that has to be run"""
+		for (i, (stage, method)) in enumerate(stages):
+			if not self.done(stage):
+				return i
+		return len(stages)
+
+	def begin(self, stage, stages):
+		"""Forgets 'stage' and every stage after it, before it is (re)run"""
+		names = [ name for (name, method) in stages ]
+		later = names[names.index(stage):]
+		if [ entry for entry in self.completed if entry['stage'] in later ]:
+			self.completed = [ entry for entry in self.completed if entry['stage'] not in later ]
+			self.save()
+
+	def complete(self, stage, stages):
+		"""Records that 'stage' finished"""
+		self.completed.append({ 'stage' : stage, 'version' : self.version, 'finished' : time() })
+		self.save()
+
+	def finish(self):
+		"""Forgets the drive: everything has been written to it and verified (see finishDrive())"""
+		self.completed = []
+		if self.path is not None and os.path.exists(self.path):
+			os.remove(self.path)
+
+	def save(self):
+		"""Replaces the journal file atomically (write, fsync, rename, fsync the directory)"""
+		if self.path is None:
+			return
+		if not os.path.isdir(JOURNAL_DIR):
+			os.makedirs(JOURNAL_DIR)
+		tmpPath = self.path + '.tmp'
+		f = open(tmpPath, 'w')
+		try:
+			json.dump({ 'id' : self.key, 'completed' : self.completed }, f)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(tmpPath, self.path)
+		fd = os.open(JOURNAL_DIR, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+def runDriveStage(parts, i, stages):
+	"""Runs stage i on a drive, unless its journal shows it (and every stage before it) already done
+	for the current source version
+	@param parts - the drive's partitions (media objects)
+	@param i - index of the stage in 'stages'
+	@param stages - the list of (name, media method name) from driveStages()
+	@returns False if the stage failed
+	"""
+	(stage, method) = stages[i]
+	if stage in IMAGE_ONLY_STAGES and parts[0].imageIsCurrent():
+		parts[0].debug("Skipping the " + stage + " stage: the drive already has the current image", 1)
+		return True
+	journal = None
+	if JOURNAL_DIR:
+		journal = driveJournal(parts[0].getDisk())
+		if i < journal.resumePoint(stages):
+			parts[0].debug("Skipping the " + stage + " stage: the journal shows it done with the current sources", 1)
+			if i == len(stages) - 1 and not FANOUT_POPULATE:
+				# the last run stopped between finishing the drive's stages and finishing the drive
+				finishDrive(parts)
+			return True
+		journal.begin(stage, stages)
+	getattr(parts[0], method)(parts)
+	for part in parts:
+		if part.getName() in failed_drives:
+			return False
+	if journal is not None:
+		journal.complete(stage, stages)
+	# with the fan-out writer the files are only copied (and verified) after the last stage
+	if i == len(stages) - 1 and not FANOUT_POPULATE:
+		finishDrive(parts)
+	return True
+
+def finishDrive(parts):
+	"""Closes a drive's journal and stamps it with the current image, once everything has been written to
+	it and verified: after its last stage, or after the fan-out copy
+	@param parts - the drive's partitions (media objects)
+	"""
+	if JOURNAL_DIR:
+		driveJournal(parts[0].getDisk()).finish()
+	if IMAGE_DRIVES and not parts[0].imageIsCurrent():
+		parts[0].stampImage()
+
+def driveStages():
+	"""Returns the stages every drive goes through for this run, in order, as (name, media method name)"""
+	stages = []
+	if IMAGE_DRIVES and not GOLDEN_IMAGES:
+		stages += [ ('wipe', 'wipeStage'), ('partition', 'partitionStage'), ('format', 'formatStage') ]
+	if IMAGE_DRIVES or SYNC_DRIVES:
+		stages.append(('populate', 'populateStage'))
+	if IMAGE_DRIVES and not GOLDEN_IMAGES:
+		stages.append(('bootloader', 'bootloaderStage'))
+	if stages:
+		stages.append(('verify', 'verifyStage'))
+	return stages
+
+def diskBytesWritten(disk):
+	"""Returns how many bytes have been written to a drive since it appeared (from its sysfs I/O
+	statistics), or None if the kernel doesn't keep them for it
+	@param disk - the whole-disk device node (e.g. /dev/sdb)
+	"""
+	device = lookupBlockDevice(disk)
+	if not device.known:
+		return None
+	stats = readSysfsFile(os.path.join(device.sysfsPath, 'stat'))
+	if stats is None:
+		return None
+	return int(stats.split()[6]) * 512
+
+def driveResult(dev):
+	"""Returns a new result for a drive, which the worker fills in and sends to the main process
+	@param dev - the device key (partition link without the partition number)
+	"""
+	version = None
+	if IMAGE_DRIVES or SYNC_DRIVES:
+		version = sourceVersion()
+	return { 'drive' : dev,
+			 'status' : 'ok',			# 'ok', 'failed' or 'current' (already had the image; not run)
+			 'failedStage' : None,		# the first stage that failed
+			 'stages' : {},				# stage name : seconds
+			 'bytesWritten' : 0,
+			 'current' : False,			# already had the current image, so only the tools were refreshed
+			 'version' : version,
+			 'snapshots' : dict(PINNED_SNAPSHOTS) }	# the source snapshots it was copied from
+
+def stageFailed(result, stage):
+	"""Marks a drive result failed, keeping the first stage that failed"""
+	result['status'] = 'failed'
+	if result['failedStage'] is None:
+		result['failedStage'] = stage
+
+def sendResult(result):
+	"""Sends a drive's result to the main process (see runResults)"""
+	if RESULT_QUEUE is not None:
+		RESULT_QUEUE.put(result)
+
+class runResults:
+	"""Collects the drive results as they arrive; the report, email subject and exit code come from them"""
+	def __init__(self):
+		self.results = {}		# device : result (see driveResult())
+
+	def add(self, result):
+		"""Takes one drive's result"""
+		self.results[result['drive']] = result
+		if result['status'] == 'failed':
+			debug("%s failed in the %s stage" % (result['drive'], result['failedStage']), 0)
+		elif result['status'] == 'ok':
+			debug("%s finished in %.0fs, %.1f MB written" % (result['drive'], sum(result['stages'].values()),
+				result['bytesWritten'] / 1000000.0), 1)
+
+	def drain(self, queue, timeout=0):
+		"""Takes every result waiting on the queue, waiting up to 'timeout' seconds for the first one"""
+		try:
+			if timeout > 0:
+				self.add(queue.get(True, timeout))
+			while True:
+				self.add(queue.get_nowait())
+		except Empty:
+			pass
+
+	def lost(self, dev, exitcode, stage=None):
+		"""Records a drive whose worker died without sending a result
+		@param stage - (optional) the stage it was in, if known
+		"""
+		if dev not in self.results:
+			debug("%s: the worker exited with code %s without a result" % (dev, exitcode), 0)
+			result = driveResult(dev)
+			stageFailed(result, stage or 'unknown')
+			self.add(result)
+
+	def markFailed(self, dev, stage):
+		"""Marks a drive failed in a stage the main process ran itself (e.g. the fan-out copy)"""
+		if dev in self.results:
+			stageFailed(self.results[dev], stage)
+			debug("%s failed in the %s stage" % (dev, stage), 0)
+
+	def succeeded(self, dev):
+		"""Returns True if a drive went through every stage"""
+		return dev in self.results and self.results[dev]['status'] == 'ok'
+
+	def failed(self):
+		"""Returns the results of the drives that failed"""
+		return [ self.results[dev] for dev in sorted(self.results, key=naturalKey) if self.results[dev]['status'] == 'failed' ]
+
+	def driveTime(self):
+		"""Returns the average seconds a drive that was imaged took, or None if none was"""
+		times = [ sum(result['stages'].values()) for result in self.results.values()
+				  if result['status'] == 'ok' and not result['current'] ]
+		if not times:
+			return None
+		return sum(times) / len(times)
+
+	def summary(self):
+		"""Returns lines describing the results, for the report"""
+		counts = {}
+		for result in self.results.values():
+			counts[result['status']] = counts.get(result['status'], 0) + 1
+		lines = [ "%d drive(s) ok, %d failed, %d already current; %.1f MB written" % (counts.get('ok', 0),
+			counts.get('failed', 0), counts.get('current', 0),
+			sum([ result['bytesWritten'] for result in self.results.values() ]) / 1000000.0) ]
+		for result in self.failed():
+			lines.append("%s failed in the %s stage" % (result['drive'], result['failedStage']))
+		for name in sorted(PINNED_SNAPSHOTS):
+			lines.append("Copied from the %s snapshot %s" % (name, PINNED_SNAPSHOTS[name]))
+		return lines
+
+	def report(self):
+		"""Displays the summary"""
+		for line in self.summary():
+			debug(line, 0)
+
+	def exitCode(self):
+		"""Returns the exit status for the run: 1 if any drive failed"""
+		return self.failed() and 1 or 0
+
+def processDrive(current, watch=None): #"current" must be an array of media devices
+	"""Runs every stage on one drive (the worker process for the drive)
+	@param current - the drive's partitions (media objects)
+	@param watch - (optional) driveWatch the main process's watchdog keeps an eye on
+	"""
 	if type(current).__name__ != "list":
 		debug("processDrive: did not get array of media devices....", 0)
 		exit()
-	if IMAGE_DRIVES:
-		for part in current:
-			part.unmount()
-		current[0].imageFedora(current)
-		if len(current) == 1:
-			debug("Drive only has one partition.....", 1)
-
-	if SYNC_DRIVES:
-		for part in current:
-			if part.getPartNum() == 1:
-				part.copyTools()
-			else:
-				part.debug( "Not copying to [" + part.getDev() + "] because this is not the first FAT32 partition\n", 2)
+	WORKER.watch = watch
+	stages = driveStages()
+	result = driveResult(current[0].getDev()[:-1])
+	disk = current[0].getDisk()
+	writtenBefore = diskBytesWritten(disk)
+	result['current'] = IMAGE_DRIVES and current[0].imageIsCurrent()
+	stage = None
+	try:
+		for (i, (stage, method)) in enumerate(stages):
+			setTracePhase(stage)
+			started = time()
+			if watch is not None:
+				watch.enter(i, result['drive'])
+			if not runDriveStage(current, i, stages) or commandTimedOut():
+				stageFailed(result, stage)
+			result['stages'][stage] = time() - started
+			setTracePhase('setup', current[0].getName()[:-1], started)
+			if commandTimedOut():
+				current[0].debug("Giving up on the drive: the " + stage + " stage overran its deadline", 0)
+				break
+			if watch is not None:
+				watch.leave()
+		stage = None
+	finally:
+		if stage is not None:
+			# a critical failure ended the worker in this stage
+			stageFailed(result, stage)
+		if writtenBefore is not None:
+			result['bytesWritten'] = diskBytesWritten(disk) - writtenBefore
+		sendResult(result)
+	if IMAGE_DRIVES and len(current) == 1:
+		debug("Drive only has one partition.....", 1)
+
+	for part in current:
+		part.reportMountOps()
+
+	if not THREAD_ENGINE:
+		# the drive threads share this process' counters; runDriveThreads() reports them once
+		reportWaitStats()
+
+def runDriveWorkers(devices, results):
+	"""Runs one worker process per drive and handles each drive as soon as its worker exits, while the
+	watchdog stops any drive that overruns a stage's deadline. Each worker holds the write end of a pipe
+	of its own, which reads as closed the moment the worker exits, however it exits.
+	@param devices - dictionary of "device : [media partitions]"
+	@param results - runResults to add the drives' results to
+	"""
+	stages = driveStages()
+	running = {}		# read end of the worker's pipe -> (device, process, driveWatch)
+	killedIn = {}		# device -> stage its worker was killed in
+	for dev in devices:
+		watch = driveWatch()
+		(readFd, writeFd) = os.pipe()
+		# the commands the worker runs mustn't keep the pipe open after it has gone
+		fcntl.fcntl(writeFd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+		p = Process(target=processDrive, args=(devices[dev], watch))
+		p.start()
+		os.close(writeFd)
+		running[readFd] = (dev, p, watch)
+
+	while running:
+		try:
+			ready = select.select(running.keys(), [], [], 1)[0]
+		except select.error, e:
+			if e[0] != errno.EINTR:
+				raise
+			ready = []
+		results.drain(RESULT_QUEUE)
+		for fd in ready:
+			(dev, p, watch) = running.pop(fd)
+			os.close(fd)
+			p.join()
+			results.drain(RESULT_QUEUE)
+			driveFinished(dev, devices[dev], p.exitcode, results, killedIn.get(dev))
+		now = time()
+		for (dev, p, watch) in running.values():
+			if watch.check(stages, now) and now - watch.killedAt >= WATCHDOG_GRACE:
+				# killing the command didn't free the worker (it's stuck in our own code); the worker only has this drive
+				debug(dev + " is still stuck after its command was killed; stopping its worker", 0)
+				killedIn[dev] = stages[watch.stage.value][0]
+				watch.leave()
+				try:
+					os.kill(p.pid, signal.SIGKILL)
+				except OSError:
+					pass
+				reclaimIO(p.pid, dev)
+
+def runDriveThreads(devices, results):
+	"""Runs every drive from this process, a thread per drive, instead of a worker process per drive.
+	The drives spend nearly all their time waiting on external commands (COMMAND_RUNNER limits how many
+	run at once), so a drive costs a thread rather than a forked interpreter. Stages, commands, results
+	and the watchdog are the same as with runDriveWorkers().
+	@param devices - dictionary of "device : [media partitions]"
+	@param results - runResults to add the drives' results to
+	"""
+	stages = driveStages()
+	finished = Queue()		# devices whose thread is done
+	running = {}			# device -> driveWatch
+	threads = {}			# device -> its thread
+	killedIn = {}			# device -> stage it was given up on in
+
+	def driveThread(dev, watch):
+		try:
+			processDrive(devices[dev], watch)
+		finally:
+			finished.put(dev)
+
+	for dev in sorted(devices):
+		watch = driveWatch()
+		thread = threading.Thread(target=driveThread, args=(dev, watch), name=os.path.basename(dev))
+		# a thread stuck in our own code can't be killed; don't let it hold up the exit
+		thread.daemon = True
+		thread.start()
+		running[dev] = watch
+		threads[dev] = thread
+
+	while running:
+		try:
+			dev = finished.get(True, 1)
+		except Empty:
+			dev = None
+		results.drain(RESULT_QUEUE)
+		if dev in running:
+			del running[dev]
+			driveFinished(dev, devices[dev], 0, results, killedIn.get(dev))
+		now = time()
+		for (dev, watch) in running.items():
+			if watch.check(stages, now) and now - watch.killedAt >= WATCHDOG_GRACE:
+				debug(dev + " is still stuck after its command was killed; giving up on it", 0)
+				killedIn[dev] = stages[watch.stage.value][0]
+				watch.leave()
+				del running[dev]
+				# the thread may be in the middle of a copy; its slot goes to the next drive
+				reclaimIO(threads[dev].ident, dev)
+				driveFinished(dev, devices[dev], None, results, killedIn[dev])
+	reportWaitStats()
+
+def driveFinished(dev, parts, exitcode, results, killedIn=None):
+	"""Wraps up a drive as soon as its worker exits
+	@param dev - the device key
+	@param parts - the drive's partitions (media objects)
+	@param exitcode - the worker's exit code
+	@param results - runResults holding the drive's result
+	@param killedIn - (optional) the stage the watchdog killed the worker in
+	"""
+	results.lost(dev, exitcode, killedIn)
+	if FANOUT_POPULATE:
+		# the fan-out copy still needs it
+		return
+	for part in parts:
+		part.unmount()
+	if results.results[dev]['status'] == 'ok':
+		debug(dev + " is done and can be unplugged", 1)
+	else:
+		debug(dev + " failed and can be unplugged", 1)
+
+class drivePipeline:
+	"""Runs the drive stages as a pipeline: every stage has its own queue and its own worker processes,
+	so the quick metadata stages of newly started drives run while other drives are in the
+	bandwidth-bound populate stage. A drive moves to the next stage's queue as soon as it finishes one.
+	Drives can be submitted at any time while the pipeline is running (see hotplugDaemon).
+	"""
+	def __init__(self, devices, stages, workers=None, results=None):
+		"""
+		@param devices - dictionary of "device : [media partitions]" known before the workers start
+		@param stages - list of (name, media method name), see driveStages()
+		@param workers - (optional) dictionary of stage name -> number of workers (default: STAGE_WORKERS)
+		@param results - (optional) runResults to add each drive's result to when it leaves the pipeline
+		"""
+		self.devices = devices
+		self.results = results
+		self.inProgress = {}	# (device, generation) -> result being put together from the stage events
+		self.stages = stages
+		self.workers = dict(STAGE_WORKERS)
+		if workers:
+			self.workers.update(workers)
+		self.queues = [ Queue() for stage in stages ]
+		self.events = Queue()
+		# per stage: drives, total/max service time, total/max time queued, max queue depth
+		self.stats = dict([ (name, { 'drives' : 0, 'failed' : 0, 'service' : 0.0, 'maxService' : 0.0,
+									 'queued' : 0.0, 'maxQueued' : 0.0, 'maxDepth' : 0 }) for (name, method) in stages ])
+		self.failed = []
+		self.pending = 0		# drives submitted but not finished
+		self.submitted = 0
+		self.processes = []
+		self.watches = []		# one driveWatch per stage worker
+		self.generations = []	# per stage worker: the generation of the drive it is on
+		self.built = {}			# (device, generation) -> media partitions built by this worker process
+
+	def run(self):
+		"""Pushes every drive through the stages and waits for all of them to finish"""
+		self.start()
+		for dev in sorted(self.devices):
+			self.submit(dev)
+		self.wait()
+		self.stop()
+
+	def start(self):
+		"""Starts the stage worker processes"""
+		self.started = time()
+		for i in range(len(self.stages)):
+			for n in range(self.numWorkers(i)):
+				self.processes.append(None)
+				self.watches.append(None)
+				self.generations.append(None)
+				self.startWorker(len(self.processes) - 1, i)
+
+	def startWorker(self, n, i):
+		"""Starts (or restarts) stage worker n, a worker for stage i"""
+		self.watches[n] = driveWatch()
+		self.generations[n] = Value('l', 0, lock=False)
+		self.processes[n] = Process(target=self.stageWorker, args=(i, self.watches[n], self.generations[n]))
+		self.processes[n].start()
+
+	def numWorkers(self, i):
+		return max(1, self.workers.get(self.stages[i][0], 1))
+
+	def submit(self, dev, paths=None):
+		"""Queues a drive for the first stage
+		@param dev - the device key (partition link without the partition number)
+		@param paths - (optional) the drive's partition links, for drives the workers don't know about yet
+		"""
+		self.submitted += 1
+		self.pending += 1
+		self.inProgress[(dev, self.submitted)] = driveResult(dev)
+		self.queues[0].put((dev, paths, self.submitted, time()))
+
+	def poll(self, timeout=1):
+		"""Waits up to 'timeout' seconds for a drive to finish a stage
+		@returns (device, ok, finished with the pipeline) or None if nothing happened
+		"""
+		for i in range(len(self.stages)):
+			stats = self.stats[self.stages[i][0]]
+			stats['maxDepth'] = max(stats['maxDepth'], self.queues[i].qsize())
+		now = time()
+		for (n, watch) in enumerate(self.watches):
+			if watch.check(self.stages, now) and now - watch.killedAt >= WATCHDOG_GRACE:
+				self.replaceWorker(n, now)
+		try:
+			(i, dev, generation, queuedAt, started, finished, ok, written, current) = self.events.get(True, timeout)
+		except Empty:
+			return None
+		result = self.inProgress[(dev, generation)]
+		result['stages'][self.stages[i][0]] = finished - started
+		result['bytesWritten'] += written or 0
+		if i == 0:
+			result['current'] = current
+		stats = self.stats[self.stages[i][0]]
+		stats['drives'] += 1
+		stats['service'] += finished - started
+		stats['maxService'] = max(stats['maxService'], finished - started)
+		stats['queued'] += started - queuedAt
+		stats['maxQueued'] = max(stats['maxQueued'], started - queuedAt)
+		if not ok:
+			stats['failed'] += 1
+			self.failed.append(dev)
+			stageFailed(result, self.stages[i][0])
+		done = not ok or i == len(self.stages) - 1
+		if done:
+			self.pending -= 1
+			del self.inProgress[(dev, generation)]
+			if self.results is not None:
+				self.results.add(result)
+		return (dev, ok, done)
+
+	def replaceWorker(self, n, now):
+		"""Stops stage worker n, still stuck after the watchdog killed its command (it's stuck in our own
+		code), fails the drive it was on and starts a new worker for the stage in its place"""
+		(p, watch) = (self.processes[n], self.watches[n])
+		i = watch.stage.value
+		(dev, generation, started) = (watch.drive.value, self.generations[n].value, watch.started.value)
+		debug(dev + " is still stuck after its command was killed; stopping its " + self.stages[i][0] + " worker", 0)
+		watch.leave()
+		try:
+			os.kill(p.pid, signal.SIGKILL)
+		except OSError:
+			pass
+		p.join()
+		reclaimIO(p.pid, dev)
+		self.events.put((i, dev, generation, started, started, now, False, None, False))
+		self.startWorker(n, i)
+
+	def wait(self):
+		"""Waits until every submitted drive has finished"""
+		while self.pending > 0:
+			self.poll()
+
+	def stop(self):
+		"""Stops the stage workers (once they're idle) and reports"""
+		for i in range(len(self.stages)):
+			for n in range(self.numWorkers(i)):
+				self.queues[i].put(None)
+		for p in self.processes:
+			p.join()
+		self.report(time() - self.started)
+
+	def partsFor(self, dev, paths, generation):
+		"""Returns the media partitions for a drive, building them for drives submitted by path"""
+		if paths is None:
+			return self.devices[dev]
+		if (dev, generation) not in self.built:
+			self.built[(dev, generation)] = [ media(path.split('/')[-1], path, DEBUG_LEVEL, force, email) for path in paths ]
+		return self.built[(dev, generation)]
+
+	def stageWorker(self, i, watch, currentGeneration):
+		"""Worker process for stage i: takes drives off the stage's queue and passes them on to the next
+		@param i - the stage
+		@param watch - this worker's driveWatch
+		@param currentGeneration - shared value this worker keeps the generation of its drive in
+		"""
+		WORKER.watch = watch
+		(name, method) = self.stages[i]
+		# Ctrl-C stops the daemon from taking new drives; the drives in progress still finish
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		item = self.queues[i].get()
+		while item is not None:
+			(dev, paths, generation, queuedAt) = item
+			started = time()
+			ok = True
+			written, current = None, False
+			setTracePhase(name)
+			currentGeneration.value = generation
+			watch.enter(i, dev)
+			try:
+				parts = self.partsFor(dev, paths, generation)
+				# this worker may have looked at a drive that had this kernel name before (e.g. sdb) and was unplugged
+				forgetBlockDevice(parts[0].getDev())
+				disk = parts[0].getDisk()
+				writtenBefore = diskBytesWritten(disk)
+				if i == 0:
+					current = IMAGE_DRIVES and parts[0].imageIsCurrent()
+				ok = runDriveStage(parts, i, self.stages) and not commandTimedOut()
+				if writtenBefore is not None:
+					written = diskBytesWritten(disk) - writtenBefore
+				for part in parts:
+					part.reportMountOps()
+					# the failure goes back in the drive's result; a drive plugged into the same port later starts clean
+					if part.getName() in failed_drives:
+						failed_drives.remove(part.getName())
+			except SystemExit:
+				# a critical failure on this drive; the other drives carry on
+				ok = False
+			except Exception, e:
+				debug(dev + ": unexpected error in the " + name + " stage: " + str(e), 0)
+				ok = False
+			watch.leave()
+			finished = time()
+			setTracePhase('idle', os.path.basename(dev), started)
+			if ok and i + 1 < len(self.stages):
+				self.queues[i + 1].put((dev, paths, generation, finished))
+			self.events.put((i, dev, generation, queuedAt, started, finished, ok, written, current))
+			item = self.queues[i].get()
+		reportWaitStats()
+
+	def report(self, elapsed):
+		"""Displays the per-stage queue depth and service time"""
+		debug("Pipeline finished %d drive(s) in %.0fs" % (self.submitted, elapsed), 1)
+		for i in range(len(self.stages)):
+			name = self.stages[i][0]
+			stats = self.stats[name]
+			count = max(stats['drives'], 1)
+			debug("Stage %-10s %d worker(s): %d drive(s), %d failed, service %.1fs avg / %.1fs max, queued %.1fs avg / %.1fs max, max depth %d" % (name,
+				self.numWorkers(i), stats['drives'], stats['failed'], stats['service'] / count,
+				stats['maxService'], stats['queued'] / count, stats['maxQueued'], stats['maxDepth']), 1)
+
+def enumeratePartitions(root):
+	"""Lists the partition links in a device directory, grouped by drive
+	@param root - the directory (e.g. MEDIA_DEV_ROOT) holding a usbXpartY link per partition
+	@returns dictionary of "device : [sorted partition link paths]"
+	"""
+	devices = {}
+	try:
+		names = os.listdir(root)
+	except OSError:
+		return devices
+	for name in sorted(names):
+		path = os.path.join(root, name)
+		if os.path.islink(path):
+			devices.setdefault(path[:-1], []).append(path)
+	return devices
+
+class hotplugWatcher:
+	"""Wakes up when something changes in a device directory: inotify on the directory and, optionally,
+	the kernel/udev uevent netlink socket. Falls back to rescanning every HOTPLUG_RESCAN_INTERVAL
+	seconds when neither is available.
+	"""
+	IN_NONBLOCK = 0x800
+	IN_CLOEXEC = 0x80000
+	# IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+	IN_WATCH_MASK = 0x4 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400
+	NETLINK_KOBJECT_UEVENT = 15
+
+	def __init__(self, root, netlink=False):
+		"""
+		@param root - the directory to watch
+		@param netlink - (optional) also listen for udev uevents on a netlink socket
+		"""
+		self.root = root
+		self.poller = select.poll()
+		self.inotify = None
+		self.netlink = None
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+			if fd >= 0 and libc.inotify_add_watch(fd, root, self.IN_WATCH_MASK) >= 0:
+				self.inotify = fd
+				self.poller.register(fd, select.POLLIN)
+			elif fd >= 0:
+				os.close(fd)
+		except (OSError, AttributeError):
+			pass
+		if self.inotify is None:
+			debug("inotify isn't available, so " + root + " will be rescanned every %ds" % HOTPLUG_RESCAN_INTERVAL, 1)
+		if netlink:
+			try:
+				self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_KOBJECT_UEVENT)
+				self.netlink.bind((0, 2))	# multicast group 2: events after udev has processed them
+				self.poller.register(self.netlink.fileno(), select.POLLIN)
+			except (socket.error, AttributeError), e:
+				debug("Can't listen for udev events: " + str(e), 1)
+				self.netlink = None
+
+	def wait(self, timeout):
+		"""Waits until something may have changed (or 'timeout' seconds pass), draining the events"""
+		for (fd, event) in self.poller.poll(int(timeout * 1000)):
+			try:
+				if fd == self.inotify:
+					while os.read(fd, 4096):
+						pass
+				elif self.netlink is not None and fd == self.netlink.fileno():
+					self.netlink.recv(65536)
+			except (OSError, socket.error):
+				pass
+
+	def close(self):
+		if self.inotify is not None:
+			os.close(self.inotify)
+		if self.netlink is not None:
+			self.netlink.close()
+
+def hotplugDaemon(pipeline, root, netlink=False, initial=None):
+	"""Runs until interrupted, submitting drives to the pipeline as soon as they're plugged in.
+	A drive is submitted once its partition links have stopped changing for HOTPLUG_SETTLE seconds;
+	its port is reported free as soon as it is unplugged.
+	@param pipeline - a started drivePipeline
+	@param root - the device directory to watch (MEDIA_DEV_ROOT)
+	@param netlink - (optional) also listen for udev uevents
+	@param initial - (optional) dictionary of "device : [media partitions]" already plugged in at startup
+	"""
+	watcher = hotplugWatcher(root, netlink)
+	ports = {}		# device -> 'settling', 'busy', 'done' or 'failed'
+	seen = {}		# device -> (partition links, when they last changed)
+	for dev in sorted(initial or {}):
+		seen[dev] = (sorted([ part.getDev() for part in initial[dev] ]), time())
+		ports[dev] = 'busy'
+		pipeline.submit(dev)
+	debug("Waiting for drives to be plugged in under " + root, 0)
+	try:
+		while True:
+			now = time()
+			present = enumeratePartitions(root)
+			if sorted(present.items()) != sorted([ (dev, seen[dev][0]) for dev in seen ]):
+				# a drive came or went; its kernel name may now belong to another drive
+				forgetBlockDevices()
+			for dev in present:
+				if dev not in seen or seen[dev][0] != present[dev]:
+					seen[dev] = (present[dev], now)
+					if dev not in ports:
+						ports[dev] = 'settling'
+				elif ports.get(dev) == 'settling' and now - seen[dev][1] >= HOTPLUG_SETTLE:
+					debug("Drive plugged in at " + dev + ": " + ', '.join(present[dev]), 0)
+					ports[dev] = 'busy'
+					pipeline.submit(dev, present[dev])
+			for dev in seen.keys():
+				if dev not in present:
+					debug("Drive removed from " + dev + " (" + ports.get(dev, 'unknown') + "), the port is free", 0)
+					del seen[dev]
+					ports.pop(dev, None)
+
+			result = pipeline.poll(0)
+			while result is not None:
+				(dev, ok, done) = result
+				if done and dev in ports:
+					if ok:
+						ports[dev] = 'done'
+						debug("Drive at " + dev + " is finished and can be removed", 0)
+					else:
+						ports[dev] = 'failed'
+						debug("Drive at " + dev + " FAILED and can be removed", 0)
+				result = pipeline.poll(0)
+
+			timeout = HOTPLUG_RESCAN_INTERVAL
+			if 'settling' in ports.values() or pipeline.pending > 0:
+				timeout = min(timeout, 0.5)
+			watcher.wait(timeout)
+	except KeyboardInterrupt:
+		debug("Stopping: waiting for the drives in progress to finish", 0)
+	watcher.close()
+	pipeline.wait()
 
 if __name__=="__main__":
 	print "\n"
@@ -923,6 +4289,118 @@ if __name__=="__main__":
 				dest = "image",
 				default = False,
 				help = "Images the drives with the latest image.")
+
+	parser.add_option("-g",
+				"--golden",
+				action="store_true",
+				dest = "golden",
+				default = False,
+				help = "Images the drives by building one golden image per drive size and cloning it (use with -i).")
+
+	parser.add_option("-o",
+				"--fanout",
+				action="store_true",
+				dest = "fanout",
+				default = False,
+				help = "Copies the live folder and tools to all drives at once, reading the source only once.")
+
+	parser.add_option("-b",
+				"--build-fat",
+				action="store_true",
+				dest = "buildFat",
+				default = False,
+				help = "When imaging, writes the TOOLS and LIVE filesystems with their contents directly (no mkdosfs, mount or rsync).")
+
+	parser.add_option("-z",
+				"--discard",
+				action="store_true",
+				dest = "discard",
+				default = False,
+				help = "When cloning golden images, discards (TRIMs) the free space that isn't written.")
+
+	parser.add_option("-n",
+				"--no-readback",
+				action="store_false",
+				dest = "readback",
+				default = True,
+				help = "Skips reading everything back in the verify stage (only the filesystems are checked).")
+
+	parser.add_option("-S",
+				"--snapshots",
+				dest = "snapshots",
+				default = SNAPSHOT_DIR,
+				help = "Keeps immutable snapshots of the live and tools folders here and copies every drive from the ones current at startup ('' copies from the folders directly).")
+
+	parser.add_option("-j",
+				"--journal",
+				dest = "journal",
+				default = JOURNAL_DIR,
+				help = "Keeps each drive's completed stages here so an interrupted run resumes where it stopped ('' turns it off).")
+
+	parser.add_option("-l",
+				"--domain-limit",
+				dest = "domainLimit",
+				default = 0,
+				help = "Number of drives behind one USB root port that may copy at once (default: by link speed).")
+
+	parser.add_option("-p",
+				"--pipeline",
+				action="store_true",
+				dest = "pipeline",
+				default = False,
+				help = "Runs the drives through the wipe/partition/format/populate/bootloader/verify stages as a pipeline.")
+
+	parser.add_option("-w",
+				"--stage-workers",
+				dest = "stageWorkers",
+				default = "",
+				help = "Worker processes per pipeline stage, e.g. 'populate=8,verify=2'.")
+
+	parser.add_option("-k",
+				"--deadlines",
+				dest = "deadlines",
+				default = "",
+				help = "Seconds a drive may spend in a stage before it is stopped and failed, e.g. 'populate=3600,verify=600' (0: no deadline).")
+
+	parser.add_option("-a",
+				"--threads",
+				action="store_true",
+				dest = "threads",
+				default = False,
+				help = "Runs every drive from this one process, a thread per drive, instead of a process per drive.")
+
+	parser.add_option("-c",
+				"--max-commands",
+				dest = "maxCommands",
+				type = "int",
+				default = 0,
+				help = "Most external commands to run at once across all drives (default: no limit).")
+
+	parser.add_option("-D",
+				"--daemon",
+				action="store_true",
+				dest = "daemon",
+				default = False,
+				help = "Keeps running and starts on each drive as soon as it is plugged in (implies -p).")
+
+	parser.add_option("-u",
+				"--udev",
+				action="store_true",
+				dest = "udev",
+				default = False,
+				help = "In daemon mode, also listen for udev events on a netlink socket.")
+
+	parser.add_option("-T",
+				"--trace",
+				dest = "trace",
+				default = "",
+				help = "Records every external command in this directory and writes a timeline (trace.json) and summary.")
+
+	parser.add_option("-P",
+				"--progress",
+				dest = "progress",
+				default = "",
+				help = "Publishes live per-drive progress in this directory (progress.jsonl and Prometheus .prom files).")
 					
 	#Now we'll actually parse the arguments and set the proper variables.
 	(options, args) = parser.parse_args()
@@ -930,13 +4408,8 @@ if __name__=="__main__":
 	#This will build an email to send at execution termination
 	if options.email == True: #technically shouldn't be checking if a boolean equals "True" but for readability will leave it in
 		email = True
-		#Remove the temporary email file if it already exists
-		if os.path.isfile(emailFile):
-			os.remove(emailFile)
-		#Open a new temporary email file for writing
-		emailBody = open(emailFile, "w")
-		# Write the start time at the beginning
-		emailBody.write("Started: " + ctime() + "\n\n")
+		# Every process sends its log lines to one aggregator, which writes the report at the end
+		startLogging()
 		
 	#This will turn on debug mode, which will give more verbose output.
 	if options.debug == True:
@@ -944,6 +4417,21 @@ if __name__=="__main__":
 		
 	if options.debug != 0:
 		DEBUG_LEVEL = options.debug
+
+	#Publish how far along each drive is
+	if options.progress != "":
+		PROGRESS_DIR = options.progress
+		if not os.path.isdir(PROGRESS_DIR):
+			os.makedirs(PROGRESS_DIR)
+
+	#Record every command we run so we can see where the time goes
+	if options.trace != "":
+		TRACE_DIR = options.trace
+		if not os.path.isdir(TRACE_DIR):
+			os.makedirs(TRACE_DIR)
+		for name in os.listdir(TRACE_DIR):
+			if name.startswith('commands-'):
+				os.remove(os.path.join(TRACE_DIR, name))
 		
 	#This will enumerate the drives that we can work with	
 	debug("Attempting to find the drives.", 1)
@@ -954,15 +4442,25 @@ if __name__=="__main__":
 		debug("I will run in \"Force\" mode, which is to say that I'm not going to ask for input.", 1)
 		force = True
 
+	SNAPSHOT_DIR = options.snapshots or None
+	liveManifest = None
+
 	#Now, we'll want to see if the drives should be imaged.
 	if options.image == True:
 		debug("Drives will be IMAGED!", 1)
 		IMAGE_DRIVES = True
+		if SNAPSHOT_DIR:
+			(LIVE_SOURCE, liveManifest) = pinSnapshot('live', LIVE_SOURCE)
 
 	#Now, we can see if we want to copy over the USB tools folders.
 	if options.copyTools == True:
 		debug("I'm going to copy the latest USB tools to the drives.", 1)
-		syncUSBFolder()
+		toolsFolder = syncUSBFolder()
+		if SNAPSHOT_DIR:
+			(TOOLS_SOURCE, TOOLS_MANIFEST) = pinSnapshot('tools', toolsFolder)
+			TOOLS_MANIFEST_PATH = os.path.join(os.path.dirname(TOOLS_SOURCE.rstrip('/')), 'manifest')
+		else:
+			TOOLS_MANIFEST = loadToolsManifest()
 		SYNC_DRIVES = True
 
 	addDevs = [] # A list of devices (not partitions) to use for the keys of 'devices'
@@ -981,19 +4479,109 @@ if __name__=="__main__":
 		devToAdd = current.getDev()[:-1]
 		devices[devToAdd].append(current)
 
-	# Store a list of the processes so we know when they're complete
-	processes = []
+	# Every worker sends the main process a result for its drive
+	RESULT_QUEUE = Queue()
+	results = runResults()
 
-	# Go go gadget!
-	for dev in devices:
-		p = Process(target=processDrive, args=(devices[dev],))
-		p.start()
-		processes.append(p)
+	# Drives that already carry the current image don't need imaging again
+	skippedDrives, downgradedDrives = [], []
+	if IMAGE_DRIVES:
+		for dev in sorted(devices):
+			if devices[dev][0].imageIsCurrent():
+				if SYNC_DRIVES:
+					downgradedDrives.append(dev)
+				else:
+					skippedDrives.append(dev)
+					del devices[dev]
+					result = driveResult(dev)
+					result['status'] = 'current'
+					results.add(result)
+
+	# Build the golden images once, before any drive needs one
+	if IMAGE_DRIVES and options.golden == True:
+		debug("Drives will be imaged from golden images.", 1)
+		GOLDEN_IMAGES = True
+		IMAGE_DISCARD = options.discard
+		if options.daemon == True:
+			# any size of drive may be plugged in later
+			for imageClass in sorted(GOLDEN_IMAGE_SIZE_MB):
+				GOLDEN_IMAGE_PATHS[imageClass] = buildGoldenImage(imageClass, GOLDEN_IMAGE_SIZE_MB[imageClass], SYNC_DRIVES)
+		else:
+			buildGoldenImages(devices)
+
+	if IMAGE_DRIVES and options.buildFat == True and not GOLDEN_IMAGES:
+		debug("The filesystems will be built directly onto the drives.", 1)
+		FAT_BUILD = True
+
+	if IMAGE_DRIVES and not GOLDEN_IMAGES and options.readback == True:
+		LIVE_MANIFEST = liveManifest or loadSourceManifest(LIVE_SOURCE, LIVE_MANIFEST_CACHE)
+	VERIFY_READBACK = options.readback
+
+	JOURNAL_DIR = options.journal
+	if IMAGE_DRIVES or SYNC_DRIVES:
+		# the same for every drive (journals and results carry it); work it out before the workers start
+		sourceVersion()
+
+	# Shared by every worker, so the limit holds across all of them
+	COMMAND_RUNNER = processRunner(options.maxCommands)
+
+	for setting in options.deadlines.split(','):
+		if '=' in setting:
+			(stage, seconds) = setting.split('=', 1)
+			PHASE_DEADLINES[stage.strip()] = int(seconds)
+
+	if options.fanout == True and options.daemon == True:
+		debug("Fan-out copying needs every drive at once, so it is off in daemon mode.", 0)
+	elif options.fanout == True and FAT_BUILD:
+		debug("The filesystems are built with the live folder and tools already in them (-b), so fan-out copying is off.", 0)
+	elif options.fanout == True:
+		debug("The live folder and tools will be copied to all drives at once.", 1)
+		FANOUT_POPULATE = True
 
-	#While there's still a process running...sleep a second
-	for p in processes:
-		while p.is_alive() and p.exitcode == None:
-			sleep(1)
+	# Limit how many drives copy at once behind each USB link
+	scheduler = usbScheduler(int(options.domainLimit))
+	scheduler.addPresentPorts()
+	scheduler.assign(devices)
+
+	if options.pipeline == True or options.daemon == True:
+		debug("The drives will go through the stages as a pipeline.", 1)
+		PIPELINE = True
+		workers = {}
+		for setting in options.stageWorkers.split(','):
+			if '=' in setting:
+				(stage, count) = setting.split('=', 1)
+				workers[stage.strip()] = int(count)
+		pipeline = drivePipeline(devices, driveStages(), workers, results)
+		if options.daemon == True:
+			pipeline.start()
+			hotplugDaemon(pipeline, MEDIA_DEV_ROOT, options.udev, devices)
+			pipeline.stop()
+		else:
+			pipeline.run()
+	elif options.threads == True:
+		debug("The drives will run as threads of this process.", 1)
+		THREAD_ENGINE = True
+		runDriveThreads(devices, results)
+	else:
+		# Go go gadget!
+		runDriveWorkers(devices, results)
+
+	# Every drive is partitioned and formatted; now copy to all of them at once
+	if FANOUT_POPULATE:
+		fanOutPopulate(devices)
+		for dev in devices:
+			if [ part for part in devices[dev] if part.getName() in failed_drives ]:
+				# no stamp, and the journal still has the stages, so the next run redoes just the copy
+				results.markFailed(dev, 'fan-out')
+			elif results.succeeded(dev):
+				finishDrive(devices[dev])
+
+	scheduler.report()
+	results.report()
+	reportSkippedDrives(skippedDrives, downgradedDrives, results.driveTime())
+
+	if TRACE_DIR is not None:
+		exportTrace(TRACE_DIR)
 	
 	#Now that all processes are done....
 	for dev in devices:
@@ -1004,6 +4592,8 @@ if __name__=="__main__":
 	if email:
 		# Make a notice that we're sending the email report		
 		debug("Sending email report.", 1)
-		# Actually send the email with the pre-built emailBody
-		sendEmail(emailBody)
-	
+		# Have the log aggregator put the report together and send it
+		sendEmail(results)
+
+	# The exit status says whether every drive made it
+	sys.exit(results.exitCode())